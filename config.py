@@ -19,6 +19,17 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GEMINI_MODEL = "gemini-2.5-flash-lite"
 GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:generateContent"
 
+# Gemini client: per-attempt timeouts, retries of 429/5xx within the total time budget, and a
+# circuit breaker that fails calls fast for a cooldown after consecutive failures
+GEMINI_CONNECT_TIMEOUT = 3
+GEMINI_READ_TIMEOUT = 20
+GEMINI_TOTAL_TIMEOUT = 40
+GEMINI_MAX_RETRIES = 2
+GEMINI_BACKOFF_BASE_SECONDS = 0.5
+GEMINI_BACKOFF_MAX_SECONDS = 4
+GEMINI_BREAKER_FAILURES = 5
+GEMINI_BREAKER_COOLDOWN_SECONDS = 30
+
 # Web interface configuration
 WEB_BASE_URL = os.environ.get("WEB_BASE_URL", "https://coupi.roymam.com")
 
@@ -29,6 +40,57 @@ CMD_WEB = "/web"
 COUPONS_TABLE = "Coupons"
 PAIRING_TABLE = "Pairing"
 USER_STATE_TABLE = "UserState"
+COUPON_CODES_TABLE = "CouponCodes"
+COUPON_SUMMARY_TABLE = "CouponSummary"
+PROCESSED_MESSAGES_TABLE = "ProcessedMessages"
+SENDER_LEASES_TABLE = "SenderLeases"
+EXTRACTION_CACHE_TABLE = "ExtractionCache"
+
+# Webhook idempotency: Meta retries a delivery for up to 7 days, and a claim that was not
+# completed within the processing timeout (longer than the Lambda timeout) can be taken over
+PROCESSED_MESSAGE_TTL_DAYS = 7
+MESSAGE_PROCESSING_TIMEOUT_SECONDS = 900
+
+# Webhook processing: "inline" handles messages before answering Meta, "async" only enqueues
+# them and answers right away, leaving them to the worker (see services/message_queue.py)
+WEBHOOK_PROCESSING_MODE = os.environ.get("WEBHOOK_PROCESSING_MODE") or "inline"
+MESSAGE_QUEUE_BACKEND = os.environ.get("MESSAGE_QUEUE_BACKEND") or "sqs"
+MESSAGE_QUEUE_URL = os.environ.get("MESSAGE_QUEUE_URL", "")
+WORKER_FUNCTION_NAME = os.environ.get("WORKER_FUNCTION_NAME") or os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+
+# Senders whose messages are processed in parallel; one sender's messages run in order
+MAX_MESSAGE_WORKERS = 8
+
+# Per-sender leases: "table" (conditional writes, across invocations) or "local" (in process).
+# The holder renews its lease every renew interval, so a lease only expires once its holder
+# stopped (crashed or timed out); waiting for one gives up after the wait time
+SENDER_LEASE_BACKEND = os.environ.get("SENDER_LEASE_BACKEND") or "table"
+SENDER_LEASE_SECONDS = 300
+SENDER_LEASE_RENEW_SECONDS = 60
+SENDER_LEASE_WAIT_SECONDS = 60
+
+# Cached Gemini extraction results: kept this long in the table, and this many per container
+EXTRACTION_CACHE_TTL_DAYS = 30
+EXTRACTION_CACHE_SIZE = 256
+
+# Coupon texts the rule-based extractor scores at least this confident skip Gemini
+# (see services/heuristic_parser.py); a value above 1 sends every text to Gemini
+HEURISTIC_CONFIDENCE_THRESHOLD = float(os.environ.get("HEURISTIC_CONFIDENCE_THRESHOLD") or 0.8)
+
+# Storage backend: "dynamodb", or "memory" / "sqlite" to run without AWS (see services/storage_backend.py)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND") or "dynamodb"
+STORAGE_SQLITE_PATH = os.environ.get("STORAGE_SQLITE_PATH", "coupkeep.sqlite3")
+
+# DynamoDB client settings: fail fast on a stalled connection instead of using up the Lambda
+# timeout, retry throttling adaptively, and keep enough pooled connections for parallel reads.
+# The SQS and Lambda clients of the message queue use the same settings
+DYNAMODB_CONNECT_TIMEOUT = 2
+DYNAMODB_READ_TIMEOUT = 5
+DYNAMODB_MAX_RETRIES = 3
+DYNAMODB_MAX_POOL_CONNECTIONS = 32
+
+# Coupon sharing tokens stop working this many days after they were generated
+SHARING_TOKEN_TTL_DAYS = 30
 
 # Message reactions
 REACTION_BOOKMARK = "🔖"
@@ -5,20 +5,29 @@ AWS Lambda function for handling WhatsApp webhook events for coupon management.
 
 import json
 import urllib3
-import uuid
 import traceback
 import base64
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import config
 import services.coupon_parser as coupon_parser
 import services.whatsapp as whatsapp
 import services.storage_service as storage_service
 import services.auth_service as auth_service
 import services.rest_handler as rest_handler
+import services.idempotency_service as idempotency_service
+import services.message_queue as message_queue
+import services.sender_lease as sender_lease
+import services.extraction_cache as extraction_cache
+import services.storage_backend as storage_backend
 import utils.response_formatter as response_formatter
 from datetime import datetime, timedelta
 
 http = urllib3.PoolManager()
 
+# WhatsApp interactive lists are limited to 10 rows
+MAX_LISTED_COUPONS = 10
+
 def debug_print_coupons(coupons, shared_coupons, from_number):
     print(f"Loaded {len(coupons)} coupons and {len(shared_coupons)} shared coupons for user {from_number}")
     for c in coupons:
@@ -28,11 +37,11 @@ def debug_print_coupons(coupons, shared_coupons, from_number):
 
 def response_with_coupon(coupon_data, msg_id, phone_number, is_new=True, existing_coupon=None):
     """
-    Handles the incoming coupon data by sending a reaction to the user's message,
-    saving the coupon, and sending a confirmation message with the coupon details.
+    Handles the incoming coupon data by sending a reaction to the user's message
+    and a confirmation message with the coupon details.
     
     Args:
-        coupon_data: Dictionary containing coupon information
+        coupon_data: Dictionary containing coupon information, already stored
         msg_id: ID of the message that contained the coupon
         phone_number: User's phone number
         is_new: Whether this is a new coupon or an existing one
@@ -52,11 +61,6 @@ def response_with_coupon(coupon_data, msg_id, phone_number, is_new=True, existin
                 # Show existing coupon
                 formatted = response_formatter.format_response(coupon_id, existing_coupon, is_new=False)
                 whatsapp.send_whatsapp_message(phone_number, formatted, is_interactive=True)
-        elif is_new:
-            coupon_id = str(uuid.uuid4())
-            storage_service.store_new_coupon(phone_number, coupon_id, msg_id, coupon_data)   
-            formatted = response_formatter.format_response(coupon_id, coupon_data, is_new=is_new)                                                                    
-            whatsapp.send_whatsapp_message(phone_number, formatted, is_interactive=True)
         else:
             coupon_id = coupon_data["coupon_id"]
             formatted = response_formatter.format_response(coupon_id, coupon_data, is_new=is_new)                                                                    
@@ -64,6 +68,23 @@ def response_with_coupon(coupon_data, msg_id, phone_number, is_new=True, existin
     else:
         whatsapp.send_reaction(phone_number, msg_id, config.REACTION_ERROR)
 
+def save_and_respond_with_coupons(coupons, msg_id, phone_number):
+    """
+    Checks all valid parsed coupons for duplicates at once, stores the new ones
+    in a single batch and responds with the details of each coupon.
+    
+    Args:
+        coupons: List of valid coupon dictionaries parsed from one message
+        msg_id: ID of the message that contained the coupons
+        phone_number: User's phone number
+    """
+    duplicates = storage_service.find_duplicate_coupons(phone_number, coupons)
+    new_coupons = [coupon for coupon, existing in zip(coupons, duplicates) if existing is None]
+    storage_service.store_new_coupons(phone_number, new_coupons, msg_id)
+
+    for coupon, existing in zip(coupons, duplicates):
+        response_with_coupon(coupon, msg_id, phone_number, is_new=True, existing_coupon=existing)
+
 def show_list_of_coupons(from_number, expiring_soon=False):
     """
     Retrieves and displays the user's coupons and any shared coupons.
@@ -72,21 +93,35 @@ def show_list_of_coupons(from_number, expiring_soon=False):
         from_number: User's phone number
         expiring_soon: If True, show only coupons expiring soon
     """
-    coupons = storage_service.get_user_coupons(from_number, expiring_soon=expiring_soon)
-    shared_coupons = storage_service.get_shared_coupons(from_number, expiring_soon=expiring_soon)
-    
-    total_coupons = len(coupons) + len(shared_coupons)
-    
     if expiring_soon:
         title_coupons = "📋 קופונים שעומדים לפוג בקרוב:"
         title_categories = "🎉 קופונים שעומדים לפוג בקרוב!"
     else:
         title_coupons = "📋 רשימת הקופונים שלך:"
         title_categories = "🎉 צברת אחלה של קופונים!"
+
+        # The summary holds the category counts of the whole list, so large lists need no coupon reads
+        summary = storage_service.get_list_summary(from_number)
+        if summary['total'] > MAX_LISTED_COUPONS:
+            formatted_list = response_formatter.format_categories_menu(summary['categories'], summary['total'], title=title_categories)
+            whatsapp.send_whatsapp_message(from_number, formatted_list, is_interactive=True)
+            return
+
+    coupons_iter = storage_service.iter_user_coupons(from_number, expiring_soon=expiring_soon, profile='list')
+    shared_iter = storage_service.iter_shared_coupons(from_number, expiring_soon=expiring_soon, profile='list')
+
+    # Pull only enough coupons to tell whether they fit in a single interactive list
+    coupons = list(itertools.islice(coupons_iter, MAX_LISTED_COUPONS + 1))
+    shared_coupons = list(itertools.islice(shared_iter, MAX_LISTED_COUPONS + 1 - len(coupons)))
+    
+    total_coupons = len(coupons) + len(shared_coupons)
     
-    if total_coupons <= 10:
+    if total_coupons <= MAX_LISTED_COUPONS:
         formatted_list = response_formatter.format_coupons_list_interactive(coupons, shared_coupons, title=title_coupons)
     else:
+        # The categories menu counts every coupon, so read the remaining pages as well
+        coupons.extend(coupons_iter)
+        shared_coupons.extend(shared_iter)
         formatted_list = response_formatter.format_categories_list(coupons, shared_coupons, title=title_categories)
     
     whatsapp.send_whatsapp_message(from_number, formatted_list, is_interactive=True)
@@ -170,8 +205,10 @@ def handle_text_message(msg, from_number):
     user_state = storage_service.get_user_state(from_number)
     if user_state is None or user_state == config.STATE_REGISTRATION_PENDING:
         # new user or pending registration
-        if user_state is None:
-            storage_service.set_user_state(from_number, config.STATE_REGISTRATION_PENDING)
+        if user_state is None and not storage_service.set_user_state(
+                from_number, config.STATE_REGISTRATION_PENDING, expected_state=None):
+            # a concurrent message already started the registration
+            return True
         formatted = response_formatter.format_registration_welcome()
         whatsapp.send_whatsapp_message(from_number, formatted, is_interactive=True)
         return True
@@ -187,7 +224,7 @@ def handle_text_message(msg, from_number):
         search_query = msg_text[1:].strip()
         whatsapp.send_reaction(from_number, msg_id, config.REACTION_PROCESSING)
         
-        coupons = storage_service.get_user_coupons(from_number)
+        coupons = list(storage_service.iter_user_coupons(from_number, profile='search'))
         if not coupons:
             whatsapp.send_reaction(from_number, msg_id, config.REACTION_NONE)
             whatsapp.send_whatsapp_message(from_number, "אין לך קופונים לחיפוש.")
@@ -250,8 +287,7 @@ def handle_text_message(msg, from_number):
         
     # Handle short messages or help requests for registered users
     if user_state == config.STATE_IDLE and (len(msg_text) <= 10 or msg_text in ['?', 'help', 'עזרה', 'אופציה']):
-        coupons = storage_service.get_user_coupons(from_number)
-        formatted = response_formatter.format_welcome_message(new_user=(len(coupons) == 0))
+        formatted = response_formatter.format_welcome_message(new_user=not storage_service.has_coupons(from_number))
         whatsapp.send_whatsapp_message(from_number, formatted, is_interactive=True)
         send_web_cta(from_number)
         return True
@@ -268,17 +304,10 @@ def handle_text_message(msg, from_number):
                 # check if there are more than one coupon
                 if isinstance(coupon_data, list):
                     # Handle multiple coupons
-                    valid_coupons = False
-                    for coupon in coupon_data:
-                        if coupon["valid"]:
-                            # Check for duplicate
-                            existing = None
-                            if coupon.get('coupon_code'):
-                                existing = storage_service.find_coupon_by_code(from_number, coupon['coupon_code'])
-                            response_with_coupon(coupon, msg_id, from_number, is_new=True, existing_coupon=existing)
-                            valid_coupons = True
-                    
-                    if not valid_coupons:
+                    valid_coupons = [coupon for coupon in coupon_data if coupon["valid"]]
+                    if valid_coupons:
+                        save_and_respond_with_coupons(valid_coupons, msg_id, from_number)
+                    else:
                         # clear reaction
                         whatsapp.send_reaction(from_number, msg_id, config.REACTION_NONE)
                         whatsapp.send_whatsapp_message(from_number, response_formatter.format_welcome_message(new_user=False), is_interactive=True)
@@ -289,15 +318,10 @@ def handle_text_message(msg, from_number):
                         whatsapp.send_reaction(from_number, msg_id, config.REACTION_NONE)
 
                         # Show welcome message for unrecognized text
-                        coupons = storage_service.get_user_coupons(from_number)
-                        formatted = response_formatter.format_welcome_message(new_user=(len(coupons) == 0))
+                        formatted = response_formatter.format_welcome_message(new_user=not storage_service.has_coupons(from_number))
                         whatsapp.send_whatsapp_message(from_number, formatted, is_interactive=True)
                     else:
-                        # Check for duplicate
-                        existing = None
-                        if coupon_data.get('coupon_code'):
-                            existing = storage_service.find_coupon_by_code(from_number, coupon_data['coupon_code'])
-                        response_with_coupon(coupon_data, msg_id, from_number, existing_coupon=existing)
+                        save_and_respond_with_coupons([coupon_data], msg_id, from_number)
             else:
                  # message too short and in IDLE, just clear reaction
                  whatsapp.send_reaction(from_number, msg_id, config.REACTION_NONE)
@@ -364,26 +388,17 @@ def handle_media_message(msg, from_number):
             print("Parsed coupon data:", json.dumps(coupon_data, ensure_ascii=False))
             if isinstance(coupon_data, list):
                 # Handle multiple coupons
-                valid_coupons = False
-                for coupon in coupon_data:
-                    if coupon["valid"]:
-                        # Check for duplicate
-                        existing = None
-                        if coupon.get('coupon_code'):
-                            existing = storage_service.find_coupon_by_code(from_number, coupon['coupon_code'])
-                        response_with_coupon(coupon, msg_id, from_number, is_new=True, existing_coupon=existing)
-                        valid_coupons = True
-                
-                if not valid_coupons:
+                valid_coupons = [coupon for coupon in coupon_data if coupon["valid"]]
+                if valid_coupons:
+                    save_and_respond_with_coupons(valid_coupons, msg_id, from_number)
+                else:
                     # clear reaction
                     whatsapp.send_reaction(from_number, msg_id, config.REACTION_NONE)
                     whatsapp.send_whatsapp_message(from_number, response_formatter.format_welcome_message(new_user=False), is_interactive=True)
+            elif coupon_data["valid"]:
+                save_and_respond_with_coupons([coupon_data], msg_id, from_number)
             else:
-                # Check for duplicate
-                existing = None
-                if coupon_data.get('coupon_code'):
-                    existing = storage_service.find_coupon_by_code(from_number, coupon_data['coupon_code'])
-                response_with_coupon(coupon_data, msg_id, from_number, existing_coupon=existing)
+                response_with_coupon(coupon_data, msg_id, from_number)
             return True
         except Exception as e:
             print(f"Error processing media: {str(e)}")
@@ -419,7 +434,8 @@ def handle_interactive_message(msg, from_number):
         if button_id == config.BUTTON_AGREE:
             if user_state == config.STATE_REGISTRATION_PENDING:
                 # Agreeing to terms and privacy, complete registration
-                storage_service.set_user_state(from_number, config.STATE_IDLE)
+                if not storage_service.set_user_state(from_number, config.STATE_IDLE, expected_state=user_state):
+                    return True
                 web_url = auth_service.get_web_url(from_number)
                 formatted = response_formatter.format_commands_list(web_url)
                 whatsapp.send_whatsapp_message(from_number, formatted, is_interactive=True)
@@ -483,7 +499,7 @@ def handle_interactive_message(msg, from_number):
             storage_service.unmark_coupon_as_used(client_id, coupon_id)
             whatsapp.send_reaction(from_number, msg_id, config.REACTION_SUCCESS)
             # Show the coupon again
-            coupon_data = storage_service.get_coupon_by_code(client_id, coupon_id)
+            coupon_data = storage_service.get_coupon_by_code(from_number, coupon_id, owner_id=client_id)
             if coupon_data:
                 formatted = response_formatter.format_response(coupon_id, coupon_data, is_new=False)
                 whatsapp.send_whatsapp_message(from_number, formatted, is_interactive=True)
@@ -534,7 +550,7 @@ def handle_interactive_message(msg, from_number):
             parts = list_id.split(":")
             client_id = parts[1]
             coupon_id = parts[2]
-            coupon_data = storage_service.get_coupon_by_code(client_id, coupon_id)
+            coupon_data = storage_service.get_coupon_by_code(from_number, coupon_id, owner_id=client_id)
             if coupon_data:
                 is_shared = client_id != from_number
                 formatted = response_formatter.format_response(coupon_id, coupon_data, is_new=False, is_shared=is_shared)
@@ -545,8 +561,8 @@ def handle_interactive_message(msg, from_number):
             return True
         elif list_id.startswith(config.BUTTON_CATEGORY_PREFIX):
             category = list_id.split(":")[1]
-            coupons = storage_service.get_user_coupons(from_number)
-            shared_coupons = storage_service.get_shared_coupons(from_number)            
+            coupons = storage_service.get_user_coupons(from_number, profile='list')
+            shared_coupons = storage_service.get_shared_coupons(from_number, profile='list')
             formatted_list = response_formatter.format_category_coupons_list(coupons, shared_coupons, category)
             whatsapp.send_whatsapp_message(from_number, formatted_list, is_interactive=True)
             return True
@@ -573,19 +589,15 @@ def handle_interactive_message(msg, from_number):
                             # Apply the update
                             coupon_data = storage_service.get_coupon_by_code(from_number, coupon_id)
                             if coupon_data:
-                                # Update coupon with selected option's fields
-                                storage_service.update_coupon_details(coupon_data, update_fields)
-                                
-                                # Reload coupon to show updated data
-                                updated_coupon = storage_service.get_coupon_by_code(from_number, coupon_id)
-                                if updated_coupon:
-                                    updated_coupon['valid'] = True
+                                # Update coupon with selected option's fields and show the stored coupon
+                                updated_coupon = storage_service.update_coupon_details(coupon_data, update_fields)
+                                updated_coupon['valid'] = True
                                 
                                 # Send confirmation and show updated coupon
                                 whatsapp.send_reaction(from_number, msg_id, config.REACTION_SUCCESS)
                                 whatsapp.send_whatsapp_message(from_number, f"✅ {selected_option.get('label', 'הקופון עודכן בהצלחה')}")
                                 response_with_coupon(updated_coupon, msg_id, from_number, is_new=False)
-                                storage_service.set_user_state(from_number, config.STATE_IDLE)
+                                storage_service.set_user_state(from_number, config.STATE_IDLE, expected_state=user_state)
                                 return True
                     except (json.JSONDecodeError, ValueError, KeyError, IndexError) as e:
                         print(f"Error decoding update options: {e}")
@@ -624,6 +636,38 @@ def handle_button_message(msg, from_number):
     
     return False
 
+def handle_message(msg):
+    """Dispatch one incoming WhatsApp message by its type."""
+    from_number = msg["from"]
+    whatsapp.send_read_receipt(from_number, msg["id"])
+
+    # Handle different message types
+    if msg.get("type") == "text":
+        handle_text_message(msg, from_number)
+    elif msg.get("type") in ["image", "document"]:
+        handle_media_message(msg, from_number)
+    elif msg.get("type") == "interactive":
+        handle_interactive_message(msg, from_number)
+    elif msg.get("type") == "button":
+        handle_button_message(msg, from_number)
+
+def process_message(msg):
+    """Handle a message once, skipping redeliveries of messages already handled or in progress."""
+    claim = idempotency_service.claim_message(msg["id"])
+    if claim != idempotency_service.CLAIMED:
+        print("Skipping redelivered message:", msg["id"], claim)
+        return
+
+    try:
+        # one message of a user at a time, across concurrent invocations
+        with sender_lease.sender_lease(msg["from"]):
+            handle_message(msg)
+    except Exception:
+        # let Meta's retry of this delivery process the message again
+        idempotency_service.release_message(msg["id"])
+        raise
+    idempotency_service.complete_message(msg["id"])
+
 def lambda_handler(event, context):
     """
     AWS Lambda handler function for processing WhatsApp webhook events and REST API.
@@ -635,6 +679,112 @@ def lambda_handler(event, context):
     Returns:
         Response object with status code and body
     """
+    if message_queue.is_worker_event(event):
+        return worker_handler(event, context)
+
+    try:
+        # reads are memoized only for the duration of one invocation, as warm containers are reused
+        with storage_service.request_scope():
+            return handle_event(event)
+    finally:
+        log_process_stats()
+
+def log_process_stats():
+    """Log the counters this container has kept since it started, once per invocation."""
+    connections = storage_backend.connection_stats()
+    if connections:
+        print("Connection stats:", json.dumps(connections))
+    print("Sender lease stats:", json.dumps(sender_lease.lease_stats()))
+    print("Extraction cache stats:", json.dumps(extraction_cache.cache_stats()))
+
+def worker_handler(event, context):
+    """
+    Process the messages the webhook enqueued in fast-ack mode.
+
+    Accepts an SQS batch or the payload of an asynchronous invocation. Failed SQS messages
+    are reported back so only they are retried; later messages of the same sender are
+    retried with them to keep that sender's order.
+
+    Args:
+        event: SQS event, or {"worker_messages": [...]} from an asynchronous invocation
+        context: AWS Lambda context object
+
+    Returns:
+        SQS partial batch response
+    """
+    queued = message_queue.worker_messages(event)
+    record_ids = {id(msg): record_id for msg, record_id in queued}
+    try:
+        failed = process_messages([msg for msg, _ in queued])
+    finally:
+        log_process_stats()
+    if failed and any(record_ids[id(msg)] is None for msg in failed):
+        # an asynchronous invocation is retried as a whole; handled messages are skipped then
+        raise RuntimeError(f"Failed to process messages: {[msg.get('id') for msg in failed]}")
+    return {"batchItemFailures": [{"itemIdentifier": record_ids[id(msg)]} for msg in failed]}
+
+def process_queued_message(msg):
+    """Process one message in its own request scope."""
+    with storage_service.request_scope():
+        print("Incoming:", json.dumps(msg))
+        process_message(msg)
+
+def process_messages(messages):
+    """
+    Process messages in order per sender, with different senders in parallel.
+
+    A sender's messages run one after the other on one worker thread, at most
+    MAX_MESSAGE_WORKERS senders at a time. When a message fails, the sender's later
+    messages are not processed, so a retry handles them in their original order.
+
+    Returns:
+        The messages that failed or were not processed
+    """
+    by_sender = {}
+    for msg in messages:
+        by_sender.setdefault(msg.get("from"), []).append(msg)
+
+    def process_sender(sender_messages):
+        for index, msg in enumerate(sender_messages):
+            try:
+                process_queued_message(msg)
+            except Exception as e:
+                print("Error processing message:", msg.get("id"), str(e))
+                traceback.print_exc()
+                return sender_messages[index:]
+        return []
+
+    def process_sender_in_worker(sender_messages):
+        # boto3 resources are not thread safe, so each worker thread uses its own
+        with storage_backend.thread_resource():
+            return process_sender(sender_messages)
+
+    senders = list(by_sender.values())
+    if len(senders) <= 1:
+        results = [process_sender(sender_messages) for sender_messages in senders]
+    else:
+        with ThreadPoolExecutor(max_workers=min(config.MAX_MESSAGE_WORKERS, len(senders))) as executor:
+            results = list(executor.map(process_sender_in_worker, senders))
+    return [msg for failed in results for msg in failed]
+
+def incoming_messages(body):
+    """Return every message of a webhook delivery, across all its entries and changes."""
+    return [msg
+            for entry in body.get("entry", [])
+            for change in entry.get("changes", [])
+            for msg in change.get("value", {}).get("messages", [])]
+
+def handle_statuses(body):
+    """Log the delivery status updates (sent, delivered, read, failed) of a webhook delivery."""
+    for entry in body.get("entry", []):
+        for change in entry.get("changes", []):
+            for status in change.get("value", {}).get("statuses", []):
+                print("Message status:", status.get("id"), status.get("recipient_id"), status.get("status"))
+                if status.get("errors"):
+                    print("Message delivery errors:", json.dumps(status["errors"]))
+
+def handle_event(event):
+    """Route a single webhook or REST API event."""
     print("Received event:")
     print(json.dumps(event))
 
@@ -690,22 +840,15 @@ def lambda_handler(event, context):
         try:
             # message received
             print("Received message:", json.dumps(body))
-            if "messages" in body["entry"][0]["changes"][0]["value"]:                
-                msg = body["entry"][0]["changes"][0]["value"]["messages"][0]                
-                print("Incoming:", json.dumps(msg))
-                from_number = msg["from"]
-                whatsapp.send_read_receipt(from_number, msg["id"])
-                
-                # Handle different message types
-                if msg.get("type") == "text":
-                    handle_text_message(msg, from_number)
-                elif msg.get("type") in ["image", "document"]:
-                    handle_media_message(msg, from_number)
-                elif msg.get("type") == "interactive":
-                    handle_interactive_message(msg, from_number)
-                elif msg.get("type") == "button":
-                    handle_button_message(msg, from_number)
-                    
+            handle_statuses(body)
+            messages = incoming_messages(body)
+            if config.WEBHOOK_PROCESSING_MODE == "async":
+                # answer Meta right away; the worker handles the messages
+                message_queue.enqueue_messages(messages)
+            elif process_messages(messages):
+                # Meta redelivers the whole batch; messages already handled are skipped then
+                return {"statusCode": 500, "body": "Error processing message"}
+
             return {"statusCode": 200, "body": "OK"}
         except Exception as e:
             print("Error processing message:", str(e))
@@ -0,0 +1,53 @@
+"""Backfill `active_expiry` on unused coupons saved before the active list indexes existed.
+
+Active and expiring-soon listings query `client_id-active_expiry-index` and
+`shared_with-active_expiry-index`, which only hold coupons carrying `active_expiry`.
+Unused coupons written earlier do not have it and would be missing from the lists
+until this script sets it from their `expires_on`, or for coupons saved before that existed
+from their expiration date, counting relative periods from the day the coupon was saved.
+
+Usage: python -m scripts.backfill_active_expiry [--segments N] [--dry-run]
+"""
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+import services.storage_service as storage_service
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+
+def backfill(segments, dry_run=False):
+    def handle_item(get_table, coupon):
+        key = {'client_id': coupon['client_id'], 'coupon_id': coupon['coupon_id']}
+        # the stored expires_on is the date the user sees, and may have been edited since
+        active_expiry = coupon.get('expires_on') or storage_service.active_expiry_of(
+            coupon.get('expiration_date'), storage_service.saved_on(coupon))
+        if dry_run:
+            print("Would set active_expiry:", key, active_expiry)
+            return True
+        try:
+            # skip coupons used, canceled or already backfilled since the scan read them
+            get_table(config.COUPONS_TABLE).update_item(
+                Key=key,
+                UpdateExpression='SET active_expiry = :active_expiry',
+                ConditionExpression=Attr('coupon_status').eq('unused') & Attr('active_expiry').not_exists(),
+                ExpressionAttributeValues={':active_expiry': active_expiry}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    return parallel_scan(
+        config.COUPONS_TABLE, handle_item, segments,
+        FilterExpression=Attr('coupon_status').eq('unused') & Attr('active_expiry').not_exists(),
+        ProjectionExpression='client_id, coupon_id, expiration_date, expires_on, #ts',
+        ExpressionAttributeNames={'#ts': 'timestamp'}
+    )
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    updated = backfill(args.segments, args.dry_run)
+    print("Coupons backfilled:", updated)
@@ -0,0 +1,68 @@
+"""Backfill the numeric `value_amount` and `remaining_amount` on coupons saved before they existed.
+
+Reads and conditional usage updates use the stored amounts instead of parsing money
+strings like "100₪" on every list. Coupons written earlier only have the `value` text;
+this script parses it once and stores both amounts. Coupons without a numeric value
+are left as they are.
+
+It also recomputes the amounts of values with a comma. Those were stored before the
+shared money parser read "1,000₪" as 1000 instead of 1.0.
+
+Usage: python -m scripts.backfill_amounts [--segments N] [--dry-run]
+"""
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+import services.storage_service as storage_service
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+
+def backfill(segments, dry_run=False):
+    def handle_item(get_table, coupon):
+        key = {'client_id': coupon['client_id'], 'coupon_id': coupon['coupon_id']}
+        amounts = storage_service.amount_fields(coupon.get('value'), coupon.get('used'))
+        if not amounts:
+            return False
+        stored_amount = coupon.get('value_amount')
+        if stored_amount is not None and stored_amount == amounts['value_amount']:
+            return False
+        if coupon.get('coupon_status') == 'used':
+            amounts['remaining_amount'] = 0
+            # marking as used copied the misparsed value_amount into used
+            if stored_amount is not None and coupon.get('used') == stored_amount:
+                amounts['used'] = amounts['value_amount']
+
+        if dry_run:
+            print("Would set amounts:", key, coupon.get('value'), amounts)
+            return True
+        try:
+            # skip coupons whose value or usage changed since the scan read them
+            condition = (Attr('value_amount').not_exists() if stored_amount is None
+                         else Attr('value_amount').eq(stored_amount))
+            condition &= Attr('value').eq(coupon.get('value'))
+            condition &= Attr('used').eq(coupon['used']) if 'used' in coupon else Attr('used').not_exists()
+            get_table(config.COUPONS_TABLE).update_item(
+                Key=key,
+                UpdateExpression='SET ' + ', '.join(f"{name} = :{name}" for name in amounts),
+                ConditionExpression=condition,
+                ExpressionAttributeValues={f":{name}": value for name, value in amounts.items()}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    return parallel_scan(
+        config.COUPONS_TABLE, handle_item, segments,
+        FilterExpression=Attr('value').exists() & (Attr('value_amount').not_exists() | Attr('value').contains(',')),
+        ProjectionExpression='client_id, coupon_id, #val, value_amount, used, coupon_status',
+        ExpressionAttributeNames={'#val': 'value'}
+    )
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    updated = backfill(args.segments, args.dry_run)
+    print("Coupons backfilled:", updated)
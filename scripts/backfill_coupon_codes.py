@@ -0,0 +1,43 @@
+"""Backfill the CouponCodes lookup table from the coupons that are already stored.
+
+Usage: python -m scripts.backfill_coupon_codes [--segments N] [--dry-run]
+"""
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+import services.storage_service as storage_service
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+
+def backfill(segments, dry_run=False):
+    def handle_item(get_table, item):
+        code_key = storage_service.coupon_code_key(item['client_id'], item.get('coupon_code'))
+        if not code_key:
+            return False
+        if dry_run:
+            print("Would index:", code_key, item['coupon_id'])
+            return True
+        try:
+            # never overwrite a lookup that the bot already wrote for a newer coupon
+            get_table(config.COUPON_CODES_TABLE).put_item(
+                Item={'code_key': code_key, 'client_id': item['client_id'], 'coupon_id': item['coupon_id']},
+                ConditionExpression=Attr('code_key').not_exists()
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    return parallel_scan(
+        config.COUPONS_TABLE, handle_item, segments,
+        FilterExpression=Attr('coupon_code').exists(),
+        ProjectionExpression='client_id, coupon_id, coupon_code'
+    )
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    indexed = backfill(args.segments, args.dry_run)
+    print("Coupon codes indexed:", indexed)
@@ -0,0 +1,58 @@
+"""Backfill the normalized `expires_on` date on coupons saved before it existed.
+
+`expiration_date` holds the date as the parser returned it, which is not always ISO.
+Expiring-soon listings now range over `expires_on` and the `active_expiry` index key,
+both normalized to YYYY-MM-DD. This script sets `expires_on` from the raw date, using
+the coupon's save time for relative periods, and fixes `active_expiry` on unused coupons.
+
+Usage: python -m scripts.backfill_expires_on [--segments N] [--dry-run]
+"""
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+import services.storage_service as storage_service
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+
+def backfill(segments, dry_run=False):
+    def handle_item(get_table, coupon):
+        key = {'client_id': coupon['client_id'], 'coupon_id': coupon['coupon_id']}
+        expires_on = storage_service.expiry_fields(coupon['expiration_date'], storage_service.saved_on(coupon)).get('expires_on')
+        if not expires_on:
+            return False
+
+        expression = 'SET expires_on = :expires_on'
+        if 'active_expiry' in coupon:
+            expression += ', active_expiry = :expires_on'
+        if dry_run:
+            print("Would set expires_on:", key, coupon['expiration_date'], "->", expires_on)
+            return True
+        try:
+            # skip coupons whose date or status changed since the scan read them
+            condition = Attr('expiration_date').eq(coupon['expiration_date'])
+            condition &= Attr('active_expiry').exists() if 'active_expiry' in coupon else Attr('active_expiry').not_exists()
+            get_table(config.COUPONS_TABLE).update_item(
+                Key=key,
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                ExpressionAttributeValues={':expires_on': expires_on}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    return parallel_scan(
+        config.COUPONS_TABLE, handle_item, segments,
+        FilterExpression=Attr('expiration_date').attribute_type('S') & Attr('expires_on').not_exists(),
+        ProjectionExpression='client_id, coupon_id, expiration_date, active_expiry, #ts',
+        ExpressionAttributeNames={'#ts': 'timestamp'}
+    )
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    updated = backfill(args.segments, args.dry_run)
+    print("Coupons backfilled:", updated)
@@ -0,0 +1,132 @@
+"""Accuracy and latency benchmark of the rule-based coupon extractor.
+
+Runs services.heuristic_parser over the labeled texts of scripts/heuristic_corpus.json and
+reports how many it answers at the confidence threshold, how accurate the answered fields
+are and how long an extraction takes. Texts marked `needs_gemini` (a shipping notice, an
+expiry the rules cannot read) must never be answered; any that are get reported. With --gemini it also sends every text to Gemini
+(GEMINI_API_KEY must be set) and compares the Gemini path and the combined path, where the
+extractor answers what it can and Gemini the rest.
+
+Usage: python -m scripts.benchmark_heuristic_parser [--threshold X] [--rounds N] [--gemini] [--verbose]
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+import timeit
+from datetime import date
+import config
+import services.heuristic_parser as heuristic_parser
+import utils.money as money
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "heuristic_corpus.json")
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    for entry in entries:
+        entry["reference"] = date.fromisoformat(entry["reference"]) if entry.get("reference") else None
+    return entries
+
+
+def _same(field, expected, actual):
+    if expected is None or actual is None:
+        return expected == actual
+    if field == "coupon_code":
+        return re.sub(r"[\s\-]", "", str(expected)).upper() == re.sub(r"[\s\-]", "", str(actual)).upper()
+    if field in ("value", "discount_value"):
+        if str(expected).endswith("%") or str(actual).endswith("%"):
+            return money.parse_amount(expected) == money.parse_amount(actual)
+        return money.parse_money(expected) == money.parse_money(actual)
+    if field == "url":
+        strip = lambda url: re.sub(r"^(?:https?://)?(?:www\.)?", "", str(url)).rstrip("/").lower()
+        return strip(expected) == strip(actual)
+    return str(expected).strip().lower() == str(actual).strip().lower()
+
+
+def score(expected, result):
+    """Return (correct, total) labeled fields of one extraction result."""
+    if isinstance(expected, dict) and expected.get("valid") is False:
+        valid = any(c.get("valid") for c in result) if isinstance(result, list) else bool(result and result.get("valid"))
+        return (0 if valid else 1), 1
+
+    expected_coupons = expected if isinstance(expected, list) else [expected]
+    total = sum(len(coupon) for coupon in expected_coupons)
+    results = result if isinstance(result, list) else [result]
+    results = [r for r in results if r and r.get("valid")]
+    if len(results) != len(expected_coupons):
+        return 0, total
+
+    code_of = lambda coupon: re.sub(r"[\s\-]", "", str(coupon.get("coupon_code"))).upper()
+    pairs = zip(sorted(expected_coupons, key=code_of), sorted(results, key=code_of))
+    correct = sum(_same(field, value, actual.get(field))
+                  for expected_coupon, actual in pairs for field, value in expected_coupon.items())
+    return correct, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threshold", type=float, default=config.HEURISTIC_CONFIDENCE_THRESHOLD,
+                        help="confidence that skips Gemini (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=200, help="timed passes over the corpus (default: %(default)s)")
+    parser.add_argument("--gemini", action="store_true", help="also run every text through Gemini")
+    parser.add_argument("--verbose", action="store_true", help="print every text the extractor got wrong")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    extractions = [heuristic_parser.extract(entry["text"], entry["reference"]) for entry in corpus]
+    elapsed = timeit.timeit(
+        lambda: [heuristic_parser.extract(entry["text"], entry["reference"]) for entry in corpus], number=args.rounds)
+    heuristic_ms = elapsed / args.rounds / len(corpus) * 1000
+
+    answered = [i for i, (_, confidence) in enumerate(extractions) if confidence >= args.threshold]
+    answered_scores = [score(corpus[i]["expected"], extractions[i][0]) for i in answered]
+    wrong = [i for i, (correct, total) in zip(answered, answered_scores) if correct < total]
+    must_not_answer = [i for i in answered if corpus[i].get("needs_gemini")]
+    all_scores = [score(entry["expected"], coupon) for entry, (coupon, _) in zip(corpus, extractions)]
+
+    ratio = lambda scores: sum(c for c, _ in scores) / max(sum(t for _, t in scores), 1)
+    print(f"{len(corpus)} labeled texts, confidence threshold {args.threshold}")
+    print(f"heuristic:  {heuristic_ms:.3f} ms per text")
+    print(f"  answered without Gemini: {len(answered)}/{len(corpus)} ({len(answered) / len(corpus):.0%}), "
+          f"{len(wrong)} of them with a wrong field, {len(must_not_answer)} that needed Gemini")
+    print(f"  field accuracy when answered: {ratio(answered_scores):.1%}, on every text: {ratio(all_scores):.1%}")
+    if args.verbose:
+        for i in wrong:
+            print("  wrong:", json.dumps({"text": corpus[i]["text"], "got": extractions[i][0]}, ensure_ascii=False))
+        for i in must_not_answer:
+            print("  needed Gemini:", json.dumps({"text": corpus[i]["text"], "got": extractions[i][0]}, ensure_ascii=False))
+
+    if not args.gemini:
+        return
+    if not config.GEMINI_API_KEY:
+        parser.error("--gemini needs GEMINI_API_KEY")
+    import services.coupon_parser as coupon_parser
+
+    gemini_results, gemini_seconds = [], []
+    for entry in corpus:
+        started = time.perf_counter()
+        try:
+            result = coupon_parser.parse_coupon_details_with_gemini(entry["text"])
+        except Exception as e:
+            print("Gemini call failed:", e)
+            result = {"valid": False}
+        gemini_seconds.append(time.perf_counter() - started)
+        gemini_results.append(result)
+
+    gemini_scores = [score(entry["expected"], result) for entry, result in zip(corpus, gemini_results)]
+    combined_scores = [answered_scores[answered.index(i)] if i in answered else gemini_scores[i]
+                       for i in range(len(corpus))]
+    gemini_ms = sum(gemini_seconds) / len(corpus) * 1000
+    combined_ms = (heuristic_ms * len(corpus) + sum(
+        seconds * 1000 for i, seconds in enumerate(gemini_seconds) if i not in answered)) / len(corpus)
+    print(f"gemini:     {gemini_ms:.1f} ms per text, field accuracy {ratio(gemini_scores):.1%}")
+    print(f"combined:   {combined_ms:.1f} ms per text ({gemini_ms / combined_ms:.1f}x), "
+          f"field accuracy {ratio(combined_scores):.1%}")
+
+
+if __name__ == "__main__":
+    main()
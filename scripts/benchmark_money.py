@@ -0,0 +1,69 @@
+"""Micro-benchmark of money parsing over a 1,000 coupon list.
+
+Compares the per-call parser that storage_service and response_formatter each used to
+carry (chained str.replace and an uncompiled re.search) with utils.money, which is
+precompiled and cached. Rendering a list parses `used` and `value` of every coupon,
+so each round parses both fields of all coupons, like one list render.
+
+Usage: python -m scripts.benchmark_money [--coupons N] [--rounds N]
+"""
+
+import argparse
+import random
+import re
+import timeit
+import utils.money as money
+
+SAMPLE_VALUES = [
+    "100₪", "50 ש\"ח", "$25", "200 שח", "75.5₪", "₪1,000", "12,5", "30% הנחה",
+    "שובר מתנה", "150 ש״ח", "€20", "400", "קנה 1 קבל 1", "250₪ / $70", None
+]
+
+
+def legacy_parse_amount(value):
+    """The parser each module used to carry, kept here as the baseline."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(",", ".")
+    text = text.replace("₪", "").replace("$", "").replace("ש\"ח", "").replace("שח", "")
+    match = re.search(r"-?\d+(?:\.\d+)?", text)
+    if not match:
+        return None
+    try:
+        return float(match.group())
+    except ValueError:
+        return None
+
+
+def build_coupons(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        {'value': rng.choice(SAMPLE_VALUES), 'used': rng.choice([0, 0, 0, "10", "25₪", 40])}
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--coupons", type=int, default=1000, help="coupons per list (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=200, help="list renders to time (default: %(default)s)")
+    args = parser.parse_args()
+
+    coupons = build_coupons(args.coupons)
+    values = [coupon['value'] for coupon in coupons] + [coupon['used'] for coupon in coupons]
+
+    legacy = timeit.timeit(lambda: [legacy_parse_amount(value) for value in values], number=args.rounds)
+    scalar = timeit.timeit(lambda: [money.parse_amount(value) for value in values], number=args.rounds)
+    bulk = timeit.timeit(lambda: money.parse_amounts(values), number=args.rounds)
+
+    per_render = lambda total: total / args.rounds * 1000
+    print(f"{args.coupons} coupons, {args.rounds} renders")
+    print(f"legacy parse_amount:  {per_render(legacy):.3f} ms per render")
+    print(f"money.parse_amount:   {per_render(scalar):.3f} ms per render ({legacy / scalar:.1f}x)")
+    print(f"money.parse_amounts:  {per_render(bulk):.3f} ms per render ({legacy / bulk:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Regression checks of the CouponSummary counters, run against the in-memory storage backend.
+
+Each check writes coupons through storage_service the way the webhook and the REST API do,
+inside a request scope, and compares the summary counters with the coupons the user
+actually sees. Exits with an error on the first mismatch.
+
+Usage: python -m scripts.check_coupon_summary
+"""
+
+import os
+
+os.environ["STORAGE_BACKEND"] = "memory"
+
+import services.storage_backend as storage_backend
+import services.storage_service as storage_service
+
+
+def new_coupon(client_id, coupon_id, **fields):
+    coupon = {'store': 'Fox', 'category': 'clothing_and_fashion', 'coupon_code': coupon_id, 'value': '100₪', **fields}
+    storage_service.store_new_coupon(client_id, coupon_id, None, coupon)
+
+def expect(name, actual, expected):
+    if actual != expected:
+        raise SystemExit(f"FAIL {name}: expected {expected!r}, got {actual!r}")
+    print(f"ok   {name}")
+
+def check_unmark_in_request_scope():
+    """Unmarking a used coupon counts it back, even when the coupon was read in the same request."""
+    new_coupon('u1', 'c1')
+    with storage_service.request_scope():
+        storage_service.get_coupon_by_code('u1', 'c1')
+        storage_service.mark_coupon_as_used('u1', 'c1')
+    expect("total after mark as used", storage_service.get_coupon_summary('u1')['total'], 0)
+
+    with storage_service.request_scope():
+        storage_service.get_coupon_by_code('u1', 'c1')
+        storage_service.unmark_coupon_as_used('u1', 'c1')
+        expect("total after unmark, same request", storage_service.get_coupon_summary('u1')['total'], 1)
+    expect("total after unmark", storage_service.get_coupon_summary('u1')['total'], 1)
+
+def check_cached_reads_keep_their_image():
+    """A coupon read earlier in a request keeps the image it was read with after a write."""
+    new_coupon('u2', 'c2')
+    with storage_service.request_scope():
+        before = storage_service.get_coupon_item('u2', 'c2')
+        storage_service.mark_coupon_as_used('u2', 'c2')
+        expect("earlier read unchanged", before['coupon_status'], 'unused')
+        expect("later read sees the write", storage_service.get_coupon_item('u2', 'c2')['coupon_status'], 'used')
+
+def check_partner_share_counted_once():
+    """A partner's coupon also shared one by one is counted once, like it is listed once."""
+    new_coupon('u4', 'c4')
+    new_coupon('u4', 'c5', store='KSP', category='electronics')
+    new_coupon('u5', 'c6')
+    storage_service.confirm_pairing('u4', 'u3')
+    storage_service.share_coupon_with_user('u4', 'c4', 'u3')
+    storage_service.share_coupon_with_user('u5', 'c6', 'u3')
+    with storage_service.request_scope():
+        listed = storage_service.get_user_coupons('u3') + storage_service.get_shared_coupons('u3')
+        summary = storage_service.get_list_summary('u3')
+    expect("list summary total", summary['total'], len(listed))
+    expect("list summary stores", summary['categories'],
+           {'clothing_and_fashion': {'Fox': 2}, 'electronics': {'KSP': 1}})
+
+
+def main():
+    storage_backend.reset_local_storage()
+    check_unmark_in_request_scope()
+    check_cached_reads_keep_their_image()
+    check_partner_share_counted_once()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Regression checks of coupon updates, run against the in-memory storage backend.
+
+Each check updates a coupon through coupon_service the way the REST API does, inside a
+request scope, and compares the coupon it answers with the one stored afterwards. Exits
+with an error on the first mismatch.
+
+Usage: python -m scripts.check_coupon_updates
+"""
+
+import os
+
+os.environ["STORAGE_BACKEND"] = "memory"
+
+import services.coupon_service as coupon_service
+import services.storage_backend as storage_backend
+import services.storage_service as storage_service
+from scripts.check_coupon_summary import expect, new_coupon
+
+
+def check_update_answers_remaining_amount():
+    """A PATCH of `used` or `value` answers the remaining amount the table now holds."""
+    new_coupon('u1', 'c1')
+    with storage_service.request_scope():
+        result = coupon_service.update_fields('u1', 'c1', {'used': '40'})
+    expect("remaining after used", result['coupon']['remaining'], 60.0)
+
+    with storage_service.request_scope():
+        result = coupon_service.update_fields('u1', 'c1', {'value': '500₪'})
+    expect("remaining after value", result['coupon']['remaining'], 460.0)
+    stored = storage_service.get_coupon_item('u1', 'c1')
+    expect("stored remaining", float(stored['remaining_amount']), 460.0)
+
+def check_update_answers_expiry():
+    """A new expiration date is answered with its normalized `expires_on`."""
+    new_coupon('u2', 'c2', expiration_date='2026-11-01')
+    with storage_service.request_scope():
+        result = coupon_service.update_fields('u2', 'c2', {'expiration_date': '30/06/2027'})
+    expect("expires_on after update", result['coupon']['expires_on'], '2027-06-30')
+
+def check_unmark_keeps_edited_expiry():
+    """Unmarking puts a coupon back in the active index under the expiry the user sees."""
+    new_coupon('u3', 'c3', expiration_date='2026-11-01')
+    # saved long ago, so a relative period would count from another day
+    storage_service.table.update_item(Key={'client_id': 'u3', 'coupon_id': 'c3'},
+                                      UpdateExpression='SET #ts = :ts', ExpressionAttributeNames={'#ts': 'timestamp'},
+                                      ExpressionAttributeValues={':ts': '2025-01-01T10:00:00'})
+    with storage_service.request_scope():
+        result = coupon_service.update_fields('u3', 'c3', {'expiration_date': '30 יום'})
+    with storage_service.request_scope():
+        storage_service.mark_coupon_as_used('u3', 'c3')
+    with storage_service.request_scope():
+        storage_service.get_coupon_item('u3', 'c3')
+        storage_service.unmark_coupon_as_used('u3', 'c3')
+    stored = storage_service.get_coupon_item('u3', 'c3')
+    expect("active_expiry after unmark", stored['active_expiry'], result['coupon']['expires_on'])
+
+
+def main():
+    storage_backend.reset_local_storage()
+    check_update_answers_remaining_amount()
+    check_update_answers_expiry()
+    check_unmark_keeps_edited_expiry()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Checks of utils.date_utils.normalize_expiration_date on the expiration dates coupons use.
+
+Each case is a raw expiration date, as Gemini or the rule-based extractor returns it, and
+the date it must normalize to from a fixed reference date; None means it must not be read
+as a date at all. Exits with an error if any case fails.
+
+Usage: python -m scripts.check_date_utils
+"""
+
+from datetime import date
+from utils.date_utils import normalize_expiration_date
+
+REFERENCE = date(2026, 10, 17)
+
+CASES = [
+    ("2027-06-30", "2027-06-30"),
+    ("31/12/2027", "2027-12-31"),
+    ("30.06.27", "2027-06-30"),
+    ("12/27", "2027-12-31"),
+    ("12/25", "2025-12-31"),
+    ("03/11", "2026-11-03"),
+    ("31 בדצמבר 2027", "2027-12-31"),
+    ("December 31, 2025", "2025-12-31"),
+    ("Dec. 31st 2025", "2025-12-31"),
+    ("30 יום", "2026-11-16"),
+    ("ל-30 יום", "2026-11-16"),
+    ("לשנה", "2027-10-17"),
+    ("3 months", "2027-01-17"),
+    ("valid for 1 year", "2027-10-17"),
+    ("חצי שנה", "2027-04-17"),
+    ("לשבועיים", "2026-10-31"),
+    # unit words inside other words or naming a calendar period are not periods
+    ("today", None),
+    ("Monday", None),
+    ("birthday", None),
+    ("סוף החודש", None),
+    ("עד סוף השנה", None),
+    ("סוף השבוע", None),
+    ("end of the month", None),
+    ("this year", None),
+]
+
+
+def main():
+    failed = False
+    for value, expected in CASES:
+        result = normalize_expiration_date(value, REFERENCE)
+        if result == expected:
+            print(f"ok   {value}")
+            continue
+        failed = True
+        print(f"FAIL {value}: expected {expected!r}, got {result!r}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
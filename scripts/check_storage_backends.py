@@ -0,0 +1,124 @@
+"""Check that the memory and SQLite storage backends answer the same expressions the same way.
+
+Runs one sequence of conditional writes, update expressions, index queries, paginated
+queries and filtered scans against a fresh store of each backend. Every result must match
+the DynamoDB behaviour written next to it, and both stores must return the same results.
+This covers sparse indexes too: an item without an index key is not indexed, and writing
+an index key of None is rejected. Exits with an error if any check fails.
+
+Usage: python -m scripts.check_storage_backends
+"""
+
+import os
+import tempfile
+from decimal import Decimal
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+import config
+import services.storage_backend as storage_backend
+
+
+def error_code(call):
+    try:
+        call()
+    except ClientError as e:
+        return e.response['Error']['Code']
+    return None
+
+def ids(response):
+    return [item['coupon_id'] for item in response.get('Items', [])]
+
+def coupon(coupon_id, **fields):
+    return {'client_id': 'c1', 'coupon_id': coupon_id, 'coupon_status': 'unused', **fields}
+
+def run_checks(resource):
+    """Run the checks against a resource; returns [(name, result, expected)]."""
+    table = resource.Table(config.COUPONS_TABLE)
+    results = []
+    check = lambda name, result, expected: results.append((name, result, expected))
+
+    table.put_item(Item=coupon('1', active_expiry='2027-01-31', value='1,000₪', shared_with='c2'))
+    table.put_item(Item=coupon('2', active_expiry='2027-03-01', value='50'))
+    check("None index key rejected",
+          error_code(lambda: table.put_item(Item=coupon('3', active_expiry=None, coupon_status='used'))),
+          'ValidationException')
+    check("None index key rejected on update", error_code(lambda: table.update_item(
+        Key={'client_id': 'c1', 'coupon_id': '2'}, UpdateExpression='SET shared_with = :none',
+        ExpressionAttributeValues={':none': None})), 'ValidationException')
+    table.put_item(Item=coupon('3', coupon_status='used'))
+    table.put_item(Item=coupon('4', value_amount=Decimal(100), remaining_amount=Decimal(30)))
+
+    check("conditional put on an existing key",
+          error_code(lambda: table.put_item(Item=coupon('1'), ConditionExpression=Attr('coupon_id').not_exists())),
+          'ConditionalCheckFailedException')
+    check("conditional put as a string expression",
+          error_code(lambda: table.put_item(Item=coupon('5'), ConditionExpression='attribute_not_exists(coupon_id)')),
+          None)
+
+    updated = table.update_item(
+        Key={'client_id': 'c1', 'coupon_id': '4'},
+        UpdateExpression='ADD used :amount, remaining_amount :negative SET note = if_not_exists(note, :note) '
+                         'REMOVE active_expiry',
+        ConditionExpression='attribute_exists(value_amount) AND remaining_amount >= :amount',
+        ExpressionAttributeValues={':amount': Decimal(20), ':negative': Decimal(-20), ':note': 'n'},
+        ReturnValues='ALL_NEW'
+    )['Attributes']
+    check("update expression", (updated['used'], updated['remaining_amount'], updated['note']),
+          (Decimal(20), Decimal(10), 'n'))
+
+    try:
+        table.update_item(
+            Key={'client_id': 'c1', 'coupon_id': '4'},
+            UpdateExpression='ADD used :amount',
+            ConditionExpression=Attr('remaining_amount').gte(Decimal(20)),
+            ExpressionAttributeValues={':amount': Decimal(20)},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        failed = None
+    except ClientError as e:
+        failed = (e.response['Error']['Code'], 'Item' in e.response)
+    check("failed condition returns the old item", failed, ('ConditionalCheckFailedException', True))
+
+    check("sparse active index skips a missing key", ids(table.query(
+        IndexName='client_id-active_expiry-index', KeyConditionExpression=Key('client_id').eq('c1'))), ['1', '2'])
+    check("range condition on an index", ids(table.query(
+        IndexName='client_id-active_expiry-index',
+        KeyConditionExpression=Key('client_id').eq('c1') & Key('active_expiry').between('2027-01-01', '2027-02-01'))),
+        ['1'])
+    check("sparse shared index skips a missing key", ids(table.query(
+        IndexName='shared_with-index', KeyConditionExpression=Key('shared_with').eq('c2'))), ['1'])
+    check("index scan skips a missing key", sorted(ids(table.scan(IndexName='shared_with-index'))), ['1'])
+
+    first = table.query(KeyConditionExpression=Key('client_id').eq('c1'), Limit=2)
+    second = table.query(KeyConditionExpression=Key('client_id').eq('c1'), Limit=2,
+                         ExclusiveStartKey=first['LastEvaluatedKey'])
+    check("paginated query", (ids(first), ids(second)), (['1', '2'], ['3', '4']))
+    check("filtered scan", ids(table.scan(FilterExpression=Attr('value').contains(','))), ['1'])
+    check("projection", table.get_item(Key={'client_id': 'c1', 'coupon_id': '2'},
+                                       ProjectionExpression='coupon_id, #v',
+                                       ExpressionAttributeNames={'#v': 'value'})['Item'],
+          {'coupon_id': '2', 'value': '50'})
+    return results
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        stores = {
+            'memory': storage_backend.MemoryStore(),
+            'sqlite': storage_backend.SqliteStore(os.path.join(directory, 'check.sqlite3')),
+        }
+        outcomes = {name: run_checks(storage_backend.LocalResource(store)) for name, store in stores.items()}
+
+    failed = False
+    for (name, memory_result, expected), (_, sqlite_result, _) in zip(outcomes['memory'], outcomes['sqlite']):
+        if memory_result == expected and sqlite_result == expected:
+            print(f"ok   {name}")
+            continue
+        failed = True
+        print(f"FAIL {name}: expected {expected!r}, memory gave {memory_result!r}, sqlite gave {sqlite_result!r}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Remove the "..." shared_with sentinel so shared_with-index only holds real recipients.
+
+Unsharing a coupon used to write `shared_with = "..."`, which indexed every unshared
+coupon under a single shared_with-index partition. Unsharing now removes the attribute;
+this script rewrites the rows written before that.
+
+Usage: python -m scripts.cleanup_shared_with_sentinel [--segments N] [--dry-run]
+"""
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+SENTINEL = "..."
+
+
+def cleanup(segments, dry_run=False):
+    def handle_item(get_table, coupon):
+        key = {'client_id': coupon['client_id'], 'coupon_id': coupon['coupon_id']}
+        if dry_run:
+            print("Would unshare:", key)
+            return True
+        try:
+            get_table(config.COUPONS_TABLE).update_item(
+                Key=key,
+                UpdateExpression='REMOVE shared_with',
+                ConditionExpression=Attr('shared_with').eq(SENTINEL)
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    return parallel_scan(
+        config.COUPONS_TABLE, handle_item, segments,
+        FilterExpression=Attr('shared_with').eq(SENTINEL),
+        ProjectionExpression='client_id, coupon_id'
+    )
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    updated = cleanup(args.segments, args.dry_run)
+    print("Sentinel rows cleaned:", updated)
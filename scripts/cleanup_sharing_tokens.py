@@ -0,0 +1,60 @@
+"""Remove placeholder and expired sharing tokens so sharing_token-index stays sparse.
+
+Coupons used to get `sharing_token = "..."` when shared or unshared, which put all of
+them on one partition of sharing_token-index. This script removes those placeholders,
+removes tokens past `sharing_token_expires_at`, and gives tokens created before expiry
+existed a fresh expiry. It is safe to run again periodically as an expiry sweep.
+
+Usage: python -m scripts.cleanup_sharing_tokens [--segments N] [--dry-run]
+"""
+
+from datetime import datetime, timedelta
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+import services.storage_service as storage_service
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+
+def cleanup(segments, dry_run=False):
+    now = datetime.now()
+    default_expiry = int((now + timedelta(days=config.SHARING_TOKEN_TTL_DAYS)).timestamp())
+
+    def handle_item(get_table, coupon):
+        token = coupon['sharing_token']
+        key = {'client_id': coupon['client_id'], 'coupon_id': coupon['coupon_id']}
+        if token == "..." or storage_service.is_sharing_token_expired(coupon, now.timestamp()):
+            update = {'UpdateExpression': 'REMOVE sharing_token, sharing_token_expires_at'}
+        elif coupon.get('sharing_token_expires_at') is None:
+            update = {
+                'UpdateExpression': 'SET sharing_token_expires_at = :expires_at',
+                'ExpressionAttributeValues': {':expires_at': default_expiry}
+            }
+        else:
+            return False
+
+        if dry_run:
+            print("Would update:", key, update['UpdateExpression'])
+            return True
+        try:
+            # skip coupons whose token changed since the scan read them
+            get_table(config.COUPONS_TABLE).update_item(
+                Key=key, ConditionExpression=Attr('sharing_token').eq(token), **update
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    return parallel_scan(
+        config.COUPONS_TABLE, handle_item, segments,
+        FilterExpression=Attr('sharing_token').exists(),
+        ProjectionExpression='client_id, coupon_id, sharing_token, sharing_token_expires_at'
+    )
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    updated = cleanup(args.segments, args.dry_run)
+    print("Sharing tokens cleaned:", updated)
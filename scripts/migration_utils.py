@@ -0,0 +1,50 @@
+"""Helpers shared by the one-off DynamoDB migration scripts."""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import services.storage_backend as storage_backend
+
+DEFAULT_SEGMENTS = 8
+
+
+def build_arg_parser(description):
+    """Build the command line parser shared by the migration scripts."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS,
+                        help="number of parallel scan segments (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report the items that would be changed")
+    return parser
+
+
+def parallel_scan(table_name, handle_item, total_segments=DEFAULT_SEGMENTS, **scan_kwargs):
+    """Scan a table with parallel segments and call `handle_item(tables, item)` for every item.
+
+    Each segment runs in its own thread with its own resource, since boto3 resources
+    are not thread safe. `tables` is a function that returns a segment-local Table by name.
+    Returns the number of items for which `handle_item` returned a truthy value.
+    """
+    def scan_segment(segment):
+        resource = storage_backend.new_resource()
+        tables = {}
+
+        def get_table(name):
+            if name not in tables:
+                tables[name] = resource.Table(name)
+            return tables[name]
+
+        params = dict(scan_kwargs, Segment=segment, TotalSegments=total_segments)
+        changed = 0
+        while True:
+            response = get_table(table_name).scan(**params)
+            for item in response.get('Items', []):
+                if handle_item(get_table, item):
+                    changed += 1
+
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return changed
+            params['ExclusiveStartKey'] = last_key
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        return sum(executor.map(scan_segment, range(total_segments)))
@@ -0,0 +1,54 @@
+"""Drop the per-coupon shared_with copies written by the old pairing fan-out.
+
+Paired users now see each other's coupons through the Pairing table, so coupons that
+were shared with the pairing partner one by one only duplicate that relation.
+Note that a coupon shared with the partner by token before pairing is indistinguishable
+from a fanned-out one, so it stops being shared once the pairing is cancelled.
+
+Usage: python -m scripts.unshare_paired_coupons [--segments N] [--dry-run]
+"""
+
+from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+import config
+from scripts.migration_utils import build_arg_parser, parallel_scan
+
+
+def unshare(segments, dry_run=False):
+    def handle_item(get_table, pairing):
+        owner = pairing['client_id']
+        partner = pairing.get('shared_with_client_id')
+        coupons_table = get_table(config.COUPONS_TABLE)
+        query_params = {
+            'KeyConditionExpression': Key('client_id').eq(owner),
+            'FilterExpression': Attr('shared_with').eq(partner),
+            'ProjectionExpression': 'client_id, coupon_id'
+        }
+        while True:
+            response = coupons_table.query(**query_params)
+            for coupon in response.get('Items', []):
+                if dry_run:
+                    print("Would unshare:", owner, coupon['coupon_id'], partner)
+                    continue
+                try:
+                    coupons_table.update_item(
+                        Key={'client_id': owner, 'coupon_id': coupon['coupon_id']},
+                        UpdateExpression='REMOVE shared_with',
+                        ConditionExpression=Attr('shared_with').eq(partner)
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return True
+            query_params['ExclusiveStartKey'] = last_key
+
+    return parallel_scan(config.PAIRING_TABLE, handle_item, segments)
+
+
+if __name__ == "__main__":
+    args = build_arg_parser(__doc__.splitlines()[0]).parse_args()
+    pairings = unshare(args.segments, args.dry_run)
+    print("Pairings migrated:", pairings)
@@ -1,11 +1,11 @@
 """Authentication service for API key management."""
 
 import uuid
-import boto3
+from boto3.dynamodb.conditions import Key
 import config
+import services.storage_backend as storage_backend
 
-dynamodb = boto3.resource('dynamodb')
-user_state_table = dynamodb.Table(config.USER_STATE_TABLE)
+user_state_table = storage_backend.table(config.USER_STATE_TABLE)
 
 def generate_api_key(client_id):
     """Generate a new API key for a user."""
@@ -21,8 +21,7 @@ def validate_api_key(api_key):
     """Validate an API key and return the associated client_id."""
     response = user_state_table.query(
         IndexName='api_key-index',
-        KeyConditionExpression='api_key = :key',
-        ExpressionAttributeValues={':key': api_key}
+        KeyConditionExpression=Key('api_key').eq(api_key)
     )
     items = response.get('Items', [])
     return items[0]['client_id'] if items else None
@@ -1,6 +1,5 @@
 """Business logic for coupon operations, independent of API layer."""
 
-import uuid
 import json
 from decimal import Decimal
 import services.coupon_parser as coupon_parser
@@ -17,103 +16,100 @@ def add_remaining_field(coupon):
     """Add a computed remaining value (value-used) when value is numeric."""
     if not coupon:
         return coupon
+    return _with_remaining(coupon, storage_service.coupon_amounts(coupon))
 
+def add_remaining_fields(coupons):
+    """add_remaining_field of a whole list, parsing each distinct used and value string once."""
+    coupons = [coupon for coupon in coupons if coupon]
+    return [_with_remaining(coupon, amounts)
+            for coupon, amounts in zip(coupons, storage_service.coupons_amounts(coupons))]
+
+def _with_remaining(coupon, amounts):
     coupon_copy = dict(coupon)
-    used = storage_service.parse_amount(coupon_copy.get('used')) or 0.0
+    used, value_amount, remaining = amounts
     coupon_copy['used'] = used
-
-    value_amount = storage_service.parse_amount(coupon_copy.get('value'))
     if value_amount is not None:
-        coupon_copy['remaining'] = max(value_amount - used, 0.0)
+        coupon_copy['remaining'] = remaining
 
     return coupon_copy
 
+def save_parsed_coupons(client_id, coupons):
+    """Store the new coupons among parsed ones and report duplicates, using batched reads and writes."""
+    duplicates = storage_service.find_duplicate_coupons(client_id, coupons)
+    new_coupons = [coupon for coupon, existing in zip(coupons, duplicates) if existing is None]
+    storage_service.store_new_coupons(client_id, new_coupons)
+
+    results = []
+    for coupon, existing in zip(coupons, duplicates):
+        if existing:
+            results.append({'status': 'duplicate', 'coupon': existing})
+        else:
+            coupon['used'] = 0
+            results.append({'status': 'created', 'coupon': add_remaining_field(coupon)})
+    return results
+
+def create_coupons_from_parsed(client_id, coupon_data):
+    """Create coupon(s) from a parser result, which is either a coupon or a list of coupons."""
+    if isinstance(coupon_data, list):
+        return save_parsed_coupons(client_id, [coupon for coupon in coupon_data if coupon["valid"]])
+
+    if not coupon_data["valid"]:
+        return {'status': 'invalid', 'coupon': coupon_data}
+
+    return save_parsed_coupons(client_id, [coupon_data])[0]
+
 def create_coupon_from_text(client_id, text):
     """Parse and create coupon(s) from text."""
     coupon_data = coupon_parser.parse_coupon_details(text)
-    
-    if isinstance(coupon_data, list):
-        results = []
-        for coupon in coupon_data:
-            if coupon["valid"]:
-                existing = None
-                if coupon.get('coupon_code'):
-                    existing = storage_service.find_coupon_by_code(client_id, coupon['coupon_code'])
-                
-                if existing:
-                    results.append({'status': 'duplicate', 'coupon': existing})
-                else:
-                    coupon_id = str(uuid.uuid4())
-                    storage_service.store_new_coupon(client_id, coupon_id, None, coupon)
-                    coupon['coupon_id'] = coupon_id
-                    coupon['used'] = 0
-                    results.append({'status': 'created', 'coupon': add_remaining_field(coupon)})
-        return results
-    else:
-        if not coupon_data["valid"]:
-            return {'status': 'invalid', 'coupon': coupon_data}
-        
-        existing = None
-        if coupon_data.get('coupon_code'):
-            existing = storage_service.find_coupon_by_code(client_id, coupon_data['coupon_code'])
-        
-        if existing:
-            return {'status': 'duplicate', 'coupon': existing}
-        
-        coupon_id = str(uuid.uuid4())
-        storage_service.store_new_coupon(client_id, coupon_id, None, coupon_data)
-        coupon_data['coupon_id'] = coupon_id
-        coupon_data['used'] = 0
-        return {'status': 'created', 'coupon': add_remaining_field(coupon_data)}
+    return create_coupons_from_parsed(client_id, coupon_data)
 
 def create_coupon_from_image(client_id, image_bytes):
     """Parse and create coupon(s) from image."""
     coupon_data = coupon_parser.parse_image(image_bytes)
-    
-    if isinstance(coupon_data, list):
-        results = []
-        for coupon in coupon_data:
-            if coupon["valid"]:
-                existing = None
-                if coupon.get('coupon_code'):
-                    existing = storage_service.find_coupon_by_code(client_id, coupon['coupon_code'])
-                
-                if existing:
-                    results.append({'status': 'duplicate', 'coupon': existing})
-                else:
-                    coupon_id = str(uuid.uuid4())
-                    storage_service.store_new_coupon(client_id, coupon_id, None, coupon)
-                    coupon['coupon_id'] = coupon_id
-                    coupon['used'] = 0
-                    results.append({'status': 'created', 'coupon': add_remaining_field(coupon)})
-        return results
-    else:
-        if not coupon_data["valid"]:
-            return {'status': 'invalid', 'coupon': coupon_data}
-        
-        existing = None
-        if coupon_data.get('coupon_code'):
-            existing = storage_service.find_coupon_by_code(client_id, coupon_data['coupon_code'])
-        
-        if existing:
-            return {'status': 'duplicate', 'coupon': existing}
-        
-        coupon_id = str(uuid.uuid4())
-        storage_service.store_new_coupon(client_id, coupon_id, None, coupon_data)
-        coupon_data['coupon_id'] = coupon_id
-        coupon_data['used'] = 0
-        return {'status': 'created', 'coupon': add_remaining_field(coupon_data)}
-
-def list_coupons(client_id, expiring_soon=False, include_shared=True, include_used=False):
-    """Get list of user's coupons."""
-    coupons = storage_service.get_user_coupons(client_id, expiring_soon=expiring_soon, include_used=include_used)
-    shared_coupons = []
-    if include_shared:
-        shared_coupons = storage_service.get_shared_coupons(client_id, expiring_soon=expiring_soon, include_used=include_used)
-    
+    return create_coupons_from_parsed(client_id, coupon_data)
+
+def list_coupons(client_id, expiring_soon=False, include_shared=True, include_used=False, limit=None, cursor=None,
+                 view='export'):
+    """Get list of user's coupons.
+
+    When `limit` is given only one page is read: the user's own coupons first, then the
+    coupons shared with them, and `next_cursor` resumes the listing where it stopped.
+    `view` is the projection profile of the listed coupons (list, search, detail or export).
+    """
+    filters = {'expiring_soon': expiring_soon, 'include_used': include_used, 'profile': view}
+    if limit is None:
+        coupons = storage_service.iter_user_coupons(client_id, **filters)
+        shared_coupons = storage_service.iter_shared_coupons(client_id, **filters) if include_shared else []
+        return {
+            'coupons': add_remaining_fields(coupons),
+            'shared_coupons': add_remaining_fields(shared_coupons)
+        }
+
+    source, position = (cursor or "own:").split(":", 1)
+    if source not in ("own", "shared"):
+        raise ValueError("Invalid cursor")
+    coupons, shared_coupons, next_cursor = [], [], None
+
+    if source == "own":
+        coupons, position = storage_service.get_user_coupons_page(client_id, limit, cursor=position or None, **filters)
+        if position:
+            next_cursor = f"own:{position}"
+        elif include_shared:
+            source = "shared"
+
+    remaining = limit - len(coupons)
+    if source == "shared" and include_shared and next_cursor is None:
+        if remaining > 0:
+            shared_coupons, position = storage_service.get_shared_coupons_page(client_id, remaining, cursor=position or None, **filters)
+            if position:
+                next_cursor = f"shared:{position}"
+        else:
+            next_cursor = "shared:"
+
     return {
-        'coupons': [add_remaining_field(c) for c in coupons],
-        'shared_coupons': [add_remaining_field(c) for c in shared_coupons]
+        'coupons': add_remaining_fields(coupons),
+        'shared_coupons': add_remaining_fields(shared_coupons),
+        'next_cursor': next_cursor
     }
 
 def get_coupon(client_id, coupon_id, include_example=False):
@@ -149,7 +145,7 @@ def update_coupon(client_id, coupon_id, update_text):
         parsed_used = storage_service.parse_amount(updated_fields['used'])
         updated_fields['used'] = parsed_used if parsed_used is not None else 0
 
-    storage_service.update_coupon_details(coupon_data, updated_fields)
+    coupon_data = storage_service.update_coupon_details(coupon_data, updated_fields)
     
     return {
         'status': 'updated', 
@@ -169,7 +165,8 @@ def update_fields(client_id, coupon_id, fields):
         parsed_used = storage_service.parse_amount(fields['used'])
         fields['used'] = parsed_used if parsed_used is not None else 0
 
-    storage_service.update_coupon_details(coupon_data, fields)
+    # the remaining amount comes from the stored amounts, so answer with the updated coupon
+    coupon_data = storage_service.update_coupon_details(coupon_data, fields)
     return {'status': 'updated', 'coupon': add_remaining_field(coupon_data)}
 
 def add_coupon_usage(client_id, coupon_id, amount):
@@ -213,7 +210,8 @@ def delete_coupon(client_id, coupon_id):
 
 def search_coupons(client_id, query):
     """Search coupons."""
-    coupons = storage_service.get_user_coupons(client_id)
+    # The LLM search ranks the whole collection, so every page is pulled here
+    coupons = list(storage_service.iter_user_coupons(client_id))
     if not coupons:
         return {'coupons': []}
     
@@ -221,7 +219,7 @@ def search_coupons(client_id, query):
     matching_ids = search_result.get('coupon_ids', [])
     matching_coupons = [c for c in coupons if c['coupon_id'] in matching_ids]
     
-    return {'coupons': [add_remaining_field(c) for c in matching_coupons]}
+    return {'coupons': add_remaining_fields(matching_coupons)}
 
 def share_coupon(client_id, coupon_id):
     """Generate sharing token for a coupon."""
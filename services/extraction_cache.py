@@ -0,0 +1,100 @@
+"""Content-addressed cache of Gemini coupon extraction results.
+
+Users re-forward the same voucher image, SMS or PDF, and one voucher is often sent to many
+users. Results are keyed by a SHA-256 of the normalized text or the media bytes, together with
+the prompt version and the model, so any change to either misses the old entries. They are
+kept in the ExtractionCache table with a TTL, behind an in-process LRU that serves repeats
+in a warm container without a DynamoDB read.
+"""
+
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from botocore.exceptions import ClientError
+import config
+import services.storage_backend as storage_backend
+
+cache_table = storage_backend.table(config.EXTRACTION_CACHE_TABLE)
+
+_lru = collections.OrderedDict()
+_stats = {'memory_hits': 0, 'table_hits': 0, 'misses': 0, 'stores': 0, 'errors': 0}
+_lock = threading.Lock()
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Normalize a coupon text so copies that differ only in whitespace or Unicode form match."""
+    return WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+def cache_key(kind, content, prompt_version):
+    """Build the key of an extraction: its kind (text, image, pdf), model, prompt version and content."""
+    digest = hashlib.sha256()
+    digest.update(f"{kind}\0{config.GEMINI_MODEL}\0{prompt_version}\0".encode("utf-8"))
+    digest.update(content if isinstance(content, bytes) else content.encode("utf-8"))
+    return f"{kind}#{digest.hexdigest()}"
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+def _remember(key, result_json):
+    with _lock:
+        _lru[key] = result_json
+        _lru.move_to_end(key)
+        while len(_lru) > config.EXTRACTION_CACHE_SIZE:
+            _lru.popitem(last=False)
+
+def get(key):
+    """Return the cached extraction of a key as a fresh object, or None on a miss."""
+    with _lock:
+        result_json = _lru.get(key)
+        if result_json is not None:
+            _lru.move_to_end(key)
+            _stats['memory_hits'] += 1
+    if result_json is not None:
+        return json.loads(result_json)
+
+    try:
+        item = cache_table.get_item(Key={'cache_key': key}).get('Item')
+    except ClientError as e:
+        # the cache is an optimization; a failed read only costs a Gemini call
+        print("Extraction cache read failed:", e)
+        _count('errors')
+        item = None
+    # TTL deletion is lazy, so an expired item may still be returned
+    if not item or item.get('expires_at', 0) < time.time():
+        _count('misses')
+        return None
+
+    _count('table_hits')
+    _remember(key, item['result'])
+    return json.loads(item['result'])
+
+def put(key, result):
+    """Cache the extraction result of a key."""
+    # stored as JSON text: Gemini's numbers are floats, which DynamoDB does not accept
+    result_json = json.dumps(result, ensure_ascii=False)
+    _remember(key, result_json)
+    try:
+        cache_table.put_item(Item={
+            'cache_key': key,
+            'result': result_json,
+            'expires_at': int(time.time()) + config.EXTRACTION_CACHE_TTL_DAYS * 24 * 3600
+        })
+        _count('stores')
+    except ClientError as e:
+        print("Extraction cache write failed:", e)
+        _count('errors')
+
+def cache_stats():
+    """Return the hit/miss counters of this process, with the overall hit rate."""
+    with _lock:
+        stats = dict(_stats, memory_entries=len(_lru))
+    lookups = stats['memory_hits'] + stats['table_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['memory_hits'] + stats['table_hits']) / lookups if lookups else 0.0
+    return stats
@@ -0,0 +1,124 @@
+"""
+HTTP client for the Gemini generateContent API, shared by every Gemini call.
+
+Requests go through one pooled urllib3 PoolManager, so warm invocations reuse kept-alive TLS
+connections. Each attempt has connect and read timeouts. 429 and 5xx responses and
+connection errors are retried a bounded number of times with jittered exponential backoff,
+within an overall time budget. After repeated failures a circuit breaker fails calls fast
+for a cooldown period, so a Gemini outage cannot use up the whole Lambda duration.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import urllib3
+import config
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+http = urllib3.PoolManager(
+    maxsize=config.MAX_MESSAGE_WORKERS,
+    retries=False,
+    timeout=urllib3.Timeout(connect=config.GEMINI_CONNECT_TIMEOUT, read=config.GEMINI_READ_TIMEOUT)
+)
+
+
+class GeminiError(Exception):
+    """A Gemini call failed. `status` is the HTTP status, or None when no response came back."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+_breaker_lock = threading.Lock()
+_consecutive_failures = 0
+_open_until = 0.0
+
+
+def _check_breaker():
+    global _open_until
+    with _breaker_lock:
+        if _consecutive_failures < config.GEMINI_BREAKER_FAILURES:
+            return
+        now = time.monotonic()
+        if now < _open_until:
+            raise GeminiError("Gemini circuit breaker is open")
+        # half open: this call is the trial, the others keep failing fast until it succeeds
+        _open_until = now + config.GEMINI_BREAKER_COOLDOWN_SECONDS
+
+def _record_result(success):
+    global _consecutive_failures, _open_until
+    with _breaker_lock:
+        if success:
+            _consecutive_failures = 0
+            return
+        _consecutive_failures += 1
+        if _consecutive_failures >= config.GEMINI_BREAKER_FAILURES:
+            _open_until = time.monotonic() + config.GEMINI_BREAKER_COOLDOWN_SECONDS
+            print("Gemini circuit breaker opened after", _consecutive_failures, "failures")
+
+def _backoff(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), config.GEMINI_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(config.GEMINI_BACKOFF_BASE_SECONDS * 2 ** attempt, config.GEMINI_BACKOFF_MAX_SECONDS))
+
+def generate_content(body):
+    """
+    POST a generateContent request and return the decoded JSON response.
+
+    Raises:
+        GeminiError: on a non-200 response, a timeout or connection error that persisted
+            through the retries, or while the circuit breaker is open
+    """
+    _check_breaker()
+    headers = {
+        "Content-Type": "application/json",
+        "x-goog-api-key": config.GEMINI_API_KEY
+    }
+    payload = json.dumps(body).encode("utf-8")
+    deadline = time.monotonic() + config.GEMINI_TOTAL_TIMEOUT
+
+    attempt = 0
+    while True:
+        retry_after = None
+        # a retry only gets what is left of the total budget
+        read_timeout = max(min(config.GEMINI_READ_TIMEOUT, deadline - time.monotonic()), 1)
+        try:
+            response = http.request("POST", config.GEMINI_API_URL, headers=headers, body=payload,
+                                    timeout=urllib3.Timeout(connect=config.GEMINI_CONNECT_TIMEOUT, read=read_timeout))
+            if response.status == 200:
+                _record_result(True)
+                return json.loads(response.data.decode("utf-8"))
+            error = GeminiError(f"Gemini API error {response.status}: {response.data.decode(errors='replace')}",
+                                response.status)
+            retryable = response.status in RETRYABLE_STATUSES
+            retry_after = response.headers.get("Retry-After")
+        except urllib3.exceptions.HTTPError as e:
+            error = GeminiError(f"Gemini API request failed: {e}")
+            retryable = True
+
+        delay = _backoff(attempt, retry_after)
+        if not retryable or attempt >= config.GEMINI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+            # a client error (400, 403) is a bad request: neither a sign that Gemini is down
+            # nor that it recovered, so it leaves the breaker as it is
+            if retryable:
+                _record_result(False)
+            raise error
+        print(f"{error}; retrying in {delay:.2f}s")
+        time.sleep(delay)
+        attempt += 1
+
+def response_text(result):
+    """Return the text of the first candidate of a generateContent response."""
+    return result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+
+def response_json(result):
+    """Decode the JSON a model answered with, dropping a ```json fence around it."""
+    cleaned_json = re.sub(r"^```json|```$", "", response_text(result).strip(), flags=re.MULTILINE).strip()
+    return json.loads(cleaned_json)
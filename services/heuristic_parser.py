@@ -0,0 +1,236 @@
+"""Rule-based coupon extraction that answers well-structured texts without a Gemini call.
+
+Most forwarded vouchers are SMS or e-mail texts of a few known issuers, with a labeled code,
+an expiration date, an amount and a link. `extract(text)` pulls those fields out with regular
+expressions and scores how sure it is; parse_coupon_details uses the result when the score
+reaches HEURISTIC_CONFIDENCE_THRESHOLD and asks Gemini otherwise. Texts with several coupon
+codes are always left to Gemini, which returns them as a list, and so are texts the rules can
+only answer in part: without an issuer, without an expiry or an amount, or with an expiry
+phrase they cannot read.
+
+The issuer registry names the store and category of a text from its link or its wording, and
+a template may also recognize the issuer's own code format; `register_issuer()` adds issuers.
+"""
+
+import re
+from collections import namedtuple
+import utils.money as money
+from utils.date_utils import normalize_expiration_date
+
+IssuerTemplate = namedtuple(
+    "IssuerTemplate", ["store", "category", "domains", "keywords", "code_pattern"], defaults=(None,)
+)
+
+# Known voucher issuers; a text is attributed to the first one whose domain or keyword it contains
+ISSUERS = [
+    IssuerTemplate("BuyMe", "other", ["buyme.co.il"], ["buyme", "ביימי"]),
+    IssuerTemplate("Shufersal", "food_and_drinks", ["shufersal.co.il"], ["shufersal", "שופרסל"]),
+    IssuerTemplate("Super-Pharm", "beauty_and_health", ["super-pharm.co.il"], ["super-pharm", "סופר-פארם", "סופר פארם"]),
+    IssuerTemplate("Wolt", "food_and_drinks", ["wolt.com"], ["wolt", "וולט"]),
+    IssuerTemplate("10bis", "food_and_drinks", ["10bis.co.il"], ["10bis", "תן ביס"]),
+    IssuerTemplate("Nofshonit", "travel", ["nofshonit.co.il"], ["nofshonit", "נופשונית"]),
+    IssuerTemplate("IKEA", "home_and_garden", ["ikea.co.il", "ikea.com"], ["ikea", "איקאה"]),
+    IssuerTemplate("Fox", "clothing_and_fashion", ["fox.co.il"], ["פוקס"]),
+    IssuerTemplate("KSP", "electronics", ["ksp.co.il"], ["ksp"]),
+    IssuerTemplate("Cinema City", "entertainment", ["cinema-city.co.il"], ["cinema city", "סינמה סיטי"]),
+]
+
+# How much each extracted field adds to the confidence; a code nobody labeled counts for less
+CONFIDENCE_WEIGHTS = {'coupon_code': 0.4, 'store': 0.25, 'expiration_date': 0.15, 'value': 0.15, 'url': 0.05}
+UNLABELED_CODE_WEIGHT = 0.2
+UNLABELED_DATE_WEIGHT = 0.1
+
+URL_PATTERN = re.compile(r"(?:https?://|www\.)[^\s<>\"']+", re.IGNORECASE)
+DOMAIN_PATTERN = re.compile(r"(?:https?://)?(?:www\.)?([^/\s:?#]+)", re.IGNORECASE)
+
+CODE_LABEL = (
+    r"(?:[הבלו]?קוד\s*(?:ה?קופון|ה?שובר|ה?הטבה|ה?הנחה|ה?מימוש|ה?כרטיס)?|מספר\s*(?:ה?שובר|ה?קופון|ה?כרטיס)|"
+    r"(?:coupon|promo|voucher|discount|gift\s*card|card)\s*(?:code|number|no\.?)|code)"
+)
+LABELED_CODE_PATTERN = re.compile(
+    rf"(?<![\w]){CODE_LABEL}\s*[:：\-]?\s*([A-Za-z0-9](?:[A-Za-z0-9]|-(?=[A-Za-z0-9])){{3,39}})", re.IGNORECASE
+)
+# Words that make the code or number after them an order, a shipment or a login, not a coupon
+NON_COUPON_CODE_PATTERN = re.compile(
+    r"(?:\b(?:tracking|track|order|verification|verify|confirmation|delivery|shipment|shipping|package|parcel|"
+    r"booking|reservation|login|otp|security|reference)|מעקב|הזמנה|ההזמנה|אימות|האימות|משלוח|המשלוח|חבילה|"
+    r"החבילה|אישור|האישור)\s*(?:#|no\.?|number|מספר)?\s*[:：\-]?\s*$",
+    re.IGNORECASE
+)
+# A long number standing on its own, like the voucher numbers printed under a barcode
+UNLABELED_CODE_PATTERN = re.compile(r"(?<![\w/.\-])\d{8,20}(?![\w/.\-])")
+# Israeli mobile and landline numbers, which look like voucher numbers but are not
+PHONE_PATTERN = re.compile(r"(?:0|972)\d{8,9}")
+
+DATE_LABEL = (
+    r"(?:בתוקף\s*(?:עד|ל)?(?:\s*ה?תאריך)?|תוקף(?:\s*ה?שובר|\s*ה?קופון)?|תאריך\s*תפוגה|פג\s*תוקף|"
+    r"valid\s*(?:until|till|through|thru|to|for)|expires?(?:\s*on)?|expiry(?:\s*date)?|"
+    r"expiration(?:\s*date)?|use\s*by)"
+)
+DATE_VALUE = (
+    r"\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[/.\-]\d{1,2}(?:[/.\-]\d{4}|[/.\-]\d{2})?|"
+    r"\d{1,2}\s+ב?-?[A-Za-zא-ת]+,?\s*\d{4}|"
+    r"\d+\s*-?\s*(?:ימים|יום|חודשים|חודש|שנים|שנה|days?|months?|years?)|"
+    r"חצי\s*שנה|שנתיים|חודשיים|שנה"
+)
+LABELED_DATE_PATTERN = re.compile(
+    rf"(?<![\w]){DATE_LABEL}\s*[:：]?\s*(?:ה|ב|ל)?-?\s*({DATE_VALUE})(?![\d/]|\.\d)", re.IGNORECASE
+)
+# An expiry label alone, to tell an expiry the rules cannot read ("בתוקף עד סוף החודש") from none
+DATE_LABEL_PATTERN = re.compile(rf"(?<![\w]){DATE_LABEL}(?![A-Za-z])", re.IGNORECASE)
+UNLABELED_DATE_PATTERN = re.compile(r"(?<![\d/.])(\d{1,2}[/.]\d{1,2}[/.](?:\d{4}|\d{2}))(?![\d/]|\.\d)")
+
+AMOUNT = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?"
+MONEY_PATTERN = re.compile(
+    rf"(?:{money.CURRENCY_PATTERN.pattern})\s*(?:{AMOUNT})|(?:{AMOUNT})\s*(?:{money.CURRENCY_PATTERN.pattern})(?![א-ת])",
+    re.IGNORECASE
+)
+PERCENT_PATTERN = re.compile(r"(?<![\d.])(\d{1,2}(?:\.\d+)?)\s*%")
+
+# Words around an amount that make it the coupon's value or its discount
+VALUE_WORDS_PATTERN = re.compile(r"בשווי|בסך|על\s*סך|ערך|שווי|יתרה|טעינה|\b(?:worth|value|amount|balance)\b", re.IGNORECASE)
+DISCOUNT_WORDS_PATTERN = re.compile(r"הנחה|חיסכון|\b(?:off|discount)\b", re.IGNORECASE)
+# Sentences that state restrictions, kept as the coupon's terms
+SENTENCE_BREAK_PATTERN = re.compile(r"\n|(?<=[.!?])\s+")
+TERMS_MARKERS = ("בכפוף", "תקנון", "לא כולל", "לא ניתן", "אינו", "אינה", "terms", "not valid",
+                 "cannot be", "excluding", "one per")
+
+
+def register_issuer(store, category, domains=(), keywords=(), code_pattern=None):
+    """Add an issuer template; `code_pattern` is a regex whose first group is the issuer's code format."""
+    template = IssuerTemplate(store, category, [d.lower() for d in domains], [k.lower() for k in keywords],
+                              re.compile(code_pattern) if isinstance(code_pattern, str) else code_pattern)
+    ISSUERS.append(template)
+    return template
+
+def _find_issuer(text, urls):
+    domains = [DOMAIN_PATTERN.match(url).group(1).lower() for url in urls]
+    lowered = text.lower()
+    for issuer in ISSUERS:
+        if any(domain == d or domain.endswith("." + d) for domain in domains for d in issuer.domains):
+            return issuer
+    for issuer in ISSUERS:
+        if any(keyword in lowered for keyword in issuer.keywords):
+            return issuer
+    return None
+
+def _find_urls(text):
+    return [match.group().rstrip(".,;:!?)]}\"'") for match in URL_PATTERN.finditer(text)]
+
+def _after_non_coupon_words(text, start):
+    return bool(NON_COUPON_CODE_PATTERN.search(text[max(start - 30, 0):start]))
+
+def _find_codes(text, issuer):
+    """Return the distinct codes of a text and whether they were labeled as codes."""
+    codes = []
+    if issuer and issuer.code_pattern:
+        codes = [match.group(1) for match in issuer.code_pattern.finditer(text)]
+    if not codes:
+        # a labeled word is a code only if it has a digit or is written in capitals ("SUMMER"),
+        # and not when the label names a tracking, order or verification code
+        codes = [match.group(1) for match in LABELED_CODE_PATTERN.finditer(text)
+                 if (any(ch.isdigit() for ch in match.group(1)) or match.group(1).isupper())
+                 and not _after_non_coupon_words(text, match.start())]
+    if codes:
+        return list(dict.fromkeys(codes)), True
+
+    without_urls = URL_PATTERN.sub(" ", text)
+    codes = [match.group() for match in UNLABELED_CODE_PATTERN.finditer(without_urls)
+             if not PHONE_PATTERN.fullmatch(match.group()) and not _after_non_coupon_words(without_urls, match.start())]
+    return list(dict.fromkeys(codes)), False
+
+def _find_expiration_date(text, reference):
+    """Return the expiration date of a text, whether it was labeled, and whether the text has
+    an expiry label whose date could not be read."""
+    for match in LABELED_DATE_PATTERN.finditer(text):
+        expiration_date = normalize_expiration_date(match.group(1), reference)
+        if expiration_date:
+            return expiration_date, True, False
+    unreadable = bool(DATE_LABEL_PATTERN.search(text))
+    dates = {normalize_expiration_date(match.group(1), reference) for match in UNLABELED_DATE_PATTERN.finditer(text)}
+    dates.discard(None)
+    # a single date is most likely the expiration; with several it could as well be the issue date
+    if len(dates) == 1:
+        return dates.pop(), False, unreadable
+    return None, False, unreadable
+
+def _near(text, start, end, words_pattern):
+    return bool(words_pattern.search(text[max(start - 20, 0):start]) or words_pattern.search(text[end:end + 12]))
+
+def _find_amounts(text):
+    """Return the value and the discount of a text, either of them possibly None."""
+    values, labeled_values, discounts = [], [], []
+    for match in MONEY_PATTERN.finditer(text):
+        amount = match.group().strip()
+        if _near(text, match.start(), match.end(), DISCOUNT_WORDS_PATTERN):
+            discounts.append(amount)
+        elif _near(text, match.start(), match.end(), VALUE_WORDS_PATTERN):
+            labeled_values.append(amount)
+        else:
+            values.append(amount)
+
+    percent = PERCENT_PATTERN.search(text)
+    discount = f"{percent.group(1)}%" if percent else (discounts[0] if discounts else None)
+    if labeled_values:
+        return labeled_values[0], discount
+    # without a label, only an amount that is the single one of the text is taken as the value
+    distinct = {money.parse_money(amount) for amount in values}
+    return (values[0] if len(distinct) == 1 else None), discount
+
+def _find_terms(text):
+    sentences = [sentence.strip() for sentence in SENTENCE_BREAK_PATTERN.split(text)]
+    terms = [sentence for sentence in sentences if any(marker in sentence.lower() for marker in TERMS_MARKERS)]
+    return "\n".join(terms) or None
+
+def extract(text, reference=None):
+    """
+    Extract the coupon fields of a text with rules alone.
+
+    Args:
+        text: The coupon text as the user sent it
+        reference: Date that relative periods ("בתוקף ל-30 יום") count from (defaults to today)
+
+    Returns:
+        (coupon, confidence): the coupon in the shape parse_coupon_details returns, and a
+        score between 0 and 1 of how complete and unambiguous the extraction is
+    """
+    text = text or ""
+    urls = _find_urls(text)
+    issuer = _find_issuer(text, urls)
+    codes, labeled_code = _find_codes(text, issuer)
+    expiration_date, labeled_date, unreadable_date = _find_expiration_date(text, reference)
+    value, discount_value = _find_amounts(text)
+
+    coupon = {
+        "valid": bool(codes),
+        "store": issuer.store if issuer else None,
+        "coupon_code": codes[0] if codes else None,
+        "coupon_date": None,
+        "expiration_period": None,
+        "expiration_date": expiration_date,
+        "discount_value": discount_value,
+        "value": value,
+        "cost": None,
+        "terms_and_conditions": _find_terms(text),
+        "url": urls[0] if urls else None,
+        "category": issuer.category if issuer else "other",
+        "misc": None
+    }
+    # without a code there is no coupon to store, and several codes are several coupons
+    if len(codes) != 1:
+        return coupon, 0.0
+    # a code is a coupon only with its issuer and an expiry or an amount; and an expiry the
+    # rules could not read would be lost, so all of these are left to Gemini
+    if not issuer or not (expiration_date or value or discount_value) or unreadable_date:
+        return coupon, 0.0
+
+    confidence = CONFIDENCE_WEIGHTS['coupon_code'] if labeled_code else UNLABELED_CODE_WEIGHT
+    if issuer:
+        confidence += CONFIDENCE_WEIGHTS['store']
+    if expiration_date:
+        confidence += CONFIDENCE_WEIGHTS['expiration_date'] if labeled_date else UNLABELED_DATE_WEIGHT
+    if value or discount_value:
+        confidence += CONFIDENCE_WEIGHTS['value']
+    if urls:
+        confidence += CONFIDENCE_WEIGHTS['url']
+    return coupon, round(confidence, 2)
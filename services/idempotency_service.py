@@ -0,0 +1,74 @@
+"""Idempotency of webhook deliveries, keyed by WhatsApp message ID.
+
+Meta redelivers a webhook when the previous delivery was slow or failed. Every message is
+claimed with a conditional put before it is processed, so a redelivery of a message that was
+already handled, or that another invocation is handling right now, is skipped.
+"""
+
+import time
+from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+import config
+import services.storage_backend as storage_backend
+
+processed_table = storage_backend.table(config.PROCESSED_MESSAGES_TABLE)
+
+# Outcomes of claim_message
+CLAIMED = "claimed"
+ALREADY_PROCESSED = "already_processed"
+IN_PROGRESS = "in_progress"
+
+STATUS_PROCESSING = "processing"
+STATUS_DONE = "done"
+
+_deserializer = TypeDeserializer()
+
+
+def claim_message(message_id):
+    """Record that `message_id` is being processed, unless it already was.
+
+    Returns CLAIMED when the caller should process the message, ALREADY_PROCESSED for a
+    redelivery of a handled message and IN_PROGRESS when another invocation holds it.
+    A claim whose processing timed out without completing can be taken over.
+    """
+    now = int(time.time())
+    try:
+        processed_table.put_item(
+            Item={
+                'message_id': message_id,
+                'message_status': STATUS_PROCESSING,
+                'claimed_at': now,
+                'lease_expires_at': now + config.MESSAGE_PROCESSING_TIMEOUT_SECONDS,
+                'expires_at': now + config.PROCESSED_MESSAGE_TTL_DAYS * 24 * 3600
+            },
+            ConditionExpression=Attr('message_id').not_exists()
+                                | (Attr('message_status').eq(STATUS_PROCESSING) & Attr('lease_expires_at').lt(now)),
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return CLAIMED
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        old_item = e.response.get('Item') or {}
+        status = _deserializer.deserialize(old_item['message_status']) if 'message_status' in old_item else None
+        return ALREADY_PROCESSED if status == STATUS_DONE else IN_PROGRESS
+
+def complete_message(message_id):
+    """Mark a claimed message as processed, so later redeliveries are skipped."""
+    processed_table.update_item(
+        Key={'message_id': message_id},
+        UpdateExpression='SET message_status = :done REMOVE lease_expires_at',
+        ExpressionAttributeValues={':done': STATUS_DONE}
+    )
+
+def release_message(message_id):
+    """Drop the claim of a message whose processing failed, so Meta's retry processes it again."""
+    try:
+        processed_table.delete_item(
+            Key={'message_id': message_id},
+            ConditionExpression=Attr('message_status').eq(STATUS_PROCESSING)
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
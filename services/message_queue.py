@@ -0,0 +1,92 @@
+"""Queue of incoming WhatsApp messages for fast-ack webhook processing.
+
+In the `async` webhook mode the webhook only enqueues the messages of a delivery and returns
+200 right away; a worker runs them later through `lambda_function.worker_handler`.
+MESSAGE_QUEUE_BACKEND selects where they go:
+
+- `sqs`: an SQS queue (MESSAGE_QUEUE_URL) that triggers the worker. With a FIFO queue,
+  messages of one sender keep their order and share a message group.
+- `lambda`: an asynchronous invocation of the worker function (WORKER_FUNCTION_NAME).
+- `local`: an in-process queue, drained with `process_local_queue()`, for tests and local runs.
+"""
+
+import collections
+import json
+import threading
+import boto3
+import config
+import services.storage_backend as storage_backend
+
+# SendMessageBatch accepts up to 10 messages per request
+SQS_BATCH_SIZE = 10
+
+_clients = {}
+_local_queue = collections.deque()
+_lock = threading.Lock()
+
+
+def _client(service):
+    with _lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(service, config=storage_backend.CLIENT_CONFIG)
+        return _clients[service]
+
+def enqueue_messages(messages):
+    """Hand the messages of a webhook delivery to the worker. Raises if they could not be queued."""
+    if not messages:
+        return
+    backend = config.MESSAGE_QUEUE_BACKEND
+    if backend == 'sqs':
+        _send_to_sqs(messages)
+    elif backend == 'lambda':
+        _invoke_worker(messages)
+    elif backend == 'local':
+        _local_queue.extend(messages)
+    else:
+        raise ValueError(f"Unknown message queue backend: {backend}")
+    print("Messages enqueued:", backend, [msg["id"] for msg in messages])
+
+def _send_to_sqs(messages):
+    fifo = config.MESSAGE_QUEUE_URL.endswith('.fifo')
+    for start in range(0, len(messages), SQS_BATCH_SIZE):
+        entries = []
+        for index, msg in enumerate(messages[start:start + SQS_BATCH_SIZE]):
+            entry = {'Id': str(index), 'MessageBody': json.dumps(msg)}
+            if fifo:
+                entry['MessageGroupId'] = msg["from"]
+                entry['MessageDeduplicationId'] = msg["id"]
+            entries.append(entry)
+        response = _client('sqs').send_message_batch(QueueUrl=config.MESSAGE_QUEUE_URL, Entries=entries)
+        if response.get('Failed'):
+            raise RuntimeError(f"Failed to enqueue messages: {response['Failed']}")
+
+def _invoke_worker(messages):
+    response = _client('lambda').invoke(
+        FunctionName=config.WORKER_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=json.dumps({'worker_messages': messages}).encode('utf-8')
+    )
+    if response.get('StatusCode') != 202:
+        raise RuntimeError(f"Failed to invoke worker: {response.get('StatusCode')}")
+
+def worker_messages(event):
+    """Return the messages a worker event carries, as (message, SQS record ID or None) pairs."""
+    if 'worker_messages' in event:
+        return [(msg, None) for msg in event['worker_messages']]
+    return [(json.loads(record['body']), record.get('messageId')) for record in event.get('Records', [])]
+
+def is_worker_event(event):
+    """Tell a queued-messages event apart from an API Gateway request."""
+    return 'worker_messages' in event or any(
+        record.get('eventSource') == 'aws:sqs' for record in event.get('Records', []))
+
+def process_local_queue(handle):
+    """Run `handle(msg)` for every message in the local queue, in order. Returns how many ran."""
+    processed = 0
+    while True:
+        try:
+            msg = _local_queue.popleft()
+        except IndexError:
+            return processed
+        handle(msg)
+        processed += 1
@@ -94,12 +94,24 @@ def handle_rest_api(event):
 
 def get_coupons(client_id, params):
     params = params or {}
-    result = coupon_service.list_coupons(
-        client_id,
-        params.get('expiring_soon') == 'true',
-        params.get('include_shared', 'true') == 'true',
-        params.get('include_used', 'false') == 'true'
-    )
+    limit = params.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) <= 0:
+            return make_json_response(400, {'error': 'Invalid limit'})
+        limit = int(limit)
+    try:
+        result = coupon_service.list_coupons(
+            client_id,
+            params.get('expiring_soon') == 'true',
+            params.get('include_shared', 'true') == 'true',
+            params.get('include_used', 'false') == 'true',
+            limit=limit,
+            cursor=params.get('cursor'),
+            view=params.get('view', 'export')
+        )
+    except ValueError as e:
+        # invalid cursor or view
+        return make_json_response(400, {'error': str(e)})
     return make_json_response(200, result)
 
 def create_coupon(client_id, body):
@@ -0,0 +1,173 @@
+"""Per-sender leases that serialize the processing of one user's messages.
+
+A user often sends a photo and a clarifying text right after it, and Meta may deliver them to
+concurrent invocations. Both read and write the user's state, so their flows would interleave.
+`sender_lease(sender)` holds a lease on the sender while a message is processed: messages of
+one sender run one at a time, while different senders never wait for each other.
+
+SENDER_LEASE_BACKEND selects the implementation:
+
+- `table`: a conditional put on the SenderLeases table, shared by all invocations. While the
+  block runs, a background thread renews the lease every SENDER_LEASE_RENEW_SECONDS, so a
+  slow message keeps it however long it takes. A lease that is not renewed expires after
+  SENDER_LEASE_SECONDS, so one left behind by a crashed invocation is taken over.
+- `local`: an in-process lock per sender, for tests and single-process local runs.
+"""
+
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+import config
+import services.storage_backend as storage_backend
+
+leases_table = storage_backend.table(config.SENDER_LEASES_TABLE)
+
+# Polling delays while another invocation holds the lease
+POLL_INITIAL_SECONDS = 0.05
+POLL_MAX_SECONDS = 1.0
+
+_local_locks = {}
+_stats = {'acquired': 0, 'contended': 0, 'timeouts': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+_lock = threading.Lock()
+
+
+def _try_acquire(sender, owner):
+    now = time.time()
+    try:
+        leases_table.put_item(
+            Item={
+                'sender': sender,
+                'owner': owner,
+                'lease_expires_at': int(now + config.SENDER_LEASE_SECONDS),
+                # kept past the lease so a TTL on expires_at removes stale rows
+                'expires_at': int(now + config.SENDER_LEASE_SECONDS + 24 * 3600)
+            },
+            ConditionExpression=Attr('sender').not_exists() | Attr('lease_expires_at').lt(int(now))
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+def _release(sender, owner):
+    try:
+        leases_table.delete_item(Key={'sender': sender}, ConditionExpression=Attr('owner').eq(owner))
+    except ClientError as e:
+        # the lease expired and was taken over; it is not ours to delete anymore
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def _renew(sender, owner):
+    """Push the expiry of our lease forward. Returns False once the lease is no longer ours."""
+    now = time.time()
+    try:
+        leases_table.update_item(
+            Key={'sender': sender},
+            UpdateExpression='SET lease_expires_at = :lease_expires_at, expires_at = :expires_at',
+            ConditionExpression=Attr('owner').eq(owner),
+            ExpressionAttributeValues={
+                ':lease_expires_at': int(now + config.SENDER_LEASE_SECONDS),
+                ':expires_at': int(now + config.SENDER_LEASE_SECONDS + 24 * 3600)
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+
+def _keep_renewed(sender, owner, stopped):
+    # runs next to the processing thread, so it renews through a resource of its own
+    with storage_backend.thread_resource():
+        while not stopped.wait(config.SENDER_LEASE_RENEW_SECONDS):
+            try:
+                if not _renew(sender, owner):
+                    print(f"Lost the lease of sender {sender} while processing")
+                    return
+            except Exception as e:
+                # a failed renewal is retried at the next interval, well before the lease expires
+                print(f"Error renewing the lease of sender {sender}: {e}")
+
+def _acquire_table_lease(sender, owner, deadline):
+    """Poll for the lease with jittered backoff. Returns (acquired, contended)."""
+    delay = POLL_INITIAL_SECONDS
+    contended = False
+    while not _try_acquire(sender, owner):
+        contended = True
+        if time.monotonic() >= deadline:
+            return False, contended
+        time.sleep(min(delay * random.uniform(0.5, 1.5), max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, POLL_MAX_SECONDS)
+    return True, contended
+
+def _acquire_local_lock(lock):
+    if lock.acquire(blocking=False):
+        return True, False
+    return lock.acquire(timeout=config.SENDER_LEASE_WAIT_SECONDS), True
+
+def _local_lock(sender):
+    with _lock:
+        return _local_locks.setdefault(sender, threading.Lock())
+
+def _record_wait(waited, acquired, contended):
+    with _lock:
+        if not acquired:
+            _stats['timeouts'] += 1
+            return
+        _stats['acquired'] += 1
+        if contended:
+            _stats['contended'] += 1
+            _stats['wait_seconds'] += waited
+            _stats['max_wait_seconds'] = max(_stats['max_wait_seconds'], waited)
+
+@contextmanager
+def sender_lease(sender):
+    """Hold the lease of a sender for the duration of the block.
+
+    Waits up to SENDER_LEASE_WAIT_SECONDS for another holder to finish, then raises
+    TimeoutError so the message fails and is retried later in order.
+    """
+    started = time.monotonic()
+    owner = str(uuid.uuid4())
+    if config.SENDER_LEASE_BACKEND == 'local':
+        lock = _local_lock(sender)
+        acquired, contended = _acquire_local_lock(lock)
+    else:
+        acquired, contended = _acquire_table_lease(sender, owner, started + config.SENDER_LEASE_WAIT_SECONDS)
+
+    waited = time.monotonic() - started
+    _record_wait(waited, acquired, contended)
+    if not acquired:
+        raise TimeoutError(f"Timed out waiting {waited:.1f}s for the lease of sender {sender}")
+    if contended:
+        print(f"Waited {waited:.2f}s for the lease of sender {sender}")
+
+    if config.SENDER_LEASE_BACKEND != 'local':
+        stopped = threading.Event()
+        renewer = threading.Thread(target=_keep_renewed, args=(sender, owner, stopped), daemon=True)
+        renewer.start()
+    try:
+        yield
+    finally:
+        if config.SENDER_LEASE_BACKEND == 'local':
+            lock.release()
+        else:
+            stopped.set()
+            renewer.join()
+            _release(sender, owner)
+
+def lease_stats():
+    """Return the lease metrics of this process.
+
+    `acquired` leases, of which `contended` had to wait for another holder, `timeouts`, and
+    the total, average and maximum seconds the contended ones waited.
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats['average_wait_seconds'] = stats['wait_seconds'] / stats['contended'] if stats['contended'] else 0.0
+    return stats
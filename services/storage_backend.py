@@ -0,0 +1,1000 @@
+"""
+Storage backends for the bot's DynamoDB tables.
+
+`get_resource()` returns the object the services read their tables from. With the default
+`STORAGE_BACKEND=dynamodb` it is the boto3 DynamoDB resource. boto3 resources are not thread
+safe, so services hold their tables as `table(name)`, which resolves to the table of the
+calling thread's resource, and worker threads run inside `thread_resource()`. `memory` and `sqlite` return a
+local resource that implements the part of the boto3 Table API the bot uses (get_item,
+put_item, update_item, delete_item, query, scan, batch_writer and batch_get_item) with the
+same semantics, including condition and update expressions, the global secondary indexes,
+filters, projections and LastEvaluatedKey pagination. They let the bot be benchmarked and
+load tested locally, without AWS.
+"""
+
+import copy
+import json
+import re
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from decimal import Decimal
+import boto3
+from botocore.config import Config
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer, DYNAMODB_CONTEXT
+from botocore.exceptions import ClientError
+import config
+
+# Key schema of every table: (partition key, sort key or None) and the same for each index
+TABLE_SCHEMAS = {
+    config.COUPONS_TABLE: {
+        'key': ('client_id', 'coupon_id'),
+        'indexes': {
+            'shared_with-index': ('shared_with', None),
+            'sharing_token-index': ('sharing_token', None),
+            'shared_with-coupon_id-index': ('shared_with', 'coupon_id'),
+            'client_id-active_expiry-index': ('client_id', 'active_expiry'),
+            'shared_with-active_expiry-index': ('shared_with', 'active_expiry'),
+        }
+    },
+    config.PAIRING_TABLE: {
+        'key': ('client_id', None),
+        'indexes': {'shared_with_client_id-index': ('shared_with_client_id', None)}
+    },
+    config.USER_STATE_TABLE: {
+        'key': ('client_id', None),
+        'indexes': {'api_key-index': ('api_key', None)}
+    },
+    config.COUPON_CODES_TABLE: {'key': ('code_key', None), 'indexes': {}},
+    config.COUPON_SUMMARY_TABLE: {'key': ('client_id', None), 'indexes': {}},
+    config.PROCESSED_MESSAGES_TABLE: {'key': ('message_id', None), 'indexes': {}},
+    config.SENDER_LEASES_TABLE: {'key': ('sender', None), 'indexes': {}},
+    config.EXTRACTION_CACHE_TABLE: {'key': ('cache_key', None), 'indexes': {}},
+}
+
+# BatchGetItem accepts up to 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+_MISSING = object()
+
+# Settings of every AWS client (DynamoDB, and SQS and Lambda in message_queue), shared by all
+# services and scripts
+CLIENT_CONFIG = Config(
+    connect_timeout=config.DYNAMODB_CONNECT_TIMEOUT,
+    read_timeout=config.DYNAMODB_READ_TIMEOUT,
+    retries={'mode': 'adaptive', 'max_attempts': config.DYNAMODB_MAX_RETRIES},
+    max_pool_connections=config.DYNAMODB_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True
+)
+
+_resource = None
+_resource_lock = threading.RLock()
+# Every DynamoDB resource created in this process, for connection_stats()
+_dynamodb_resources = []
+# Resources of finished thread_resource() blocks, reused by the next worker threads
+_idle_resources = []
+_thread_state = threading.local()
+_tables = {}
+
+
+def get_resource():
+    """Return the resource of the calling thread: its own inside thread_resource(), else the
+    process-wide resource of the configured backend."""
+    global _resource
+    resource = getattr(_thread_state, 'resource', None)
+    if resource is not None:
+        return resource
+    with _resource_lock:
+        if _resource is None:
+            _resource = new_resource()
+        return _resource
+
+@contextmanager
+def thread_resource():
+    """Give the calling thread a DynamoDB resource of its own for the duration of the block.
+
+    Worker threads wrap their work in this, so they never share a resource with the main
+    thread or each other. Resources are kept for the next block, so warm invocations reuse
+    their pooled connections. The local backends are safe to share and keep theirs.
+    """
+    if config.STORAGE_BACKEND != 'dynamodb' or getattr(_thread_state, 'resource', None) is not None:
+        yield get_resource()
+        return
+    with _resource_lock:
+        resource = _idle_resources.pop() if _idle_resources else None
+    if resource is None:
+        resource = new_resource()
+    _thread_state.resource = resource
+    try:
+        yield resource
+    finally:
+        _thread_state.resource = None
+        with _resource_lock:
+            _idle_resources.append(resource)
+
+class ThreadTable:
+    """A table that every call resolves on the calling thread's resource (see get_resource)."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        resource = get_resource()
+        key = (id(resource), self.name)
+        table = _tables.get(key)
+        if table is None:
+            table = _tables[key] = resource.Table(self.name)
+        return getattr(table, attribute)
+
+def table(name):
+    """Return the table of that name, safe to share between threads."""
+    return ThreadTable(name)
+
+def new_resource():
+    """Create a resource of the configured backend.
+
+    DynamoDB resources are not thread safe, so threads that need their own get a new one,
+    from a new session but with the same CLIENT_CONFIG. The local backends are safe to
+    share and always return the same store.
+    """
+    backend = config.STORAGE_BACKEND
+    if backend == 'dynamodb':
+        resource = boto3.session.Session().resource('dynamodb', config=CLIENT_CONFIG)
+        with _resource_lock:
+            _dynamodb_resources.append(resource)
+        return resource
+    if backend == 'memory':
+        return _local_resource('memory', MemoryStore)
+    if backend == 'sqlite':
+        return _local_resource('sqlite', lambda: SqliteStore(config.STORAGE_SQLITE_PATH))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def connection_stats():
+    """Report how well the DynamoDB clients reuse their pooled HTTP connections.
+
+    Returns the number of requests sent, of connections opened for them, and of requests
+    that went out on an already open (kept-alive) connection. The counts come from private
+    botocore and urllib3 attributes; when a version lays them out differently, or no
+    request was sent yet, it returns {} instead of raising.
+    """
+    requests = connections = 0
+    found = False
+    with _resource_lock:
+        resources = list(_dynamodb_resources)
+    try:
+        for resource in resources:
+            # botocore keeps its urllib3 PoolManager on the endpoint's HTTP session
+            endpoint = getattr(resource.meta.client, '_endpoint', None)
+            manager = getattr(getattr(endpoint, 'http_session', None), '_manager', None)
+            pools = getattr(manager, 'pools', None)
+            if pools is None:
+                continue
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                pool_requests = getattr(pool, 'num_requests', None)
+                pool_connections = getattr(pool, 'num_connections', None)
+                if not isinstance(pool_requests, int) or not isinstance(pool_connections, int):
+                    continue
+                requests += pool_requests
+                connections += pool_connections
+                found = True
+    except (AttributeError, TypeError, KeyError) as e:
+        print(f"Connection stats unavailable: {e}")
+        return {}
+    if not found:
+        return {}
+    return {'requests': requests, 'connections': connections, 'reused': max(requests - connections, 0)}
+
+_local_resources = {}
+
+def _local_resource(name, create_store):
+    with _resource_lock:
+        if name not in _local_resources:
+            _local_resources[name] = LocalResource(create_store())
+        return _local_resources[name]
+
+def reset_local_storage():
+    """Empty the local stores, e.g. between load test runs."""
+    for resource in _local_resources.values():
+        with resource.store.lock:
+            resource.store.clear()
+
+
+def _client_error(code, message, operation, item=None):
+    response = {'Error': {'Code': code, 'Message': message}}
+    if item is not None:
+        response['Item'] = {name: _serializer.serialize(value) for name, value in item.items()}
+    return ClientError(response, operation)
+
+def _validation_error(message, operation):
+    return _client_error('ValidationException', message, operation)
+
+def _clean(item):
+    """Convert values the way boto3 does on the wire: ints become Decimal, floats are rejected."""
+    return {name: _deserializer.deserialize(_serializer.serialize(value)) for name, value in item.items()}
+
+def _clean_value(value):
+    return _deserializer.deserialize(_serializer.serialize(value))
+
+
+# --- Expressions ------------------------------------------------------------------------
+
+_TOKEN_PATTERN = re.compile(r"\s*(?:(<>|<=|>=|[=<>(),.+\-\[\]])|(#[A-Za-z0-9_]+)|(:[A-Za-z0-9_]+)|([A-Za-z_][A-Za-z0-9_]*)|(\d+))")
+_COMPARATORS = {'=', '<>', '<', '<=', '>', '>='}
+_TYPE_NAMES = {str: 'S', Decimal: 'N', bytes: 'B', bool: 'BOOL', type(None): 'NULL',
+               dict: 'M', list: 'L'}
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN_PATTERN.match(expression, position)
+        if not match:
+            raise ValueError(f"Invalid expression near: {expression[position:]}")
+        operator, name, value, word, number = match.groups()
+        if operator:
+            tokens.append(('op', operator))
+        elif name:
+            tokens.append(('name', name))
+        elif value:
+            tokens.append(('value', value))
+        elif word:
+            tokens.append(('word', word))
+        else:
+            tokens.append(('number', int(number)))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive descent parser of the DynamoDB condition and update expression grammar."""
+
+    def __init__(self, expression, names, values):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, operator):
+        kind, text = self.next()
+        if kind != 'op' or text != operator:
+            raise ValueError(f"Expected '{operator}' in expression")
+
+    def keyword(self, *words):
+        kind, text = self.peek()
+        return kind == 'word' and text.upper() in words
+
+    def done(self):
+        return self.position >= len(self.tokens)
+
+    # Paths and operands evaluate to a function of the item
+    def path(self):
+        kind, text = self.next()
+        if kind == 'name':
+            if text not in self.names:
+                raise ValueError(f"Undefined attribute name: {text}")
+            parts = [self.names[text]]
+        elif kind == 'word':
+            parts = [text]
+        else:
+            raise ValueError("Expected an attribute path in expression")
+        while True:
+            kind, text = self.peek()
+            if kind == 'op' and text == '.':
+                self.next()
+                kind, text = self.next()
+                parts.append(self.names[text] if kind == 'name' else text)
+            elif kind == 'op' and text == '[':
+                self.next()
+                _, index = self.next()
+                self.expect(']')
+                parts.append(index)
+            else:
+                return tuple(parts)
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 'value':
+            self.next()
+            if text not in self.values:
+                raise ValueError(f"Undefined attribute value: {text}")
+            value = _clean_value(self.values[text])
+            return lambda item: value
+        if kind == 'word' and text.lower() == 'size' and self.peek(1) == ('op', '('):
+            self.next()
+            self.expect('(')
+            path = self.path()
+            self.expect(')')
+            return lambda item: _size(_resolve(item, path))
+        path = self.path()
+        return lambda item: _resolve(item, path)
+
+    # Conditions evaluate to a bool
+    def condition(self):
+        left = self.conjunction()
+        while self.keyword('OR'):
+            self.next()
+            right = self.conjunction()
+            left = (lambda a, b: lambda item: a(item) or b(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.keyword('AND'):
+            self.next()
+            right = self.negation()
+            left = (lambda a, b: lambda item: a(item) and b(item))(left, right)
+        return left
+
+    def negation(self):
+        if self.keyword('NOT'):
+            self.next()
+            inner = self.negation()
+            return lambda item: not inner(item)
+        return self.predicate()
+
+    def predicate(self):
+        kind, text = self.peek()
+        if kind == 'op' and text == '(':
+            self.next()
+            inner = self.condition()
+            self.expect(')')
+            return inner
+        if kind == 'word' and self.peek(1) == ('op', '(') and text.lower() != 'size':
+            return self.function()
+
+        left = self.operand()
+        if self.keyword('BETWEEN'):
+            self.next()
+            low = self.operand()
+            if not self.keyword('AND'):
+                raise ValueError("Expected AND in BETWEEN")
+            self.next()
+            high = self.operand()
+            return lambda item: _compare(left(item), '>=', low(item)) and _compare(left(item), '<=', high(item))
+        if self.keyword('IN'):
+            self.next()
+            self.expect('(')
+            options = [self.operand()]
+            while self.peek() == ('op', ','):
+                self.next()
+                options.append(self.operand())
+            self.expect(')')
+            return lambda item: any(_compare(left(item), '=', option(item)) for option in options)
+
+        kind, operator = self.next()
+        if kind != 'op' or operator not in _COMPARATORS:
+            raise ValueError("Expected a comparison in expression")
+        right = self.operand()
+        return lambda item: _compare(left(item), operator, right(item))
+
+    def function(self):
+        _, name = self.next()
+        name = name.lower()
+        self.expect('(')
+        path = self.path()
+        argument = None
+        if self.peek() == ('op', ','):
+            self.next()
+            argument = self.operand()
+        self.expect(')')
+
+        if name == 'attribute_exists':
+            return lambda item: _resolve(item, path) is not _MISSING
+        if name == 'attribute_not_exists':
+            return lambda item: _resolve(item, path) is _MISSING
+        if name == 'attribute_type':
+            return lambda item: _type_of(_resolve(item, path)) == argument(item)
+        if name == 'begins_with':
+            return lambda item: _begins_with(_resolve(item, path), argument(item))
+        if name == 'contains':
+            return lambda item: _contains(_resolve(item, path), argument(item))
+        raise ValueError(f"Unsupported function: {name}")
+
+    # Update expressions evaluate to a list of actions
+    def update(self):
+        actions = []
+        while not self.done():
+            kind, clause = self.next()
+            clause = clause.upper() if kind == 'word' else None
+            if clause not in ('SET', 'REMOVE', 'ADD', 'DELETE'):
+                raise ValueError("Expected SET, REMOVE, ADD or DELETE in update expression")
+            while True:
+                path = self.path()
+                if clause == 'SET':
+                    self.expect('=')
+                    actions.append(('SET', path, self.set_value()))
+                elif clause == 'REMOVE':
+                    actions.append(('REMOVE', path, None))
+                else:
+                    actions.append((clause, path, self.operand()))
+                if self.peek() != ('op', ','):
+                    break
+                self.next()
+        return actions
+
+    def set_value(self):
+        left = self.set_term()
+        kind, text = self.peek()
+        if kind == 'op' and text in ('+', '-'):
+            self.next()
+            right = self.set_term()
+            sign = 1 if text == '+' else -1
+            return lambda item: _arithmetic(left(item), right(item), sign)
+        return left
+
+    def set_term(self):
+        kind, text = self.peek()
+        if kind == 'word' and self.peek(1) == ('op', '('):
+            name = text.lower()
+            self.next()
+            self.expect('(')
+            if name == 'if_not_exists':
+                path = self.path()
+                self.expect(',')
+                default = self.set_term()
+                self.expect(')')
+                return lambda item: _first_present(_resolve(item, path), default, item)
+            if name == 'list_append':
+                first = self.set_term()
+                self.expect(',')
+                second = self.set_term()
+                self.expect(')')
+                return lambda item: list(first(item)) + list(second(item))
+            raise ValueError(f"Unsupported function: {name}")
+        return self.operand()
+
+
+def _resolve(item, path):
+    value = item
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(value, list) or part >= len(value):
+                return _MISSING
+            value = value[part]
+        else:
+            if not isinstance(value, dict) or part not in value:
+                return _MISSING
+            value = value[part]
+    return value
+
+def _type_of(value):
+    if isinstance(value, set):
+        sample = next(iter(value), '')
+        return {str: 'SS', Decimal: 'NS'}.get(type(sample), 'BS')
+    return _TYPE_NAMES.get(type(value))
+
+def _size(value):
+    if value is _MISSING or isinstance(value, (Decimal, bool)) or value is None:
+        return _MISSING
+    return Decimal(len(value))
+
+def _compare(left, operator, right):
+    if left is _MISSING or right is _MISSING:
+        # a missing attribute is only "not equal" to something
+        return operator == '<>'
+    if _type_of(left) != _type_of(right):
+        return operator == '<>'
+    if operator == '=':
+        return left == right
+    if operator == '<>':
+        return left != right
+    if not isinstance(left, (str, Decimal, bytes)):
+        return False
+    return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+
+def _begins_with(value, prefix):
+    return isinstance(value, (str, bytes)) and type(value) is type(prefix) and value.startswith(prefix)
+
+def _contains(value, element):
+    if isinstance(value, str):
+        return isinstance(element, str) and element in value
+    if isinstance(value, (set, list)):
+        return element in value
+    return False
+
+def _first_present(value, default, item):
+    return default(item) if value is _MISSING else value
+
+def _arithmetic(left, right, sign):
+    if not isinstance(left, Decimal) or not isinstance(right, Decimal):
+        raise ValueError("An operand in the update expression has an incorrect data type")
+    return DYNAMODB_CONTEXT.add(left, right) if sign > 0 else DYNAMODB_CONTEXT.subtract(left, right)
+
+def _expression(expression, names, values, is_key_condition=False):
+    """Render a boto3 Key/Attr condition to its expression string, as boto3 does before sending it."""
+    if isinstance(expression, ConditionBase):
+        built = ConditionExpressionBuilder().build_expression(expression, is_key_condition=is_key_condition)
+        expression = built.condition_expression
+        names = dict(names or {}, **built.attribute_name_placeholders)
+        values = dict(values or {}, **built.attribute_value_placeholders)
+    return expression, names or {}, values or {}
+
+def _condition(expression, names, values, is_key_condition=False):
+    """Compile a condition given as a string or a boto3 Key/Attr condition into a predicate."""
+    parser = _Parser(*_expression(expression, names, values, is_key_condition))
+    predicate = parser.condition()
+    if not parser.done():
+        raise ValueError("Unexpected text at the end of the expression")
+    return predicate
+
+def _key_condition(expression, names, values, hash_name, range_name):
+    """Compile a key condition and return it with the partition key value it requires."""
+    expression, names, values = _expression(expression, names, values, is_key_condition=True)
+    tokens = _tokenize(expression)
+    attributes = {names.get(text, text) for kind, text in tokens
+                  if kind == 'name' or (kind == 'word' and text.upper() not in ('AND', 'BETWEEN', 'BEGINS_WITH'))}
+    if hash_name not in attributes or not attributes <= {hash_name, range_name}:
+        raise ValueError('Query condition missed key schema element')
+
+    hash_value = _MISSING
+    for position in range(len(tokens) - 2):
+        (kind, text), operator, (value_kind, value) = tokens[position:position + 3]
+        if operator == ('op', '=') and value_kind == 'value' and names.get(text, text) == hash_name:
+            hash_value = _clean_value(values[value])
+    if hash_value is _MISSING:
+        raise ValueError('Query key condition not supported')
+    return _condition(expression, names, values), hash_value
+
+def _projection(expression, names):
+    if not expression:
+        return None
+    paths = []
+    parser = _Parser(expression, names, {})
+    while not parser.done():
+        paths.append(parser.path())
+        if parser.peek() == ('op', ','):
+            parser.next()
+    return paths
+
+def _project(item, paths):
+    if paths is None:
+        return item
+    projected = {}
+    for path in paths:
+        value = _resolve(item, path)
+        if value is _MISSING:
+            continue
+        target = projected
+        for part in path[:-1]:
+            target = target.setdefault(part, {})
+        target[path[-1]] = value
+    return projected
+
+def _set_path(item, path, value):
+    target = item
+    for part in path[:-1]:
+        target = target[part]
+    target[path[-1]] = value
+
+def _remove_path(item, path):
+    target = _resolve(item, path[:-1]) if len(path) > 1 else item
+    if isinstance(target, dict):
+        target.pop(path[-1], None)
+    elif isinstance(target, list) and path[-1] < len(target):
+        del target[path[-1]]
+
+
+# --- Local tables -----------------------------------------------------------------------
+
+def _sort_value(value):
+    # keys are strings or numbers within one attribute, so they order among themselves
+    return '' if value is _MISSING or value is None else value
+
+def _is_key_value(value):
+    return isinstance(value, (str, Decimal, bytes)) and value != ''
+
+def _in_index(item, hash_name, range_name):
+    """Whether an item appears in an index: like DynamoDB's sparse indexes, only items that
+    have every key attribute of the index are indexed."""
+    return hash_name in item and (range_name is None or range_name in item)
+
+class LocalTable:
+    """A table of a local store, exposing the boto3 Table methods the bot calls."""
+
+    def __init__(self, resource, name):
+        self.resource = resource
+        self.store = resource.store
+        self.name = self.table_name = name
+        self.schema = TABLE_SCHEMAS.get(name)
+
+    def _check_table(self, operation):
+        if self.schema is None:
+            raise _client_error('ResourceNotFoundException', 'Requested resource not found', operation)
+
+    def _key_of(self, item, operation):
+        hash_name, range_name = self.schema['key']
+        key = []
+        for name in (hash_name, range_name):
+            if name is None:
+                continue
+            value = item.get(name, _MISSING)
+            if not _is_key_value(value):
+                raise _validation_error(
+                    'One or more parameter values were invalid: Missing the key ' + name + ' in the item', operation)
+            key.append(value)
+        return tuple(key)
+
+    def _check_key(self, key, operation):
+        if set(key) != {name for name in self.schema['key'] if name}:
+            raise _validation_error('The provided key element does not match the schema', operation)
+        return self._key_of(_clean(key), operation)
+
+    def _index_entries(self, item, operation):
+        entries = []
+        for index_name, (hash_name, range_name) in self.schema['indexes'].items():
+            if not _in_index(item, hash_name, range_name):
+                continue
+            # DynamoDB rejects the write of an index key that is present but None or empty
+            for name in (hash_name, range_name):
+                if name is not None and not _is_key_value(item[name]):
+                    raise _validation_error(
+                        'One or more parameter values were invalid: Type mismatch for Index Key ' + name +
+                        ' IndexName: ' + index_name, operation)
+            entries.append((index_name, item[hash_name]))
+        return entries
+
+    def _write(self, key, item, operation):
+        self.store.put(self.name, key, item, self._index_entries(item, operation))
+
+    @staticmethod
+    def _check_condition(kwargs, old, operation):
+        expression = kwargs.get('ConditionExpression')
+        if expression is None:
+            return
+        try:
+            predicate = _condition(expression, kwargs.get('ExpressionAttributeNames'),
+                                   kwargs.get('ExpressionAttributeValues'))
+        except ValueError as e:
+            raise _validation_error(str(e), operation)
+        if not predicate(old or {}):
+            item = old if old and kwargs.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' else None
+            raise _client_error('ConditionalCheckFailedException', 'The conditional request failed', operation, item)
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False):
+        self._check_table('GetItem')
+        key = self._check_key(Key, 'GetItem')
+        with self.store.lock:
+            item = self.store.get(self.name, key)
+        if item is None:
+            return {}
+        return {'Item': _project(item, _projection(ProjectionExpression, ExpressionAttributeNames))}
+
+    def put_item(self, Item, ReturnValues='NONE', **kwargs):
+        self._check_table('PutItem')
+        item = _clean(Item)
+        key = self._key_of(item, 'PutItem')
+        with self.store.lock:
+            old = self.store.get(self.name, key)
+            self._check_condition(kwargs, old, 'PutItem')
+            self._write(key, item, 'PutItem')
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def delete_item(self, Key, ReturnValues='NONE', **kwargs):
+        self._check_table('DeleteItem')
+        key = self._check_key(Key, 'DeleteItem')
+        with self.store.lock:
+            old = self.store.get(self.name, key)
+            self._check_condition(kwargs, old, 'DeleteItem')
+            if old is not None:
+                self.store.delete(self.name, key)
+        return {'Attributes': old} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def update_item(self, Key, UpdateExpression=None, ReturnValues='NONE', **kwargs):
+        self._check_table('UpdateItem')
+        key = self._check_key(Key, 'UpdateItem')
+        names = kwargs.get('ExpressionAttributeNames')
+        values = kwargs.get('ExpressionAttributeValues')
+        try:
+            actions = _Parser(UpdateExpression, names, values).update() if UpdateExpression else []
+        except ValueError as e:
+            raise _validation_error(str(e), 'UpdateItem')
+        key_names = {name for name in self.schema['key'] if name}
+        if any(path[0] in key_names for _, path, _ in actions):
+            raise _validation_error('Cannot update attribute in the key', 'UpdateItem')
+
+        with self.store.lock:
+            old = self.store.get(self.name, key)
+            self._check_condition(kwargs, old, 'UpdateItem')
+            new = copy.deepcopy(old) if old is not None else _clean(Key)
+            try:
+                # every operand refers to the item as it was before the update
+                changes = [(action, path, evaluate(old or {}) if evaluate else None)
+                           for action, path, evaluate in actions]
+                for action, path, value in changes:
+                    self._apply(new, action, path, value)
+            except (ValueError, KeyError, TypeError) as e:
+                raise _validation_error(str(e), 'UpdateItem')
+            self._write(key, new, 'UpdateItem')
+
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': new}
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': old} if old else {}
+        if ReturnValues in ('UPDATED_NEW', 'UPDATED_OLD'):
+            source = new if ReturnValues == 'UPDATED_NEW' else (old or {})
+            updated = {path[0] for _, path, _ in actions}
+            return {'Attributes': {name: source[name] for name in updated if name in source}}
+        return {}
+
+    @staticmethod
+    def _apply(item, action, path, value):
+        current = _resolve(item, path)
+        if action == 'SET':
+            _set_path(item, path, value)
+        elif action == 'REMOVE':
+            _remove_path(item, path)
+        elif action == 'ADD':
+            if current is _MISSING:
+                _set_path(item, path, value)
+            elif isinstance(current, set):
+                _set_path(item, path, current | value)
+            else:
+                _set_path(item, path, _arithmetic(current, value, 1))
+        elif action == 'DELETE' and isinstance(current, set):
+            remaining = current - value
+            if remaining:
+                _set_path(item, path, remaining)
+            else:
+                _remove_path(item, path)
+
+    def _ordered(self, items, index_name, descending=False):
+        hash_name, range_name = self.schema['key']
+        if index_name:
+            index_range = self.schema['indexes'][index_name][1]
+            order = lambda item: (_sort_value(item.get(index_range, _MISSING)) if index_range else '',
+                                  item[hash_name], _sort_value(item.get(range_name, _MISSING)))
+        else:
+            order = lambda item: (_sort_value(item.get(range_name, _MISSING)),)
+        return sorted(items, key=order, reverse=descending), order
+
+    def _last_key(self, item, index_name):
+        names = [name for name in self.schema['key'] if name]
+        if index_name:
+            names += [name for name in self.schema['indexes'][index_name] if name]
+        return {name: item[name] for name in names}
+
+    def _page(self, items, order, operation, kwargs, descending=False):
+        """Apply ExclusiveStartKey, Limit, FilterExpression and ProjectionExpression to ordered items."""
+        names = kwargs.get('ExpressionAttributeNames')
+        start_key = kwargs.get('ExclusiveStartKey')
+        if start_key:
+            start = order(_clean(start_key))
+            items = [item for item in items if (order(item) < start if descending else order(item) > start)]
+
+        limit = kwargs.get('Limit')
+        if limit is not None and limit < 1:
+            raise _validation_error('Limit must be greater than or equal to 1', operation)
+        evaluated = items[:limit] if limit else items
+        try:
+            predicate = _condition(kwargs['FilterExpression'], names, kwargs.get('ExpressionAttributeValues')) \
+                if kwargs.get('FilterExpression') is not None else None
+            paths = _projection(kwargs.get('ProjectionExpression'), names)
+        except ValueError as e:
+            raise _validation_error(str(e), operation)
+        matched = [item for item in evaluated if predicate is None or predicate(item)]
+
+        response = {'Count': len(matched), 'ScannedCount': len(evaluated)}
+        if kwargs.get('Select') != 'COUNT':
+            response['Items'] = [_project(item, paths) for item in matched]
+        # like DynamoDB, a page that stopped at Limit returns a key even if nothing follows
+        if limit and len(evaluated) == limit:
+            response['LastEvaluatedKey'] = self._last_key(evaluated[-1], kwargs.get('IndexName'))
+        return response
+
+    def query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, **kwargs):
+        self._check_table('Query')
+        if IndexName and IndexName not in self.schema['indexes']:
+            raise _validation_error('The table does not have the specified index: ' + IndexName, 'Query')
+        hash_name, range_name = self.schema['indexes'][IndexName] if IndexName else self.schema['key']
+        try:
+            predicate, hash_value = _key_condition(
+                KeyConditionExpression, kwargs.get('ExpressionAttributeNames'),
+                kwargs.get('ExpressionAttributeValues'), hash_name, range_name)
+        except (ValueError, KeyError) as e:
+            raise _validation_error(str(e), 'Query')
+
+        with self.store.lock:
+            candidates = [item for item in self.store.partition_items(self.name, IndexName, hash_value)
+                          if predicate(item)]
+        items, order = self._ordered(candidates, IndexName, descending=not ScanIndexForward)
+        return self._page(items, order, 'Query', dict(kwargs, IndexName=IndexName),
+                          descending=not ScanIndexForward)
+
+    def scan(self, IndexName=None, Segment=None, TotalSegments=None, **kwargs):
+        self._check_table('Scan')
+        with self.store.lock:
+            items = self.store.all_items(self.name)
+        if IndexName:
+            index_hash, index_range = self.schema['indexes'][IndexName]
+            items = [item for item in items if _in_index(item, index_hash, index_range)]
+        if TotalSegments:
+            hash_name = self.schema['key'][0]
+            items = [item for item in items
+                     if zlib.crc32(str(item[hash_name]).encode()) % TotalSegments == Segment]
+        hash_name, range_name = self.schema['key']
+        order = lambda item: (str(item[hash_name]), _sort_value(item.get(range_name, _MISSING)))
+        return self._page(sorted(items, key=order), order, 'Scan', dict(kwargs, IndexName=IndexName))
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _LocalBatchWriter(self)
+
+
+class _LocalBatchWriter:
+    """Applies the writes right away; the end state matches boto3's buffered batch writer."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class LocalResource:
+    """Local stand-in for the boto3 DynamoDB resource."""
+
+    def __init__(self, store):
+        self.store = store
+        self._tables = {}
+
+    def Table(self, name):
+        if name not in self._tables:
+            self._tables[name] = LocalTable(self, name)
+        return self._tables[name]
+
+    def batch_get_item(self, RequestItems):
+        if sum(len(request['Keys']) for request in RequestItems.values()) > BATCH_GET_MAX_KEYS:
+            raise _validation_error('Too many items requested for the BatchGetItem call', 'BatchGetItem')
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            params = {key: request[key] for key in ('ProjectionExpression', 'ExpressionAttributeNames') if key in request}
+            responses[name] = [response['Item'] for response in
+                               (table.get_item(Key=key, **params) for key in request['Keys']) if 'Item' in response]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+# --- Stores -----------------------------------------------------------------------------
+
+class MemoryStore:
+    """Keeps every table in process memory, with a partition map per table and index."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.partitions = {}
+        self.entries = {}
+
+    def get(self, table_name, key):
+        item = self.items.get(table_name, {}).get(key)
+        return copy.deepcopy(item) if item is not None else None
+
+    def put(self, table_name, key, item, index_entries):
+        self.delete(table_name, key)
+        self.items.setdefault(table_name, {})[key] = copy.deepcopy(item)
+        entries = [(None, key[0])] + index_entries
+        self.entries[(table_name, key)] = entries
+        for index_name, hash_value in entries:
+            self.partitions.setdefault((table_name, index_name), {}).setdefault(hash_value, set()).add(key)
+
+    def delete(self, table_name, key):
+        for index_name, hash_value in self.entries.pop((table_name, key), []):
+            self.partitions[(table_name, index_name)][hash_value].discard(key)
+        self.items.get(table_name, {}).pop(key, None)
+
+    def partition_items(self, table_name, index_name, hash_value):
+        keys = self.partitions.get((table_name, index_name), {}).get(hash_value, ())
+        table_items = self.items.get(table_name, {})
+        return [copy.deepcopy(table_items[key]) for key in keys]
+
+    def all_items(self, table_name):
+        return [copy.deepcopy(item) for item in self.items.get(table_name, {}).values()]
+
+    def clear(self):
+        self.items.clear()
+        self.partitions.clear()
+        self.entries.clear()
+
+
+class SqliteStore:
+    """Keeps every table in a SQLite file, with one row per item and one per index entry."""
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                table_name TEXT NOT NULL, item_key TEXT NOT NULL, hash_key TEXT NOT NULL, item TEXT NOT NULL,
+                PRIMARY KEY (table_name, item_key));
+            CREATE TABLE IF NOT EXISTS index_entries (
+                table_name TEXT NOT NULL, index_name TEXT NOT NULL, hash_key TEXT NOT NULL, item_key TEXT NOT NULL,
+                PRIMARY KEY (table_name, index_name, hash_key, item_key));
+            CREATE INDEX IF NOT EXISTS items_by_partition ON items (table_name, hash_key);
+            CREATE INDEX IF NOT EXISTS index_entries_by_item ON index_entries (table_name, item_key);
+        """)
+
+    @staticmethod
+    def _encode_value(value):
+        return json.dumps(_serializer.serialize(value), sort_keys=True)
+
+    @staticmethod
+    def _encode_item(item):
+        return json.dumps({name: _serializer.serialize(value) for name, value in item.items()})
+
+    @staticmethod
+    def _decode_item(text):
+        return {name: _deserializer.deserialize(value) for name, value in json.loads(text).items()}
+
+    def _encode_key(self, key):
+        return json.dumps([_serializer.serialize(value) for value in key], sort_keys=True)
+
+    def get(self, table_name, key):
+        row = self.connection.execute(
+            "SELECT item FROM items WHERE table_name = ? AND item_key = ?",
+            (table_name, self._encode_key(key))).fetchone()
+        return self._decode_item(row[0]) if row else None
+
+    def put(self, table_name, key, item, index_entries):
+        item_key = self._encode_key(key)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO items (table_name, item_key, hash_key, item) VALUES (?, ?, ?, ?)",
+                (table_name, item_key, self._encode_value(key[0]), self._encode_item(item)))
+            self.connection.execute(
+                "DELETE FROM index_entries WHERE table_name = ? AND item_key = ?", (table_name, item_key))
+            self.connection.executemany(
+                "INSERT INTO index_entries (table_name, index_name, hash_key, item_key) VALUES (?, ?, ?, ?)",
+                [(table_name, index_name, self._encode_value(hash_value), item_key)
+                 for index_name, hash_value in index_entries])
+
+    def delete(self, table_name, key):
+        item_key = self._encode_key(key)
+        with self.connection:
+            self.connection.execute("DELETE FROM items WHERE table_name = ? AND item_key = ?", (table_name, item_key))
+            self.connection.execute(
+                "DELETE FROM index_entries WHERE table_name = ? AND item_key = ?", (table_name, item_key))
+
+    def partition_items(self, table_name, index_name, hash_value):
+        hash_key = self._encode_value(hash_value)
+        if index_name is None:
+            rows = self.connection.execute(
+                "SELECT item FROM items WHERE table_name = ? AND hash_key = ?", (table_name, hash_key))
+        else:
+            rows = self.connection.execute(
+                "SELECT items.item FROM index_entries JOIN items USING (table_name, item_key) "
+                "WHERE index_entries.index_name = ? AND index_entries.table_name = ? AND index_entries.hash_key = ?",
+                (index_name, table_name, hash_key))
+        return [self._decode_item(item) for (item,) in rows.fetchall()]
+
+    def all_items(self, table_name):
+        rows = self.connection.execute("SELECT item FROM items WHERE table_name = ?", (table_name,))
+        return [self._decode_item(item) for (item,) in rows.fetchall()]
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM items")
+            self.connection.execute("DELETE FROM index_entries")
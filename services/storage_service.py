@@ -1,38 +1,168 @@
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
 from datetime import datetime, timedelta
 import uuid
 import re
+import json
+import base64
+import copy
+import itertools
+import threading
+from contextlib import contextmanager
 from decimal import Decimal, InvalidOperation
 import config
+import utils.date_utils as date_utils
+from utils.money import parse_amount, parse_amounts
+import services.storage_backend as storage_backend
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(config.COUPONS_TABLE)
-pairing_table = dynamodb.Table(config.PAIRING_TABLE)
-user_state_table = dynamodb.Table(config.USER_STATE_TABLE)
+table = storage_backend.table(config.COUPONS_TABLE)
+pairing_table = storage_backend.table(config.PAIRING_TABLE)
+user_state_table = storage_backend.table(config.USER_STATE_TABLE)
+coupon_codes_table = storage_backend.table(config.COUPON_CODES_TABLE)
+summary_table = storage_backend.table(config.COUPON_SUMMARY_TABLE)
 
+# Key attributes used to build resumable cursors for the coupon list queries
+USER_COUPONS_KEY = ('client_id', 'coupon_id')
+SHARED_COUPONS_KEY = ('shared_with', 'client_id', 'coupon_id')
+ACTIVE_USER_COUPONS_KEY = USER_COUPONS_KEY + ('active_expiry',)
+ACTIVE_SHARED_COUPONS_KEY = SHARED_COUPONS_KEY + ('active_expiry',)
+CURSOR_KEY_NAMES = set(ACTIVE_USER_COUPONS_KEY + ACTIVE_SHARED_COUPONS_KEY)
 
-def parse_amount(value):
-    """Extract a numeric amount from free-form value strings like '100₪', '$50', or '100.5 ש"ח'."""
-    if value is None:
-        return None
+# Sort key of unused coupons without an expiration date, after every real date
+NO_EXPIRY = "9999-12-31"
 
-    if isinstance(value, (int, float, Decimal)):
-        return float(value)
+# Attributes read by list queries per view; None reads whole items
+LIST_ATTRIBUTES = (
+    'client_id', 'coupon_id', 'store', 'coupon_code', 'value', 'discount_value', 'category',
+    'expiration_date', 'expires_on', 'coupon_status', 'used', 'value_amount', 'remaining_amount',
+    'shared_with', 'active_expiry'
+)
+PROJECTION_PROFILES = {
+    'list': LIST_ATTRIBUTES,
+    'search': LIST_ATTRIBUTES + ('terms', 'misc'),
+    'detail': LIST_ATTRIBUTES + ('terms', 'misc', 'url', 'msg_id', 'timestamp', 'used_timestamp'),
+    'export': None
+}
 
-    # Remove currency symbols and common Hebrew currency strings to isolate the number
-    text = str(value).strip().replace(",", ".")
-    text = text.replace("₪", "").replace("$", "").replace("ש\"ח", "").replace("שח", "")
-    
-    # Match first floating point number
-    match = re.search(r"-?\d+(?:\.\d+)?", text)
-    if not match:
-        return None
+# BatchGetItem accepts up to 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+
+# Default of set_user_state, meaning the previous state is not checked
+_ANY_STATE = object()
+
+# Deserializes the low-level item returned by ReturnValuesOnConditionCheckFailure
+_deserializer = TypeDeserializer()
+
+# Request-scoped read cache, active between begin_request() and end_request(). It is
+# per thread, so messages handled in parallel each see only their own reads
+_request_state = threading.local()
+_MISSING = object()
 
+
+def _request_cache():
+    return getattr(_request_state, 'cache', None)
+
+def begin_request():
+    """Start a unit of work: repeated reads until end_request() are served from memory."""
+    _request_state.cache = {}
+
+def end_request():
+    """Drop the request-scoped cache."""
+    _request_state.cache = None
+
+@contextmanager
+def request_scope():
+    """Context manager wrapping begin_request()/end_request() around one unit of work.
+
+    Scopes may nest; the enclosing scope's cache is restored when the inner one ends.
+    """
+    outer = _request_cache()
+    begin_request()
     try:
-        return float(match.group())
-    except ValueError:
-        return None
+        yield
+    finally:
+        _request_state.cache = outer
+
+def _detached(key, value):
+    # query entries are the cache's own page lists, extended while they are replayed
+    if key[0] == 'query' or not isinstance(value, (dict, list)):
+        return value
+    return copy.deepcopy(value)
+
+def cache_get(key):
+    """Return a copy of a cached value, or _MISSING when the key was not read in this request.
+
+    Callers get their own copy, so a write later in the request never changes a value
+    they already read, and changing it never changes the cache.
+    """
+    cache = _request_cache()
+    if cache is None:
+        return _MISSING
+    value = cache.get(key, _MISSING)
+    return value if value is _MISSING else _detached(key, value)
+
+def cache_put(key, value):
+    """Remember a copy of a value for the rest of the request and return the value."""
+    cache = _request_cache()
+    if cache is not None:
+        cache[key] = _detached(key, value)
+    return value
+
+def cache_drop(kind):
+    """Forget every cached entry of one kind, e.g. after a write that changes query results."""
+    cache = _request_cache()
+    if cache is not None:
+        for key in [key for key in cache if key[0] == kind]:
+            del cache[key]
+
+def cache_coupon(item):
+    """Replace the cached copy of a written coupon with its new image and return the item.
+
+    Objects callers read earlier in the request keep the previous image.
+    """
+    cache = _request_cache()
+    if cache is None or not item:
+        return item
+    cache_put(('coupon', item['client_id'], item['coupon_id']), item)
+    # list results and failed lookups may have changed with this write
+    cache_drop('query')
+    cache_drop('lookup')
+    return item
+
+def forget_coupon(client_id, coupon_id):
+    """Drop a coupon from the request cache after a write whose new image was not returned."""
+    cache = _request_cache()
+    if cache is not None:
+        cache.pop(('coupon', client_id, coupon_id), None)
+        cache_drop('query')
+        cache_drop('lookup')
+
+def get_coupon_item(client_id, coupon_id):
+    """GetItem a coupon by its primary key, memoized for the current request."""
+    key = ('coupon', client_id, coupon_id)
+    cached = cache_get(key)
+    if cached is not _MISSING:
+        return cached
+    item = table.get_item(Key={'client_id': client_id, 'coupon_id': coupon_id}).get('Item')
+    return cache_put(key, item)
+
+def get_pairing(client_id):
+    """GetItem the pairing row of a user, memoized for the current request."""
+    key = ('pairing', client_id)
+    cached = cache_get(key)
+    if cached is not _MISSING:
+        return cached
+    return cache_put(key, pairing_table.get_item(Key={'client_id': client_id}).get("Item"))
+
+def update_coupon_item(client_id, coupon_id, **update_params):
+    """UpdateItem a coupon and apply the returned item to the request cache."""
+    response = table.update_item(
+        Key={'client_id': client_id, 'coupon_id': coupon_id},
+        ReturnValues='ALL_NEW',
+        **update_params
+    )
+    return cache_coupon(response.get('Attributes'))
 
 
 def to_decimal(value, default=Decimal('0')):
@@ -58,9 +188,108 @@ def to_decimal(value, default=Decimal('0')):
     except (InvalidOperation, ValueError):
         return default
 
-def store_new_coupon(client_id, coupon_id, msg_id, coupon_data):
-    """Store a new coupon in the database and share it with paired users if applicable."""
-    item = {
+def amount_fields(value, used=0):
+    """Numeric value_amount/remaining_amount attributes of a coupon, or {} when its value is not numeric.
+
+    The usage writes clamp against remaining_amount in their condition, since DynamoDB
+    conditions cannot compute value - used themselves. remaining_amount is only
+    meaningful on coupons that have a value_amount.
+    """
+    value_amount = parse_amount(value)
+    if value_amount is None:
+        return {}
+    used_amount = parse_amount(used) or 0.0
+    return {
+        'value_amount': to_decimal(value_amount),
+        'remaining_amount': to_decimal(max(value_amount - used_amount, 0.0))
+    }
+
+def coupon_amounts(coupon):
+    """Return the (used, value, remaining) amounts of a coupon as floats.
+
+    Uses the numeric attributes stored at write time, falling back to parsing the value
+    string for coupons saved before they existed. value and remaining are None when the
+    coupon has no numeric value.
+    """
+    return coupons_amounts([coupon])[0]
+
+def coupons_amounts(coupons):
+    """coupon_amounts of a whole list, parsing each distinct used and value string once."""
+    used_amounts = parse_amounts([coupon.get('used') for coupon in coupons])
+    value_amounts = parse_amounts([coupon.get('value') if coupon.get('value_amount') is None else None
+                                   for coupon in coupons])
+    return [_amounts_of(coupon, used or 0.0, value_amount)
+            for coupon, used, value_amount in zip(coupons, used_amounts, value_amounts)]
+
+def _amounts_of(coupon, used, parsed_value):
+    if coupon.get('value_amount') is not None:
+        value_amount = float(coupon['value_amount'])
+        remaining = coupon.get('remaining_amount')
+        remaining = float(remaining) if remaining is not None else max(value_amount - used, 0.0)
+        return used, value_amount, remaining
+
+    if parsed_value is None:
+        return used, None, None
+    return used, parsed_value, max(parsed_value - used, 0.0)
+
+def active_expiry_of(expiration_date, reference=None):
+    """The `active_expiry` sort key of an unused coupon: its normalized expiry date.
+
+    Only unused coupons carry `active_expiry`, so the sparse active indexes never hold
+    used or canceled ones and active listings read just the coupons they return.
+    `reference` is the date relative periods count from, as in expiry_fields.
+    """
+    return date_utils.normalize_expiration_date(expiration_date, reference) or NO_EXPIRY
+
+def expiry_fields(expiration_date, reference=None):
+    """The canonical `expires_on` attribute of a coupon, or {} when its expiration date is unknown."""
+    expires_on = date_utils.normalize_expiration_date(expiration_date, reference)
+    return {'expires_on': expires_on} if expires_on else {}
+
+def saved_on(coupon):
+    """The date a coupon was saved, which relative expiry periods count from."""
+    try:
+        return datetime.fromisoformat(coupon.get('timestamp') or '').date()
+    except ValueError:
+        return None
+
+def normalize_coupon_code(coupon_code):
+    """Normalize a coupon code so the same code written with different spacing or case matches."""
+    if coupon_code is None:
+        return None
+    code = re.sub(r"[\s\-]", "", str(coupon_code)).upper()
+    return code or None
+
+def coupon_code_key(client_id, coupon_code):
+    """Build the `client_id#CODE` key of the coupon code lookup table."""
+    code = normalize_coupon_code(coupon_code)
+    if not code:
+        return None
+    return f"{client_id}#{code}"
+
+def index_coupon_code(client_id, coupon_id, coupon_code):
+    """Point the lookup item of a coupon code at the given coupon."""
+    code_key = coupon_code_key(client_id, coupon_code)
+    if code_key:
+        coupon_codes_table.put_item(Item={'code_key': code_key, 'client_id': client_id, 'coupon_id': coupon_id})
+
+def unindex_coupon_code(client_id, coupon_id, coupon_code):
+    """Remove the lookup item of a coupon code, unless it already points at another coupon."""
+    code_key = coupon_code_key(client_id, coupon_code)
+    if not code_key:
+        return
+    try:
+        coupon_codes_table.delete_item(
+            Key={'code_key': code_key},
+            ConditionExpression=Attr('coupon_id').eq(coupon_id)
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def build_coupon_item(client_id, coupon_id, msg_id, coupon_data):
+    """Build the DynamoDB item of a newly parsed coupon."""
+    return {
         'client_id': client_id,
         'coupon_id': coupon_id,
         'msg_id': msg_id,
@@ -74,27 +303,65 @@ def store_new_coupon(client_id, coupon_id, msg_id, coupon_data):
         'category': coupon_data.get('category'),
         'misc': coupon_data.get('misc'),
         'coupon_status': 'unused',
+        'active_expiry': active_expiry_of(coupon_data.get('expiration_date')),
         'used': 0,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now().isoformat(),
+        **expiry_fields(coupon_data.get('expiration_date')),
+        **amount_fields(coupon_data.get('value'))
     }
 
+def store_new_coupon(client_id, coupon_id, msg_id, coupon_data):
+    """Store a new coupon in the database. Paired users see it through the pairing itself."""
+    item = build_coupon_item(client_id, coupon_id, msg_id, coupon_data)
+
     table.put_item(Item=item)
+    cache_coupon(item)
+    index_coupon_code(client_id, coupon_id, item['coupon_code'])
+    update_summary(None, item)
 
-    # check if the user has a pairing
-    pairing_partner = pairing_table.get_item(Key={'client_id': client_id}).get("Item")
-    if (pairing_partner is not None):
-        # share the coupon with the partner
-        share_coupon_with_user(client_id, coupon_id, pairing_partner.get("shared_with_client_id"))
+def store_new_coupons(client_id, coupons, msg_id=None):
+    """Store several new coupons with batch writes.
+
+    Every coupon dict gets its new `coupon_id` and `client_id` assigned in place.
+    """
+    if not coupons:
+        return
+
+    deltas = {}
+    with table.batch_writer() as coupons_batch, \
+            coupon_codes_table.batch_writer(overwrite_by_pkeys=['code_key']) as codes_batch:
+        for coupon in coupons:
+            coupon_id = str(uuid.uuid4())
+            item = build_coupon_item(client_id, coupon_id, msg_id, coupon)
+            coupons_batch.put_item(Item=item)
+            cache_coupon(item)
+            summary_deltas(None, item, deltas)
+
+            code_key = coupon_code_key(client_id, item['coupon_code'])
+            if code_key:
+                codes_batch.put_item(Item={'code_key': code_key, 'client_id': client_id, 'coupon_id': coupon_id})
+
+            coupon['coupon_id'] = coupon_id
+            coupon['client_id'] = client_id
+
+    apply_summary_deltas(deltas)
+    print("Coupons stored:", client_id, [coupon['coupon_id'] for coupon in coupons])
 
 def update_coupon_details(coupon_data, updated_fields):
-    """Update specific fields of a coupon."""
+    """Update specific fields of a coupon.
+
+    `coupon_data` is refreshed with the stored coupon, including the fields derived from the
+    update (`expires_on`, `active_expiry`, `value_amount`, `remaining_amount`), and returned.
+    """
     if not updated_fields:
         print("No fields to update.")
-        return
+        return coupon_data
 
     update_expressions = []
     expression_attribute_values = {}
     expression_attribute_names = {}
+    previous_code = coupon_data.get('coupon_code')
+    previous_coupon = dict(coupon_data)
 
     # Map of DynamoDB field names (with aliases where needed) to updated_fields keys
     field_mapping = {
@@ -134,9 +401,33 @@ def update_coupon_details(coupon_data, updated_fields):
 
     if not update_expressions:
         print("No matching fields to update.")
-        return
+        return coupon_data
+
+    # keep the numeric amounts used by the conditional usage writes in sync
+    remove_expressions = []
+    if 'value' in updated_fields or 'used' in updated_fields:
+        amounts = amount_fields(coupon_data.get('value'), coupon_data.get('used'))
+        for name in ('value_amount', 'remaining_amount'):
+            if name in amounts:
+                update_expressions.append(f"{name} = :{name}")
+                expression_attribute_values[f":{name}"] = amounts[name]
+            else:
+                remove_expressions.append(name)
+
+    if 'expiration_date' in updated_fields:
+        expires_on = expiry_fields(coupon_data.get('expiration_date')).get('expires_on')
+        if expires_on:
+            update_expressions.append("expires_on = :expires_on")
+            expression_attribute_values[':expires_on'] = expires_on
+        else:
+            remove_expressions.append("expires_on")
+        if coupon_data.get('coupon_status') == 'unused':
+            update_expressions.append("active_expiry = :active_expiry")
+            expression_attribute_values[':active_expiry'] = expires_on or NO_EXPIRY
 
     update_expression = "SET " + ", ".join(update_expressions)
+    if remove_expressions:
+        update_expression += " REMOVE " + ", ".join(remove_expressions)
 
     update_params = {
         'Key': {
@@ -150,115 +441,412 @@ def update_coupon_details(coupon_data, updated_fields):
     if expression_attribute_names:
         update_params['ExpressionAttributeNames'] = expression_attribute_names
 
-    table.update_item(**update_params)
+    response = table.update_item(ReturnValues='ALL_NEW', **update_params)
+    cache_coupon(response.get('Attributes'))
+    # the cache hands out copies, so the caller's coupon is refreshed here
+    for name in remove_expressions:
+        coupon_data.pop(name, None)
+    coupon_data.update(response.get('Attributes') or {})
+    if 'category' in updated_fields or 'store' in updated_fields:
+        update_summary(previous_coupon, response.get('Attributes'))
 
-def mark_coupon_as_used(client_id, coupon_id):
-    """Mark a coupon as used."""
-    coupon = get_coupon_by_code(client_id, coupon_id)
-    full_used = parse_amount(coupon.get('value')) if coupon else None
+    # keep the coupon code lookup in sync when the code itself changed
+    if 'coupon_code' in updated_fields:
+        new_code = coupon_data.get('coupon_code')
+        if normalize_coupon_code(previous_code) != normalize_coupon_code(new_code):
+            unindex_coupon_code(coupon_data.get('client_id'), coupon_data.get('coupon_id'), previous_code)
+            index_coupon_code(coupon_data.get('client_id'), coupon_data.get('coupon_id'), new_code)
+    return coupon_data
 
-    expression = 'SET coupon_status = :val, used_timestamp = :timestamp'
-    expression_values = {':val': "used", ':timestamp': datetime.now().isoformat()}
-    if full_used is not None:
-        expression += ', used = :used'
-        expression_values[':used'] = to_decimal(full_used)
+def mark_coupon_as_used(client_id, coupon_id):
+    """Mark a coupon as used, setting its used amount to the full value when numeric.
 
-    table.update_item(
-        Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression=expression,
-        ExpressionAttributeValues=expression_values)
+    Returns the updated coupon.
+    """
+    coupon, transitioned = update_coupon_status(
+        client_id, coupon_id, Attr('coupon_status').eq('unused'),
+        UpdateExpression='SET coupon_status = :val, used_timestamp = :timestamp, '
+                         'used = if_not_exists(value_amount, used), remaining_amount = :zero REMOVE active_expiry',
+        ExpressionAttributeValues={':val': "used", ':timestamp': datetime.now().isoformat(), ':zero': 0})
+    if transitioned:
+        update_summary(dict(coupon, coupon_status='unused'), coupon)
+    # written before value_amount existed, so derive it from the value once
+    amounts = amount_fields(coupon.get('value')) if coupon and 'value_amount' not in coupon else {}
+    if amounts:
+        coupon = update_coupon_item(
+            client_id, coupon_id,
+            UpdateExpression='SET used = :used, value_amount = :used, remaining_amount = :zero',
+            ExpressionAttributeValues={':used': amounts['value_amount'], ':zero': 0})
     print("Coupon marked as used:", coupon_id)
+    return coupon
+
+def encode_cursor(key):
+    """Encode a DynamoDB key as an opaque cursor string that can be handed to clients."""
+    if not key:
+        return None
+    raw = json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_cursor_value(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+
+def _is_cursor_key(key):
+    # any JSON decodes, but only a map of the list queries' string key attributes is a key
+    return (isinstance(key, dict) and bool(key) and set(key) <= CURSOR_KEY_NAMES
+            and all(isinstance(value, str) for value in key.values()))
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by `encode_cursor` back into a DynamoDB key.
+
+    Raises ValueError when the cursor is not one this module produced.
+    """
+    if not cursor:
+        return None
+    key = _decode_cursor_value(cursor)
+    if not _is_cursor_key(key):
+        raise ValueError("Invalid cursor")
+    return key
+
+def decode_shared_cursor(cursor):
+    """Decode a cursor produced by `shared_cursor_for` back into its position, {} for none."""
+    if not cursor:
+        return {}
+    position = _decode_cursor_value(cursor)
+    if (not isinstance(position, dict) or not _is_cursor_key(position.get('key'))
+            or not isinstance(position.get('owner', ''), str)):
+        raise ValueError("Invalid cursor")
+    return position
+
+def cursor_for(item, key_names):
+    """Build the cursor that resumes a query right after `item`."""
+    return encode_cursor({name: item[name] for name in key_names if name in item})
+
+def paginate_query(query_params, page_size=None, limit=None, cursor=None, cache_key=None):
+    """Lazily yield items of a table query, following LastEvaluatedKey page by page.
+
+    `page_size` caps the items DynamoDB reads per round trip, `limit` caps the items
+    yielded overall and `cursor` resumes a previous iteration. With a `cache_key`, pages
+    already read in the current request are replayed instead of queried again.
+    """
+    params = dict(query_params)
+    if page_size:
+        params['Limit'] = page_size
+    if cursor:
+        params['ExclusiveStartKey'] = decode_cursor(cursor)
+
+    pages = []
+    if cache_key is not None:
+        full_key = ('query', cache_key, page_size, cursor)
+        cached = cache_get(full_key)
+        pages = cached if cached is not _MISSING else cache_put(full_key, [])
+
+    yielded = 0
+    page_number = 0
+    while limit is None or yielded < limit:
+        if page_number < len(pages):
+            items, last_key = pages[page_number]
+        else:
+            response = table.query(**params)
+            items, last_key = response.get('Items', []), response.get('LastEvaluatedKey')
+            pages.append((items, last_key))
+
+        for item in items:
+            yield item
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+
+        if not last_key:
+            return
+        params['ExclusiveStartKey'] = last_key
+        page_number += 1
+
+def take_page(items, limit, cursor_of):
+    """Materialize up to `limit` items of an iterator and return (items, next_cursor).
+
+    `cursor_of` builds the cursor that resumes the iteration after a given item.
+    """
+    page = []
+    for item in items:
+        if len(page) == limit:
+            return page, cursor_of(page[-1])
+        page.append(item)
+    return page, None
+
+def _coupon_filter(expiring_soon, days, include_used):
+    """Build the status/expiry FilterExpression of the coupon list queries that include used coupons."""
+    filter_expr = None if include_used else Attr('coupon_status').eq('unused')
 
-def get_user_coupons(client_id, expiring_soon=False, days=30, include_used=False):
-    """Get all unused coupons for a user. Optionally filter for expiring soon."""
-    if include_used:
-        filter_expr = None
-    else:
-        filter_expr = Attr('coupon_status').eq('unused')
-    
     if expiring_soon:
-        now = datetime.now()
-        future = now + timedelta(days=days)
-        expiring_filter = Attr('expiration_date').gt(now.isoformat()) & Attr('expiration_date').lte(future.isoformat())
+        today, last_day = _expiring_window(days)
+        expiring_filter = Attr('expires_on').between(today, last_day)
         filter_expr = filter_expr & expiring_filter if filter_expr else expiring_filter
-    
-    query_params = {'KeyConditionExpression': Key('client_id').eq(client_id)}
-    if filter_expr:
-        query_params['FilterExpression'] = filter_expr
-    
-    response = table.query(**query_params)
-    return response.get('Items', [])
+
+    return filter_expr
+
+def projection_params(profile):
+    """Build the ProjectionExpression of a named projection profile (list, search, detail or export)."""
+    if profile is None:
+        return {}
+    if profile not in PROJECTION_PROFILES:
+        raise ValueError("Invalid view")
+    attributes = PROJECTION_PROFILES[profile]
+    if attributes is None:
+        return {}
+    # every name gets a placeholder, since some of them (value, url, timestamp) are reserved words
+    return {
+        'ProjectionExpression': ", ".join(f"#p{i}" for i in range(len(attributes))),
+        'ExpressionAttributeNames': {f"#p{i}": name for i, name in enumerate(attributes)}
+    }
+
+def _expiring_window(days):
+    """First and last `expires_on` date of coupons expiring within `days`, today included."""
+    today = datetime.now().date()
+    return today.isoformat(), (today + timedelta(days=days)).isoformat()
+
+def _coupons_query(partition_name, partition_value, index_name, active_index_name, expiring_soon, days, include_used,
+                   profile=None):
+    """Build the query of a coupon list.
+
+    Unused coupons are read from the sparse active index by key condition alone, with
+    expiring-soon listings as a range of `active_expiry`. Listings that include used
+    coupons still read the whole partition. `profile` limits the attributes read.
+    """
+    query_params = projection_params(profile)
+    key_condition = Key(partition_name).eq(partition_value)
+    if include_used:
+        query_params['KeyConditionExpression'] = key_condition
+        if index_name:
+            query_params['IndexName'] = index_name
+        filter_expr = _coupon_filter(expiring_soon, days, include_used)
+        if filter_expr:
+            query_params['FilterExpression'] = filter_expr
+        return query_params
+
+    if expiring_soon:
+        today, last_day = _expiring_window(days)
+        key_condition = key_condition & Key('active_expiry').between(today, last_day)
+    query_params.update({'IndexName': active_index_name, 'KeyConditionExpression': key_condition})
+    return query_params
+
+def iter_user_coupons(client_id, expiring_soon=False, days=30, include_used=False, page_size=None, limit=None, cursor=None,
+                      profile=None):
+    """Lazily iterate a user's coupons across all query pages.
+
+    `profile` names the attributes to read (see PROJECTION_PROFILES); whole items by default.
+    """
+    query_params = _coupons_query('client_id', client_id, None, 'client_id-active_expiry-index',
+                                  expiring_soon, days, include_used, profile)
+    cache_key = ('user_coupons', client_id, expiring_soon, days, include_used, profile)
+    return paginate_query(query_params, page_size=page_size, limit=limit, cursor=cursor, cache_key=cache_key)
+
+def get_user_coupons(client_id, expiring_soon=False, days=30, include_used=False, profile=None):
+    """Get all unused coupons for a user. Optionally filter for expiring soon."""
+    return list(iter_user_coupons(client_id, expiring_soon=expiring_soon, days=days, include_used=include_used,
+                                  profile=profile))
+
+def has_coupons(client_id):
+    """Check whether a user has any unused coupon, from the coupon summary."""
+    return get_coupon_summary(client_id)['total'] > 0
+
+def get_user_coupons_page(client_id, limit, cursor=None, expiring_soon=False, days=30, include_used=False, profile=None):
+    """Get a single page of a user's coupons and the cursor of the next page."""
+    items = iter_user_coupons(client_id, expiring_soon=expiring_soon, days=days, include_used=include_used,
+                              limit=limit + 1, cursor=cursor, profile=profile)
+    key_names = USER_COUPONS_KEY if include_used else ACTIVE_USER_COUPONS_KEY
+    return take_page(items, limit, lambda item: cursor_for(item, key_names))
 
 def find_coupon_by_code(client_id, coupon_code):
     """Find a coupon by its code for a specific user."""
-    response = table.query(
-        KeyConditionExpression=Key('client_id').eq(client_id),
-        FilterExpression=Attr('coupon_code').eq(coupon_code)
-    )
-    items = response.get('Items', [])
-    return items[0] if items else None
+    code_key = coupon_code_key(client_id, coupon_code)
+    if not code_key:
+        return None
+
+    lookup = coupon_codes_table.get_item(Key={'code_key': code_key}).get('Item')
+    if not lookup:
+        return None
+
+    return get_coupon_item(client_id, lookup['coupon_id'])
+
+def batch_get_items(table_name, keys):
+    """Fetch items by primary key with BatchGetItem, following UnprocessedKeys."""
+    items = []
+    for start in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request_items = {table_name: {'Keys': keys[start:start + BATCH_GET_MAX_KEYS]}}
+        while request_items:
+            response = storage_backend.get_resource().batch_get_item(RequestItems=request_items)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request_items = response.get('UnprocessedKeys')
+    return items
+
+def find_coupons_by_codes(client_id, coupon_codes):
+    """Find the stored coupons holding any of the given codes, keyed by normalized code.
+
+    All codes are resolved with one BatchGetItem on the lookup table and one on the coupons.
+    """
+    code_keys = {}
+    for coupon_code in coupon_codes:
+        code_key = coupon_code_key(client_id, coupon_code)
+        if code_key:
+            code_keys[code_key] = normalize_coupon_code(coupon_code)
+    if not code_keys:
+        return {}
+
+    lookups = batch_get_items(config.COUPON_CODES_TABLE, [{'code_key': code_key} for code_key in code_keys])
+    coupon_ids = {lookup['coupon_id'] for lookup in lookups}
+    coupons = batch_get_items(config.COUPONS_TABLE, [{'client_id': client_id, 'coupon_id': coupon_id} for coupon_id in coupon_ids])
+    coupons_by_id = {coupon['coupon_id']: coupon for coupon in coupons}
+
+    found = {}
+    for lookup in lookups:
+        coupon = coupons_by_id.get(lookup['coupon_id'])
+        if coupon:
+            found[code_keys[lookup['code_key']]] = coupon
+    return found
+
+def find_duplicate_coupons(client_id, coupons):
+    """Return, for each parsed coupon, the coupon that already holds its code or None.
+
+    A code repeated within `coupons` is reported as a duplicate of its first occurrence.
+    """
+    existing = find_coupons_by_codes(client_id, [coupon.get('coupon_code') for coupon in coupons])
+    duplicates = []
+    for coupon in coupons:
+        code = normalize_coupon_code(coupon.get('coupon_code'))
+        duplicates.append(existing.get(code) if code else None)
+        if code and code not in existing:
+            existing[code] = coupon
+    return duplicates
 
 def unmark_coupon_as_used(client_id, coupon_id):
     """Unmark a coupon as used."""
-    table.update_item(
-        Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET coupon_status = :val, used = :used REMOVE used_timestamp',
-        ExpressionAttributeValues={':val': 'unused', ':used': 0}
+    # callers have just read the coupon, so this is normally served by the request cache
+    current = get_coupon_item(client_id, coupon_id) or {}
+    previous_status = current.get('coupon_status')
+    coupon, transitioned = update_coupon_status(
+        client_id, coupon_id, Attr('coupon_status').ne('unused'),
+        UpdateExpression='SET coupon_status = :val, used = :used, remaining_amount = if_not_exists(value_amount, :used), '
+                         'active_expiry = :active_expiry REMOVE used_timestamp',
+        ExpressionAttributeValues={':val': 'unused', ':used': 0,
+                                   ':active_expiry': current.get('expires_on') or NO_EXPIRY}
     )
+    if transitioned:
+        update_summary(dict(coupon, coupon_status=previous_status), coupon)
     print("Coupon unmarked as used:", coupon_id)
+    return coupon
 
 
-def update_coupon_used_value(client_id, coupon_id, amount):
-    """Increase coupon used amount by `amount`, clamped to coupon value if numeric."""
-    coupon = get_coupon_by_code(client_id, coupon_id)
-    if not coupon:
-        return None
+def update_coupon_used_value(client_id, coupon_id, amount, attempts=3):
+    """Increase coupon used amount by `amount`, clamped to coupon value if numeric.
 
-    current_used = parse_amount(coupon.get('used')) or 0.0
-    added = parse_amount(amount) or 0.0
-    new_used = current_used + max(added, 0.0)
+    The increment is a single conditional ADD, so concurrent usage updates are not lost.
+    Returns the updated coupon, or None when it does not exist.
+    """
+    added = to_decimal(max(parse_amount(amount) or 0.0, 0.0))
+    for _ in range(attempts):
+        try:
+            return update_coupon_item(
+                client_id, coupon_id,
+                UpdateExpression='ADD used :amount, remaining_amount :negative',
+                ConditionExpression='attribute_exists(value_amount) AND remaining_amount >= :amount',
+                ExpressionAttributeValues={':amount': added, ':negative': -added},
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            old_item = e.response.get('Item')
+            if not old_item:
+                return None
+            coupon = {name: _deserializer.deserialize(value) for name, value in old_item.items()}
 
-    # Check value field which might have currency symbols
-    value_amount = parse_amount(coupon.get('value'))
-    if value_amount is not None:
-        new_used = min(new_used, value_amount)
+        try:
+            if 'value_amount' in coupon:
+                # not enough left, so use up the remaining value
+                return update_coupon_item(
+                    client_id, coupon_id,
+                    UpdateExpression='SET used = value_amount, remaining_amount = :zero',
+                    ConditionExpression='remaining_amount < :amount',
+                    ExpressionAttributeValues={':zero': 0, ':amount': added}
+                )
 
-    table.update_item(
-        Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET used = :used',
-        ExpressionAttributeValues={':used': to_decimal(new_used)}
-    )
+            amounts = amount_fields(coupon.get('value'), (parse_amount(coupon.get('used')) or 0.0) + float(added))
+            if not amounts:
+                # no numeric value to clamp against
+                return update_coupon_item(
+                    client_id, coupon_id,
+                    UpdateExpression='ADD used :amount',
+                    ConditionExpression='attribute_exists(client_id) AND attribute_not_exists(value_amount)',
+                    ExpressionAttributeValues={':amount': added}
+                )
 
-    coupon['used'] = new_used
-    return coupon
+            # written before value_amount existed: derive it once, guarded against concurrent usage
+            new_used = amounts['value_amount'] - amounts['remaining_amount']
+            return update_coupon_item(
+                client_id, coupon_id,
+                UpdateExpression='SET used = :used, value_amount = :value, remaining_amount = :remaining',
+                ConditionExpression='attribute_not_exists(value_amount) AND used = :previous',
+                ExpressionAttributeValues={':used': new_used, ':value': amounts['value_amount'],
+                                           ':remaining': amounts['remaining_amount'],
+                                           ':previous': coupon.get('used')}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    return get_coupon_item(client_id, coupon_id)
+
+def get_coupon_by_code(client_id, coupon_id, owner_id=None):
+    """Get a specific coupon by its ID, including shared coupons.
 
-def get_coupon_by_code(client_id, coupon_id):
-    """Get a specific coupon by its ID, including shared coupons."""
+    When the owner is known (list rows carry `client_id:coupon_id`), the coupon is read
+    with a single GetItem and returned only if `client_id` is allowed to see it.
+    Lookups are memoized for the current request.
+    """
+    lookup_key = ('lookup', client_id, coupon_id, owner_id)
+    cached = cache_get(lookup_key)
+    if cached is not _MISSING:
+        return cached
+    return cache_put(lookup_key, _lookup_coupon(client_id, coupon_id, owner_id))
+
+def _lookup_coupon(client_id, coupon_id, owner_id):
     print("Getting coupon by code:", client_id, coupon_id)
+    if owner_id and owner_id != client_id:
+        coupon = get_coupon_item(owner_id, coupon_id)
+        return coupon if coupon and can_access_coupon(client_id, coupon) else None
+
     # First try to get the user's own coupon
-    response = table.get_item(
-        Key={"client_id": client_id, "coupon_id": coupon_id}
-    )
-    coupon = response.get("Item")
-    
+    coupon = get_coupon_item(client_id, coupon_id)
     if coupon:
         return coupon
-    
-    # If not found, check if it's a shared coupon
+
+    # Then check if it was shared with the user on its own
     response = table.query(
-        IndexName='shared_with-index',
-        KeyConditionExpression=Key('shared_with').eq(client_id),
-        FilterExpression=Attr('coupon_id').eq(coupon_id)
+        IndexName='shared_with-coupon_id-index',
+        KeyConditionExpression=Key('shared_with').eq(client_id) & Key('coupon_id').eq(coupon_id)
     )
     items = response.get('Items', [])
-    return items[0] if items else None
+    if items:
+        return cache_put(('coupon', items[0]['client_id'], coupon_id), items[0])
+
+    # Finally check the coupon lists shared through pairing
+    for owner in get_pairing_partners(client_id):
+        coupon = get_coupon_item(owner, coupon_id)
+        if coupon:
+            return coupon
+    return None
+
+def can_access_coupon(client_id, coupon):
+    """Check whether a user owns a coupon or had it shared with them."""
+    if coupon.get('client_id') == client_id or coupon.get('shared_with') == client_id:
+        return True
+    pairing = get_pairing(coupon.get('client_id'))
+    return pairing is not None and pairing.get("shared_with_client_id") == client_id
 
 def get_shared_coupon(share_token):
     """Get a coupon that has been shared using a token."""
-    # make sure user won't get previously shared coupons
-    if (share_token == "..."):
-        return None
-    
     print("Getting coupon by share token:", share_token)
     response = table.query(
         IndexName='sharing_token-index',
@@ -267,128 +855,382 @@ def get_shared_coupon(share_token):
     items = response.get("Items")
     if (len(items) == 0):
         return None
-    else:
-        return items[0]
+
+    coupon = items[0]
+    if is_sharing_token_expired(coupon):
+        revoke_sharing_token(coupon['client_id'], coupon['coupon_id'], share_token)
+        return None
+    return coupon
+
+def is_sharing_token_expired(coupon, now=None):
+    """Check whether the sharing token of a coupon is past its expiry."""
+    expires_at = coupon.get('sharing_token_expires_at')
+    if expires_at is None:
+        return False
+    now = now if now is not None else datetime.now().timestamp()
+    return int(expires_at) <= now
+
+def revoke_sharing_token(client_id, coupon_id, share_token):
+    """Drop a sharing token from the coupon, and with it from sharing_token-index."""
+    try:
+        update_coupon_item(
+            client_id, coupon_id,
+            UpdateExpression='REMOVE sharing_token, sharing_token_expires_at',
+            ConditionExpression=Attr('sharing_token').eq(share_token)
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
 
 def generate_sharing_token(client_id, coupon_id):
     """Generate a unique token for sharing a coupon."""
     sharing_token = f"{uuid.uuid4().hex[:8].upper()}"
-    table.update_item(
-        Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET sharing_token = :val',
-        ExpressionAttributeValues={':val': sharing_token}
+    expires_at = datetime.now() + timedelta(days=config.SHARING_TOKEN_TTL_DAYS)
+    update_coupon_item(
+        client_id, coupon_id,
+        UpdateExpression='SET sharing_token = :val, sharing_token_expires_at = :expires_at',
+        ExpressionAttributeValues={':val': sharing_token, ':expires_at': int(expires_at.timestamp())}
     )
     print("Sharing token generated:", sharing_token)
     return sharing_token
 
 def share_coupon_with_user(client_id, coupon_id, shared_with_client_id):
-    """Share a coupon with another user."""
-    table.update_item(
+    """Share a coupon with another user. The token used to share it is consumed."""
+    previous = table.update_item(
         Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET shared_with = :shared_with, sharing_token = :token',
-        ExpressionAttributeValues={':shared_with': shared_with_client_id, ':token': "..."}
-    )
+        UpdateExpression='SET shared_with = :shared_with REMOVE sharing_token, sharing_token_expires_at',
+        ExpressionAttributeValues={':shared_with': shared_with_client_id},
+        ReturnValues='ALL_OLD'
+    ).get('Attributes')
+    # the previous image tells which recipient's shared counters to move
+    coupon = {key: value for key, value in (previous or {}).items()
+              if key not in ('sharing_token', 'sharing_token_expires_at')}
+    coupon.update({'client_id': client_id, 'coupon_id': coupon_id, 'shared_with': shared_with_client_id})
+    cache_coupon(coupon)
+    update_summary(previous, coupon)
     print("Coupon shared with user:", client_id, coupon_id, shared_with_client_id)
 
 def cancel_coupon_sharing(client_id, coupon_id):
     """Cancel sharing of a coupon."""
-    table.update_item(
+    previous = table.update_item(
         Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET shared_with = :shared_with, sharing_token = :token',
-        ExpressionAttributeValues={':shared_with': "...", ':token': "..."}
-    )
+        UpdateExpression='REMOVE shared_with, sharing_token, sharing_token_expires_at',
+        ReturnValues='ALL_OLD'
+    ).get('Attributes')
+    coupon = {key: value for key, value in (previous or {}).items()
+              if key not in ('shared_with', 'sharing_token', 'sharing_token_expires_at')}
+    coupon.update({'client_id': client_id, 'coupon_id': coupon_id})
+    cache_coupon(coupon)
+    update_summary(previous, coupon)
     print("Coupon sharing cancelled:", coupon_id, client_id)
 
-def get_shared_coupons(client_id, expiring_soon=False, days=30, include_used=False):
+def get_pairing_partners(client_id):
+    """Get the users whose whole coupon list is shared with `client_id` through pairing."""
+    cache_key = ('pairing_partners', client_id)
+    cached = cache_get(cache_key)
+    if cached is not _MISSING:
+        return cached
+    response = pairing_table.query(
+        IndexName='shared_with_client_id-index',
+        KeyConditionExpression=Key('shared_with_client_id').eq(client_id)
+    )
+    return cache_put(cache_key, sorted(item['client_id'] for item in response.get('Items', [])))
+
+def shared_cursor_for(client_id, item, include_used=False):
+    """Build the cursor that resumes `iter_shared_coupons` right after `item`."""
+    if item.get('shared_with') == client_id:
+        key_names = SHARED_COUPONS_KEY if include_used else ACTIVE_SHARED_COUPONS_KEY
+        return encode_cursor({'key': {name: item[name] for name in key_names}})
+    key_names = USER_COUPONS_KEY if include_used else ACTIVE_USER_COUPONS_KEY
+    return encode_cursor({'owner': item['client_id'], 'key': {name: item[name] for name in key_names}})
+
+def iter_shared_coupons(client_id, expiring_soon=False, days=30, include_used=False, page_size=None, limit=None, cursor=None,
+                        profile=None):
+    """Lazily iterate the coupons shared with a user across all query pages.
+
+    Coupons shared one by one are read from `shared_with-index` (or, for unused ones,
+    `shared_with-active_expiry-index`) first, followed by the coupons of every pairing
+    partner, which are joined at read time.
+    """
+    coupons = _iter_shared_sources(client_id, expiring_soon, days, include_used, page_size, decode_shared_cursor(cursor),
+                                   profile)
+    return itertools.islice(coupons, limit)
+
+def _iter_shared_sources(client_id, expiring_soon, days, include_used, page_size, position, profile):
+    resume_owner = position.get('owner')
+    resume_cursor = encode_cursor(position['key']) if position else None
+
+    if resume_owner is None:
+        query_params = _coupons_query('shared_with', client_id, 'shared_with-index', 'shared_with-active_expiry-index',
+                                      expiring_soon, days, include_used, profile)
+        cache_key = ('shared_coupons', client_id, expiring_soon, days, include_used, profile)
+        yield from paginate_query(query_params, page_size=page_size, cursor=resume_cursor, cache_key=cache_key)
+        resume_cursor = None
+
+    for owner in get_pairing_partners(client_id):
+        if resume_owner is not None and owner < resume_owner:
+            continue
+        owner_cursor = resume_cursor if owner == resume_owner else None
+        for coupon in iter_user_coupons(owner, expiring_soon=expiring_soon, days=days, include_used=include_used,
+                                        page_size=page_size, cursor=owner_cursor, profile=profile):
+            # already listed from shared_with-index
+            if coupon.get('shared_with') != client_id:
+                yield coupon
+
+def get_shared_coupons(client_id, expiring_soon=False, days=30, include_used=False, profile=None):
     """Get all coupons shared with a user. Optionally filter for expiring soon."""
-    filter_expr = None if include_used else Attr('coupon_status').eq('unused')
-    
-    if expiring_soon:
-        now = datetime.now()
-        future = now + timedelta(days=days)
-        expiring_filter = Attr('expiration_date').gt(now.isoformat()) & Attr('expiration_date').lte(future.isoformat())
-        filter_expr = filter_expr & expiring_filter if filter_expr else expiring_filter
-    
-    query_params = {
-        'IndexName': 'shared_with-index',
-        'KeyConditionExpression': Key('shared_with').eq(client_id)
-    }
-    if filter_expr:
-        query_params['FilterExpression'] = filter_expr
+    return list(iter_shared_coupons(client_id, expiring_soon=expiring_soon, days=days, include_used=include_used,
+                                    profile=profile))
 
-    response = table.query(**query_params)
-    items = response.get('Items', [])
-    return items
+def get_shared_coupons_page(client_id, limit, cursor=None, expiring_soon=False, days=30, include_used=False, profile=None):
+    """Get a single page of the coupons shared with a user and the cursor of the next page."""
+    items = iter_shared_coupons(client_id, expiring_soon=expiring_soon, days=days, include_used=include_used,
+                                limit=limit + 1, cursor=cursor, profile=profile)
+    return take_page(items, limit, lambda item: shared_cursor_for(client_id, item, include_used))
 
 def confirm_pairing(my_client_id, his_client_id):
-    """Confirm pairing between two users for coupon sharing."""
+    """Confirm pairing between two users for coupon sharing.
+
+    The partner sees all of my coupons through the pairing relation, so no coupon is rewritten.
+    """
     pairing_table.update_item(
         Key={'client_id': my_client_id},
         UpdateExpression='SET shared_with_client_id = :shared_with',
         ExpressionAttributeValues={':shared_with': his_client_id}
     )
+    cache_drop('pairing')
+    cache_drop('pairing_partners')
+    cache_drop('lookup')
     print("Pairing confirmed:", my_client_id, his_client_id)
-    
-    # update all of the coupons to be shared with the new partner
-    all_coupons = get_user_coupons(my_client_id)
-    for coupon in all_coupons:
-        share_coupon_with_user(my_client_id, coupon.get("coupon_id"), his_client_id)
 
 def cancel_pairing(client_id):
     """Cancel pairing between users."""
     # get pairing partner
-    pairing_partner = pairing_table.get_item(Key={'client_id': client_id}).get("Item")
+    pairing_partner = get_pairing(client_id)
     if (pairing_partner is not None):
         partner_id = pairing_partner.get("shared_with_client_id")
 
         # cancel pairing with the partner
         pairing_table.delete_item(Key={'client_id': client_id})
         pairing_table.delete_item(Key={'client_id': partner_id})
+        cache_drop('pairing')
+        cache_drop('pairing_partners')
+        cache_drop('lookup')
     
         print("Pairing cancelled:", client_id)
-        
-        # update all of the coupons to be shared with the new partner
-        all_coupons = get_user_coupons(client_id)
-        for coupon in all_coupons:
-            cancel_coupon_sharing(client_id, coupon.get("coupon_id"))
-
-        # update all of the coupons to be shared with the new partner
-        all_coupons = get_user_coupons(partner_id)
-        for coupon in all_coupons:
-            cancel_coupon_sharing(partner_id, coupon.get("coupon_id"))
 
 def cancel_coupon(client_id, coupon_id):
     """Cancel a coupon."""
-    table.update_item(
-        Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET coupon_status = :val',
+    coupon, transitioned = update_coupon_status(
+        client_id, coupon_id, Attr('coupon_status').eq('unused'),
+        UpdateExpression='SET coupon_status = :val REMOVE active_expiry',
         ExpressionAttributeValues={':val': "canceled"})
+    if transitioned:
+        update_summary(dict(coupon, coupon_status='unused'), coupon)
     print("Coupon canceled:", coupon_id)
 
-def set_user_state(client_id, updated_state):
-    """Set or update a user's state."""
-    if (get_user_state(client_id) is None):
-        user_state_table.put_item(Item={'client_id': client_id, 'user_state': updated_state})
-        print("User state created:", client_id, updated_state)
-        return
-    user_state_table.update_item(
-        Key={'client_id': client_id},
-        UpdateExpression='SET user_state = :user_state',
-        ExpressionAttributeValues={':user_state': updated_state}
-    )
+def set_user_state(client_id, updated_state, expected_state=_ANY_STATE):
+    """Set or update a user's state with a single upsert.
+
+    With `expected_state` the write only happens if the stored state still matches it
+    (None meaning the user has no state yet), so concurrent messages of the same user
+    cannot overwrite each other's flow. Returns whether the state was written.
+    """
+    update_params = {
+        'Key': {'client_id': client_id},
+        'UpdateExpression': 'SET user_state = :user_state',
+        'ExpressionAttributeValues': {':user_state': updated_state}
+    }
+    if expected_state is None:
+        update_params['ConditionExpression'] = Attr('user_state').not_exists()
+    elif expected_state is not _ANY_STATE:
+        update_params['ConditionExpression'] = Attr('user_state').eq(expected_state)
+
+    try:
+        user_state_table.update_item(**update_params)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        cache_drop('user_state')
+        print("User state changed concurrently, not updated:", client_id, updated_state)
+        return False
+    cache_put(('user_state', client_id), updated_state)
     print("User state updated:", client_id, updated_state)
+    return True
 
 def get_user_state(client_id):
-    """Get a user's current state."""
+    """Get a user's current state, memoized for the current request."""
+    cache_key = ('user_state', client_id)
+    cached = cache_get(cache_key)
+    if cached is not _MISSING:
+        return cached
     response = user_state_table.get_item(Key={'client_id': client_id})
     if response.get("Item") is None:
-        return None
-    return response.get("Item").get("user_state")
+        return cache_put(cache_key, None)
+    return cache_put(cache_key, response.get("Item").get("user_state"))
 
 def save_coupon_to_db_without_code(client_id, coupon_id):
     """Save a coupon without a code."""
-    table.update_item(
+    response = table.update_item(
         Key={'client_id': client_id, 'coupon_id': coupon_id},
-        UpdateExpression='SET coupon_status = :val, coupon_code = :code, used = :used',
-        ExpressionAttributeValues={':val': "unused", ':code' : None, ':used': 0})
-    print("Coupon saved:", coupon_id)
\ No newline at end of file
+        UpdateExpression='SET coupon_status = :val, coupon_code = :code, used = :used, '
+                         'remaining_amount = if_not_exists(value_amount, :used), '
+                         'active_expiry = if_not_exists(active_expiry, :no_expiry)',
+        ExpressionAttributeValues={':val': "unused", ':code' : None, ':used': 0, ':no_expiry': NO_EXPIRY},
+        ReturnValues='ALL_OLD')
+    forget_coupon(client_id, coupon_id)
+    previous = response.get('Attributes', {})
+    unindex_coupon_code(client_id, coupon_id, previous.get('coupon_code'))
+    if previous:
+        update_summary(previous, dict(previous, coupon_status='unused'))
+    print("Coupon saved:", coupon_id)
+
+def summary_counters(coupon):
+    """The summary counters an active coupon contributes to, per user.
+
+    The owner counts it under `total` and `store#<category>#<store>`. A user the coupon
+    is shared with counts it under the same names prefixed with `shared_`.
+    Used and canceled coupons count nowhere.
+    """
+    if not coupon or coupon.get('coupon_status') != 'unused':
+        return {}
+    category = coupon.get('category') or 'other'
+    store = coupon.get('store') or "חנות לא ידועה"
+    names = ('total', f"store#{category}#{store}")
+
+    counters = {coupon['client_id']: {name: 1 for name in names}}
+    if coupon.get('shared_with'):
+        counters[coupon['shared_with']] = {f"shared_{name}": 1 for name in names}
+    return counters
+
+def summary_deltas(old_coupon, new_coupon, deltas=None):
+    """Add the counter changes of a coupon going from `old_coupon` to `new_coupon` to `deltas`."""
+    deltas = deltas if deltas is not None else {}
+    for coupon, sign in ((old_coupon, -1), (new_coupon, 1)):
+        for client_id, counters in summary_counters(coupon).items():
+            user_deltas = deltas.setdefault(client_id, {})
+            for name, count in counters.items():
+                user_deltas[name] = user_deltas.get(name, 0) + sign * count
+    return deltas
+
+def apply_summary_deltas(deltas):
+    """Apply counter changes to the summary items with one ADD update per user."""
+    for client_id, user_deltas in deltas.items():
+        changes = [(name, delta) for name, delta in user_deltas.items() if delta]
+        if not changes:
+            continue
+        summary_table.update_item(
+            Key={'client_id': client_id},
+            UpdateExpression='ADD ' + ', '.join(f"#n{i} :d{i}" for i in range(len(changes))),
+            ExpressionAttributeNames={f"#n{i}": name for i, (name, _) in enumerate(changes)},
+            ExpressionAttributeValues={f":d{i}": delta for i, (_, delta) in enumerate(changes)}
+        )
+    cache_drop('summary')
+
+def update_summary(old_coupon, new_coupon):
+    """Keep the coupon summaries in sync with a single coupon write."""
+    apply_summary_deltas(summary_deltas(old_coupon, new_coupon))
+
+def update_coupon_status(client_id, coupon_id, condition, **update_params):
+    """Update a coupon status, reporting whether the write changed it.
+
+    The update is first tried under `condition` (the status it is expected to leave), so
+    only a real transition moves the summary counters. Otherwise it is applied as is.
+    Returns the updated coupon and whether the transition happened.
+    """
+    try:
+        return update_coupon_item(client_id, coupon_id, ConditionExpression=condition, **update_params), True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    return update_coupon_item(client_id, coupon_id, **update_params), False
+
+def get_coupon_summary(client_id):
+    """Get the counts of a user's active coupons, memoized for the current request.
+
+    Returns `total` and `categories` (store counts per category) of the user's own coupons
+    and `shared_total`/`shared_categories` of the coupons shared with them one by one.
+    A missing summary is built from the coupons once.
+    """
+    cache_key = ('summary', client_id)
+    cached = cache_get(cache_key)
+    if cached is not _MISSING:
+        return cached
+
+    item = summary_table.get_item(Key={'client_id': client_id}).get('Item')
+    if not item or not item.get('built'):
+        item = rebuild_coupon_summary(client_id)
+    return cache_put(cache_key, parse_summary(item))
+
+def parse_summary(item):
+    """Turn the flat counters of a summary item into totals and per-category store counts."""
+    summary = {'total': 0, 'categories': {}, 'shared_total': 0, 'shared_categories': {}}
+    for name, count in item.items():
+        prefix = 'shared_' if name.startswith('shared_') else ''
+        kind, _, rest = name[len(prefix):].partition('#')
+        count = int(count) if isinstance(count, (int, Decimal)) else 0
+        if kind == 'total' and not rest:
+            summary[prefix + 'total'] = max(count, 0)
+        elif kind == 'store' and count > 0:
+            category, _, store = rest.partition('#')
+            summary[prefix + 'categories'].setdefault(category, {})[store] = count
+    return summary
+
+def rebuild_coupon_summary(client_id):
+    """Count a user's active and shared coupons from scratch and store them as the summary."""
+    deltas = {}
+    query_params = _coupons_query('shared_with', client_id, 'shared_with-index', 'shared_with-active_expiry-index',
+                                  False, 0, False, 'list')
+    for coupon in itertools.chain(iter_user_coupons(client_id, profile='list'), paginate_query(query_params)):
+        summary_deltas(None, coupon, deltas)
+
+    item = {'client_id': client_id, 'built': True, 'total': 0, 'shared_total': 0}
+    item.update(deltas.get(client_id, {}))
+    try:
+        summary_table.put_item(Item=item, ConditionExpression=Attr('built').not_exists())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # built concurrently by another request
+        return summary_table.get_item(Key={'client_id': client_id}).get('Item')
+    print("Coupon summary rebuilt:", client_id, item['total'])
+    return item
+
+def get_list_summary(client_id):
+    """Get the counts behind a user's coupon list: own, shared one by one and paired coupons.
+
+    A partner's coupon that was also shared with the user one by one is listed once, so it
+    is counted once: with the partner's coupons and not with the shared ones.
+    """
+    summary = get_coupon_summary(client_id)
+    partners = get_pairing_partners(client_id)
+    total = summary['total'] + summary['shared_total']
+    categories = {}
+    sources = [(summary['categories'], 1), (summary['shared_categories'], 1)]
+    for owner in partners:
+        partner_summary = get_coupon_summary(owner)
+        total += partner_summary['total']
+        sources.append((partner_summary['categories'], 1))
+
+    if partners and summary['shared_total']:
+        partner_shares = {}
+        query_params = _coupons_query('shared_with', client_id, 'shared_with-index', 'shared_with-active_expiry-index',
+                                      False, 30, False, 'list')
+        cache_key = ('shared_coupons', client_id, False, 30, False, 'list')
+        for coupon in paginate_query(query_params, cache_key=cache_key):
+            if coupon['client_id'] in partners:
+                summary_deltas(None, coupon, partner_shares)
+        counters = partner_shares.get(client_id, {})
+        total -= counters.get('shared_total', 0)
+        sources.append((parse_summary(counters)['shared_categories'], -1))
+
+    for source, sign in sources:
+        for category, stores in source.items():
+            merged = categories.setdefault(category, {})
+            for store, count in stores.items():
+                merged[store] = merged.get(store, 0) + sign * count
+    for category in list(categories):
+        categories[category] = {store: count for store, count in categories[category].items() if count > 0}
+        if not categories[category]:
+            del categories[category]
+    return {'total': total, 'categories': categories}
@@ -0,0 +1,155 @@
+"""
+Utility functions for normalizing coupon expiration dates.
+"""
+
+import calendar
+import re
+from datetime import date, datetime, timedelta
+
+HEBREW_MONTHS = {
+    "ינואר": 1, "פברואר": 2, "מרץ": 3, "מרס": 3, "אפריל": 4, "מאי": 5, "יוני": 6,
+    "יולי": 7, "אוגוסט": 8, "ספטמבר": 9, "אוקטובר": 10, "נובמבר": 11, "דצמבר": 12
+}
+
+ENGLISH_MONTHS = {
+    name.lower(): number for number, name in enumerate(calendar.month_name) if name
+}
+ENGLISH_MONTHS.update({
+    name.lower(): number for number, name in enumerate(calendar.month_abbr) if name
+})
+
+MONTH_NAMES = {**HEBREW_MONTHS, **ENGLISH_MONTHS}
+
+ISO_DATE_PATTERN = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})(?:[T ].*)?$")
+NUMERIC_DATE_PATTERN = re.compile(r"^(\d{1,2})[/.\-](\d{1,2})(?:[/.\-](\d{2}|\d{4}))?$")
+MONTH_NAME_PATTERN = re.compile(r"^(?:(\d{1,2})\s+)?ב?-?([^\d\s,]+),?\s*(\d{4})?$")
+# The month before the day, as in English: "December 31, 2025", "Dec. 31st 2025"
+MONTH_FIRST_PATTERN = re.compile(r"^([^\d\s,.]+)\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s*(\d{4})?$", re.IGNORECASE)
+# A unit word standing on its own, after a count or the "ל" of "לשנה"; inside another word
+# ("today", "Monday") or after another prefix ("סוף החודש" is the end of this month) it is not a period
+RELATIVE_PATTERN = re.compile(
+    r"(?:(?<!\w)(\d+)\s*-?\s*|(?<!\w)ל?-?)(ימים|יום|חודשים|חודש|שנים|שנה|days?|months?|years?)(?!\w)",
+    re.IGNORECASE
+)
+# A unit that names a calendar period ("end of the month", "this year") rather than a length
+CALENDAR_PERIOD_PATTERN = re.compile(r"\b(?:this|the|of|next|last|every|per)\s+(?:days?|weeks?|months?|years?)\b", re.IGNORECASE)
+# Periods written as a single word, e.g. "לשנתיים" or "חצי שנה"
+NAMED_PERIODS = [
+    (re.compile(rf"(?<!\w)ל?-?{phrase}(?!\w)"), unit, count) for phrase, unit, count in [
+        ("חצי שנה", "months", 6),
+        ("שנתיים", "years", 2),
+        ("חודשיים", "months", 2),
+        ("שבועיים", "days", 14),
+        ("שבוע", "days", 7),
+    ]
+]
+RELATIVE_UNITS = {
+    "יום": "days", "ימים": "days", "day": "days", "days": "days",
+    "חודש": "months", "חודשים": "months", "month": "months", "months": "months",
+    "שנה": "years", "שנים": "years", "year": "years", "years": "years"
+}
+
+
+def end_of_month(year, month):
+    """Return the last day of a month."""
+    return date(year, month, calendar.monthrange(year, month)[1])
+
+def add_period(start, unit, count):
+    """Add a number of days, months or years to a date, clamping to the end of the month."""
+    if unit == "days":
+        return start + timedelta(days=count)
+    months = count * 12 if unit == "years" else count
+    month_index = start.month - 1 + months
+    year, month = start.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
+def _full_year(year):
+    return 2000 + year if year < 100 else year
+
+def _parse_numeric(first, second, year, today):
+    if year is not None:
+        return date(_full_year(int(year)), int(second), int(first))
+
+    first, second = int(first), int(second)
+    # two numbers only: MM/YY (end of that month) when it is a valid month of this year or later,
+    # or when it cannot be DD/MM, like the already past "12/25"
+    if 1 <= first <= 12 and (_full_year(second) >= today.year or second > 12):
+        return end_of_month(_full_year(second), first)
+    # otherwise DD/MM in the current year
+    return date(today.year, second, first)
+
+def _parse_month_name(day, month_name, year, today):
+    month = MONTH_NAMES.get(month_name.lower())
+    if month is None:
+        return None
+    year = int(year) if year else today.year
+    if day:
+        return date(year, month, int(day))
+    return end_of_month(year, month)
+
+def _parse_relative(text, reference):
+    if CALENDAR_PERIOD_PATTERN.search(text):
+        return None
+    for pattern, unit, count in NAMED_PERIODS:
+        if pattern.search(text):
+            return add_period(reference, unit, count)
+    match = RELATIVE_PATTERN.search(text)
+    if not match:
+        return None
+    count = int(match.group(1)) if match.group(1) else 1
+    return add_period(reference, RELATIVE_UNITS[match.group(2).lower()], count)
+
+def normalize_expiration_date(value, reference=None):
+    """
+    Normalize a free-form expiration date to an ISO YYYY-MM-DD string.
+
+    Handles ISO dates and datetimes, DD/MM/YYYY (also with dots, dashes or a two digit
+    year), MM/YY meaning the end of that month (also a past one, so an expired coupon
+    keeps its date), DD/MM in the current year, Hebrew and English month names before or
+    after the day ("31 בדצמבר 2025", "December 31, 2025"), and relative periods such as
+    "30 יום" or "שנה".
+
+    Args:
+        value: The expiration date as extracted from the coupon
+        reference: Date relative periods count from (defaults to today)
+
+    Returns:
+        The canonical date string, or None if the value cannot be understood
+    """
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if not isinstance(value, str) or not value.strip():
+        return None
+
+    text = value.strip()
+    today = reference or date.today()
+    if isinstance(today, datetime):
+        today = today.date()
+
+    try:
+        match = ISO_DATE_PATTERN.match(text)
+        if match:
+            return date(int(match.group(1)), int(match.group(2)), int(match.group(3))).isoformat()
+
+        match = NUMERIC_DATE_PATTERN.match(text)
+        if match:
+            return _parse_numeric(match.group(1), match.group(2), match.group(3), today).isoformat()
+
+        match = MONTH_NAME_PATTERN.match(text)
+        if match:
+            parsed = _parse_month_name(match.group(1), match.group(2), match.group(3), today)
+            if parsed:
+                return parsed.isoformat()
+
+        match = MONTH_FIRST_PATTERN.match(text)
+        if match:
+            parsed = _parse_month_name(match.group(2), match.group(1), match.group(3), today)
+            if parsed:
+                return parsed.isoformat()
+
+        parsed = _parse_relative(text, today)
+        return parsed.isoformat() if parsed else None
+    except ValueError:
+        return None
@@ -0,0 +1,96 @@
+"""
+Utility functions for parsing money amounts from free-form coupon values.
+"""
+
+import re
+from collections import namedtuple
+from decimal import Decimal
+from functools import lru_cache
+
+Money = namedtuple("Money", ["amount", "currency"])
+
+# Currency markers as they appear in coupon texts, longest first so "ש\"ח" wins over "ש"
+CURRENCY_MARKERS = [
+    ("ש\"ח", "ILS"), ("ש״ח", "ILS"), ("שקלים", "ILS"), ("שקל", "ILS"), ("שח", "ILS"),
+    ("₪", "ILS"), ("NIS", "ILS"), ("ILS", "ILS"),
+    ("$", "USD"), ("USD", "USD"),
+    ("€", "EUR"), ("EUR", "EUR"),
+    ("£", "GBP"), ("GBP", "GBP"),
+]
+
+CURRENCY_PATTERN = re.compile("|".join(re.escape(marker) for marker, _ in CURRENCY_MARKERS), re.IGNORECASE)
+CURRENCY_CODES = {marker.upper(): currency for marker, currency in CURRENCY_MARKERS}
+
+# A number with an optional thousands separator ("1,000") or decimal comma ("12,5")
+THOUSANDS_PATTERN = re.compile(r"-?\d{1,3}(?:,\d{3})+(?:\.\d+)?")
+AMOUNT_PATTERN = re.compile(r"(?<!\d)-?(?:\d{1,3}(?:,\d{3})+(?!\d)(?:\.\d+)?|\d+(?:[.,]\d+)?)")
+
+# Values parsed per process; coupon values repeat a lot ("100₪", "50 ש\"ח")
+CACHE_SIZE = 4096
+
+
+def _to_float(number_text):
+    if THOUSANDS_PATTERN.fullmatch(number_text):
+        return float(number_text.replace(",", ""))
+    return float(number_text.replace(",", "."))
+
+def _currency_near(text, start, end):
+    """Find the currency marker written right before or after an amount."""
+    for match in CURRENCY_PATTERN.finditer(text):
+        between = text[match.end():start] if match.end() <= start else text[end:match.start()]
+        if not between.strip():
+            return CURRENCY_CODES[match.group().upper()]
+    return None
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_amount_text(text):
+    match = AMOUNT_PATTERN.search(text)
+    if not match:
+        return None
+    try:
+        return _to_float(match.group())
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_money_text(text):
+    amounts = []
+    for match in AMOUNT_PATTERN.finditer(text):
+        try:
+            amount = _to_float(match.group())
+        except ValueError:
+            continue
+        amounts.append(Money(amount, _currency_near(text, match.start(), match.end())))
+    return tuple(amounts)
+
+def parse_amount(value):
+    """Extract a numeric amount from free-form value strings like '100₪', '$50', or '100.5 ש"ח'."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return float(value)
+    return _parse_amount_text(str(value).strip())
+
+def parse_amounts(values):
+    """Parse the amounts of a whole coupon list at once, e.g. every `value` of a listing.
+
+    Repeated values are parsed once, so a list costs about one parse per distinct value.
+    """
+    parsed = {}
+    amounts = []
+    for value in values:
+        if value not in parsed:
+            parsed[value] = parse_amount(value)
+        amounts.append(parsed[value])
+    return amounts
+
+def parse_money(value):
+    """Parse every amount in a value together with its currency code (ILS, USD, EUR, GBP or None).
+
+    Returns a tuple of Money, e.g. '100₪ / $30' gives (Money(100.0, 'ILS'), Money(30.0, 'USD')).
+    """
+    if value is None:
+        return ()
+    if isinstance(value, (int, float, Decimal)):
+        return (Money(float(value), None),)
+    return _parse_money_text(str(value).strip())
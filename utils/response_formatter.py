@@ -1,26 +1,8 @@
 import urllib.parse
 import config
+import utils.date_utils as date_utils
 from datetime import datetime
-import re
-
-
-def parse_amount(value):
-    if value is None:
-        return None
-    if isinstance(value, (int, float)):
-        return float(value)
-
-    # Clean text to handle currency symbols
-    text = str(value).strip().replace(",", ".")
-    text = text.replace("₪", "").replace("$", "").replace("ש\"ח", "").replace("שח", "")
-    
-    match = re.search(r"-?\d+(?:\.\d+)?", text)
-    if not match:
-        return None
-    try:
-        return float(match.group())
-    except ValueError:
-        return None
+from utils.money import parse_amounts
 
 
 def format_amount(amount):
@@ -33,7 +15,17 @@ def format_amount(amount):
 
 def build_remaining_display(coupon_data, compact=False):
     """Return a remaining/value text only when used > 0."""
-    used = parse_amount(coupon_data.get('used')) or 0
+    return build_remaining_displays([coupon_data], compact)[0]
+
+def build_remaining_displays(coupons, compact=False):
+    """build_remaining_display of a whole list, parsing each distinct used and value string once."""
+    used_amounts = parse_amounts([coupon.get('used') for coupon in coupons])
+    # only coupons with usage show a remaining amount
+    value_amounts = parse_amounts([coupon.get('value') if used else None for coupon, used in zip(coupons, used_amounts)])
+    return [_remaining_display(coupon, used or 0, value_amount, compact)
+            for coupon, used, value_amount in zip(coupons, used_amounts, value_amounts)]
+
+def _remaining_display(coupon_data, used, value_amount, compact):
     if used <= 0:
         return None
 
@@ -43,7 +35,8 @@ def build_remaining_display(coupon_data, compact=False):
 
     remaining = coupon_data.get('remaining')
     if remaining is None:
-        value_amount = parse_amount(value_text)
+        remaining = coupon_data.get('remaining_amount') if coupon_data.get('value_amount') is not None else None
+    if remaining is None:
         if value_amount is None:
             return None
         remaining = max(value_amount - used, 0)
@@ -126,14 +119,11 @@ def format_response(coupon_id, coupon_data, is_new, is_shared=False):
         title += " 👥 "
 
     body_text = title + "\n\n" + "\n".join(body_lines)
-    if coupon_data.get("expiration_date"):
+    # expires_on is the normalized date stored with the coupon, older coupons only have the raw one
+    exp_date_str = coupon_data.get("expires_on") or date_utils.normalize_expiration_date(coupon_data.get("expiration_date"))
+    if exp_date_str:
         now = datetime.now()
-        exp_date_str = coupon_data["expiration_date"]
-        # Handle both date-only and datetime formats
-        if 'T' in exp_date_str:
-            expiration_date = datetime.fromisoformat(exp_date_str.split('.')[0])  # Remove microseconds if present
-        else:
-            expiration_date = datetime.strptime(exp_date_str, "%Y-%m-%d")
+        expiration_date = datetime.strptime(exp_date_str, "%Y-%m-%d")
         remaining_days_for_expiration = (expiration_date - now).days
         if remaining_days_for_expiration < 0:
             footer_text = "קופון פג תוקף"
@@ -162,7 +152,7 @@ def format_response(coupon_id, coupon_data, is_new, is_shared=False):
         })
         # show sharing options only for new coupon 
         if not is_shared:
-            if (coupon_data.get("shared_with") and coupon_data["shared_with"] != "..."):
+            if coupon_data.get("shared_with"):
                 buttons.append({
                     "type": "reply",
                     "reply": {
@@ -338,9 +328,9 @@ def format_coupon_list_inline(coupons, shared_coupons):
             category_name = get_category_name(category)
             category_emoji = get_category_emoji(category)
             lines.append(f"{category_emoji} *{category_name}*")
-            for coupon in coupons:
+            for coupon, remaining_display in zip(coupons, build_remaining_displays(coupons, compact=True)):
                 store = coupon.get("store", "חנות לא ידועה") or "חנות לא ידועה"
-                value = build_remaining_display(coupon, compact=True) or coupon.get("value") or coupon.get("discount_value") or ""
+                value = remaining_display or coupon.get("value") or coupon.get("discount_value") or ""
                 line = f"- {RTL}{store}" + (f" - {value}" if value else "")
                 lines.append(line)    
             lines.append("")  # Add a blank line after each category
@@ -359,10 +349,11 @@ def format_coupons_list_interactive(coupons, shared_coupons, title="📋 רשי
         "rows": []
     }]
     
-    for idx, coupon in enumerate(coupons[:max_coupons], start=1):
+    listed = coupons[:max_coupons]
+    for coupon, remaining_display in zip(listed, build_remaining_displays(listed, compact=True)):
         store = coupon.get("store", "חנות לא ידועה") or "חנות לא ידועה"
         code = coupon.get("coupon_code", "-") or "(ללא קוד)"
-        value = build_remaining_display(coupon, compact=True) or coupon.get("value") or coupon.get("discount_value") or ""
+        value = remaining_display or coupon.get("value") or coupon.get("discount_value") or ""
         desc = (f"{value} - " if value else "") + f"קוד: {code}"
         
         sections[0]["rows"].append({
@@ -375,10 +366,11 @@ def format_coupons_list_interactive(coupons, shared_coupons, title="📋 רשי
         sections.append({
         "title": "קופונים ששותפו איתי",
         "rows": []})
-        for idx, shared_coupon in enumerate(shared_coupons[:max_coupons - len(sections[0]["rows"])], start=1):
+        listed_shared = shared_coupons[:max_coupons - len(sections[0]["rows"])]
+        for shared_coupon, remaining_display in zip(listed_shared, build_remaining_displays(listed_shared, compact=True)):
             store = shared_coupon.get("store", "חנות לא ידועה") or "חנות לא ידועה"
             code = shared_coupon.get("coupon_code", "-") or "(ללא קוד)"
-            value = build_remaining_display(shared_coupon, compact=True) or shared_coupon.get("value") or shared_coupon.get("discount_value") or ""
+            value = remaining_display or shared_coupon.get("value") or shared_coupon.get("discount_value") or ""
             desc = (f"{value} - " if value else "") + f"קוד: {code}"
 
             sections[1]["rows"].append({
@@ -485,7 +477,7 @@ def build_pairing_confirmation_message(phone_number: str) -> dict:
 def format_update_coupon_message(coupon_data):
     """Format a message for updating a coupon."""
     coupon_id = coupon_data.get("coupon_id")
-    is_shared = coupon_data.get("shared_with") and coupon_data["shared_with"] != "..."
+    is_shared = coupon_data.get("shared_with")
     buttons = [{
         "type": "reply",
         "reply": {
@@ -500,7 +492,7 @@ def format_update_coupon_message(coupon_data):
             }
         }]
     if not is_shared:
-        if (coupon_data.get("shared_with") and coupon_data["shared_with"] != "..."):
+        if coupon_data.get("shared_with"):
             buttons.append({
                 "type": "reply",
                 "reply": {
@@ -577,6 +569,10 @@ def format_categories_list(coupons, shared_coupons, title="🎉 צברת אחל
             categories[category][store] = 0
         categories[category][store] += 1
     
+    return format_categories_menu(categories, len(all_coupons), title=title)
+
+def format_categories_menu(categories, total_coupons, title="🎉 צברת אחלה של קופונים!"):
+    """Format the categories menu from store counts per category, e.g. from the coupon summary."""
     sections = [{
         "title": "קטגוריות",
         "rows": []
@@ -618,7 +614,7 @@ def format_categories_list(coupons, shared_coupons, title="🎉 צברת אחל
                 "text": title
             },
             "body": {
-                "text": f"🎁 איזה יופי! צברת כבר {len(all_coupons)} קופונים 🤑\nרוצה למצוא את המתאים לך?\nבחר קטגוריה לפי מה שאתה מחפש 🔍\nאפשר גם לחפש קופון ספציפי — שלח ! ואז את הטקסט לחיפוש, למשל: \"!פיצה\""
+                "text": f"🎁 איזה יופי! צברת כבר {total_coupons} קופונים 🤑\nרוצה למצוא את המתאים לך?\nבחר קטגוריה לפי מה שאתה מחפש 🔍\nאפשר גם לחפש קופון ספציפי — שלח ! ואז את הטקסט לחיפוש, למשל: \"!פיצה\""
             },
             "footer": {
                 "text": "בחר קטגוריה כדי לראות את הקופונים"